@@ -0,0 +1,756 @@
+#!/usr/bin/env python
+# Benchmarks for pylisp2 and pysmt
+# usage: python benchmark.py [benchmark name ...]   (default: run them all)
+import os
+import sys
+import time
+import shutil
+import tempfile
+import pylisp2
+from pylisp2 import lisp_parse, lisp_file, LispNode
+
+def timed(f, *args):
+  "returns (seconds taken, result) for f(*args)"
+  start = time.time()
+  result = f(*args)
+  return time.time() - start, result
+
+def smt_text(blocks):
+  "returns the text of a synthetic smt2 file with the given number of blocks"
+  lines = ["(", "; generated benchmark input"]
+  for i in range(blocks):
+    lines.append("; block "+str(i))
+    lines.append("(declare-fun f"+str(i)+" ((_ BitVec 3) Bool) (_ BitVec 2))")
+    lines.append("(define-fun g"+str(i)+" ((x (_ BitVec 3)) (b Bool)) Bool "+\
+                 "(and b (bvult x #b011) (= (f"+str(i)+" x b) #b01)))")
+    lines.append("(assert (forall ((x (_ BitVec 3)) (y (_ BitVec 2))) "+\
+                 "(or (g"+str(i)+" x true) (= (f"+str(i)+" x false) y))))")
+  lines.append(")")
+  return "\n".join(lines)+"\n"
+
+def _legacy_parse(content, comment):
+  "parses content with the char-at-a-time iterators"
+  return pylisp2._lisp_node_from_iterator(pylisp2._SpaceBufferedIterator(
+      pylisp2._CommentRemovalIterator(content, comment)))
+
+def _legacy_file(filename, comment):
+  "parses filename with the char-at-a-time iterators"
+  return _legacy_parse(pylisp2._file_iter(filename), comment)
+
+def bench_parse(blocks=2000):
+  "parse throughput: chunked tokenizer versus the char-at-a-time iterators"
+  text = smt_text(blocks)
+  megabytes = len(text) / float(1 << 20)
+  handle, filename = tempfile.mkstemp(suffix=".smt2")
+  os.write(handle, text)
+  os.close(handle)
+  try:
+    print "parsing %.2f MB" % megabytes
+    results = []
+    for name, f, arg in [("legacy iterators, string", _legacy_parse, text),
+                         ("tokenizer, string", lisp_parse, text),
+                         ("legacy iterators, file", _legacy_file, filename),
+                         ("tokenizer, file", lisp_file, filename)]:
+      seconds, node = timed(f, arg, ";")
+      results.append(str(node))
+      print "  %-26s %8.3fs %8.2f MB/s" % (name, seconds, megabytes/seconds)
+    if len(set(results)) != 1:
+      print "  ERROR: parsers disagree"
+  finally:
+    os.remove(filename)
+
+def bench_deep(depth=1000000):
+  """stress test: parses, transforms and serializes a term nested depth
+     levels deep, at the default recursion limit"""
+  import pysmt
+  text = "(not "*depth+"(p x)"+")"*depth
+  seconds, node = timed(LispNode, text)
+  print "  %-26s %8.3fs" % ("parse", seconds)
+  seconds, found = timed(node.find, "x")
+  print "  %-26s %8.3fs" % ("find", seconds)
+  seconds, result = timed(node.replace, "x", "((y))")
+  print "  %-26s %8.3fs" % ("replace", seconds)
+  seconds, result = timed(pysmt.remove_parens_around_tokens, [node])
+  print "  %-26s %8.3fs" % ("remove parens", seconds)
+  seconds, result = timed(str, node)
+  print "  %-26s %8.3fs" % ("serialize", seconds)
+  seconds, same = timed(node.__eq__, LispNode(result))
+  print "  %-26s %8.3fs" % ("reparse and compare", seconds)
+  if len(found) != 1 or result != text.replace("(p x)", "(p y)") or not same:
+    print "  ERROR: wrong result"
+
+class _DictNode:
+  "a LispNode as it was before __slots__: an old style object with a __dict__"
+  def __init__(self, node, parent):
+    self.parent = parent
+    self.children = []
+    self.token = node.token
+    self.is_token = node.is_token
+
+def _dict_nodes(node):
+  "returns a list of _DictNode copies of every node in node"
+  copies = [_DictNode(node, None)]
+  stack = [(node, copies[0])]
+  while stack:
+    node, copy = stack.pop()
+    for child in pylisp2._children_of(node):
+      copy.children.append(_DictNode(child, copy))
+      copies.append(copy.children[-1])
+      stack.append((child, copy.children[-1]))
+  return copies
+
+def _nodes(node):
+  "returns a list of every node in node"
+  nodes = []
+  stack = [node]
+  while stack:
+    nodes.append(stack.pop())
+    stack.extend(nodes[-1]._children or [])
+  return nodes
+
+def bench_memory(blocks=2000):
+  "bytes per node: __dict__ nodes, __slots__ nodes, and a LispArena"
+  text = smt_text(blocks)
+  node = lisp_parse(text, ";")
+  nodes = _nodes(node)
+  copies = _dict_nodes(node)
+  # tokens used to be read one character at a time into a new string each
+  dict_bytes = sum(sys.getsizeof(n) + sys.getsizeof(n.__dict__) +\
+                   sys.getsizeof(n.children) + sys.getsizeof(n.token) 
+                   for n in copies)
+  distinct_tokens = set(n.token for n in nodes if n.is_token)
+  slot_bytes = sum(sys.getsizeof(n) for n in nodes) +\
+               sum(sys.getsizeof(n._children) for n in nodes 
+                   if n._children is not None) +\
+               sum(map(sys.getsizeof, distinct_tokens))
+  arena = pylisp2.LispArena(text, ";")
+  print "%d nodes" % len(nodes)
+  for name, size in [("__dict__ nodes", dict_bytes), 
+                     ("__slots__ nodes", slot_bytes),
+                     ("LispArena", arena.nbytes())]:
+    print "  %-26s %8.1f bytes/node" % (name, size / float(len(nodes)))
+
+def bench_share(copies=300):
+  """copying one big term many times, as forall_unroll does: plain LispNode
+     copies versus copies of a view of a hash-consed LispArena"""
+  term = lisp_parse(smt_text(50), ";")
+  shared = pylisp2.LispArena(term, shared=True)
+  print "%d copies of a %d character term" % (copies, len(str(term)))
+  for name, original in [("LispNode copies", term), 
+                         ("shared views", shared.node())]:
+    seconds, nodes = timed(map, LispNode, [original]*copies)
+    print "  %-26s %8.3fs copy" % (name, seconds),
+    seconds, text = timed(lambda:"".join(map(str, nodes)))
+    print "%8.3fs serialize" % seconds,
+    seconds, found = timed(lambda:sum(len(n.find("true")) for n in nodes))
+    print "%8.3fs find" % seconds
+  print "  %-26s %8d rows, %d bytes" % ("shared arena", len(shared), 
+                                        shared.nbytes())
+
+def bench_find(blocks=2000):
+  """find with a list target (the first search caches hashes and lengths), 
+     and counting distinct subterms with nodes as dictionary keys"""
+  node = lisp_parse(smt_text(blocks), ";")
+  target = LispNode("(_ BitVec 3)")
+  for name in ["find, first", "find, cached"]:
+    seconds, found = timed(node.find, target)
+    print "  %-26s %8.3fs %8d found" % (name, seconds, len(found))
+  counts = {}
+  def count():
+    for n in _nodes(node):
+      counts[n] = counts.get(n, 0) + 1
+  seconds, result = timed(count)
+  print "  %-26s %8.3fs %8d distinct" % ("count subterms", seconds, 
+                                          len(counts))
+
+def bench_transform(blocks=(200, 800, 3200)):
+  """end to end: pysmt converting synthetic inputs with growing numbers of
+     top level declarations to QF_BV (no solver), which should take about the
+     same time per block"""
+  import pysmt
+  for n in blocks:
+    # smt_text is one big expression, for the parser; pysmt wants the forms
+    text = smt_text(n)
+    text = text[text.index("\n")+1:text.rindex(")")]
+    handle, filename = tempfile.mkstemp(suffix=".smt2")
+    os.write(handle, text)
+    os.close(handle)
+    output = filename+".qf_bv"
+    try:
+      seconds, result = timed(pysmt.main, [filename, "-q", output, "-s", 
+                                           "NONE"])
+      print "  %-26s %8.3fs %8.3f ms/block %10d bytes out" % (
+          "%d blocks" % n, seconds, 1000*seconds/n, os.path.getsize(output))
+    finally:
+      os.remove(filename)
+      if os.path.exists(output):
+        os.remove(output)
+
+def bench_cache(blocks=800):
+  """pysmt -cache: converting with an empty cache, then again with nothing
+     changed, then again after a one line edit, against no cache at all"""
+  import pysmt
+  text = smt_text(blocks)
+  text = text[text.index("\n")+1:text.rindex(")")]
+  edited = text.replace("(g5 x true)", "(g5 x false)", 1)
+  directory = tempfile.mkdtemp()
+  cache = os.path.join(directory, "cache")
+  filename = os.path.join(directory, "input.smt2")
+  output = os.path.join(directory, "output.smt2")
+  try:
+    results = []
+    for name, content, args in [("no cache", edited, []),
+                                ("empty cache", text, ["-cache", cache]),
+                                ("unchanged", text, ["-cache", cache]),
+                                ("one line edited", edited, ["-cache", cache])]:
+      open(filename, "w").write(content)
+      seconds, result = timed(pysmt.main, [filename, "-q", output, "-s", 
+                                           "NONE"] + args)
+      results.append(open(output).read())
+      print "  %-26s %8.3fs" % (name, seconds)
+    if results[0] != results[-1]:
+      print "  ERROR: different output"
+  finally:
+    shutil.rmtree(directory)
+
+def table_text(arg_bits, sort_bits):
+  """returns the text of an smt2 file declaring a function with arg_bits of
+     input and sort_bits of output, whose values must differ at adjacent 
+     inputs"""
+  one = "#b"+"0"*(arg_bits-1)+"1"
+  return "(declare-fun t ((_ BitVec %d)) (_ BitVec %d))\n" % (arg_bits, 
+      sort_bits) + "(assert (forall ((x (_ BitVec %d))) " % arg_bits +\
+      "(not (= (t x) (t (bvadd x %s))))))\n(check-sat)\n(get-model)\n" % one
+
+def bench_tables(shapes=((4, 4), (6, 3), (8, 8), (10, 2)), solver="z3"):
+  """pysmt -tables: the size of the output with each lookup table encoding, 
+     and how long solver takes on it (if it is installed), for functions of
+     (input bits, output bits) shapes"""
+  from distutils.spawn import find_executable
+  import pysmt
+  if find_executable(solver) == None:
+    print "  (%s not found: sizes only)" % solver
+    solver = None
+  directory = tempfile.mkdtemp()
+  filename = os.path.join(directory, "input.smt2")
+  output = os.path.join(directory, "output.smt2")
+  try:
+    for arg_bits, sort_bits in shapes:
+      open(filename, "w").write(table_text(arg_bits, sort_bits))
+      print "  %d bits in, %d out (auto: %s)" % (arg_bits, sort_bits,
+          pysmt.choose_table_encoding(arg_bits, sort_bits, 1))
+      for encoding in pysmt.TABLE_ENCODINGS:
+        seconds, result = timed(pysmt.main, [filename, "-q", output, "-s", 
+                                             "NONE", "-tables", encoding])
+        print "    %-24s %8.3fs %10d bytes out" % (encoding, seconds, 
+                                                   os.path.getsize(output)),
+        if solver != None:
+          seconds, result = timed(os.system, solver+" "+output+" > "+
+                                  os.path.join(directory, "model"))
+          print "%8.3fs %s" % (seconds, solver),
+        print
+  finally:
+    shutil.rmtree(directory)
+
+def _bench_options(cases, options, solver):
+  """runs pysmt on each of cases, (name, input text, arguments), with each
+     of options (lists of more arguments), writing how long that took, the
+     size of the output, and how long solver takes on it (if it is 
+     installed)"""
+  from distutils.spawn import find_executable
+  import pysmt
+  if find_executable(solver) == None:
+    print "  (%s not found: sizes only)" % solver
+    solver = None
+  directory = tempfile.mkdtemp()
+  filename = os.path.join(directory, "input.smt2")
+  output = os.path.join(directory, "output.smt2")
+  try:
+    for name, content, args in cases:
+      open(filename, "w").write(content)
+      print "  "+name
+      for option in options:
+        seconds, result = timed(pysmt.main, [filename, "-q", output, "-s", 
+                                             "NONE"] + args + option)
+        print "    %-24s %8.3fs %10d bytes out" % (" ".join(option) or 
+            "plain", seconds, os.path.getsize(output)),
+        if solver != None:
+          seconds, result = timed(os.system, solver+" "+output+" > "+
+                                  os.path.join(directory, "model"))
+          print "%8.3fs %s" % (seconds, solver),
+        print
+  finally:
+    shutil.rmtree(directory)
+
+def _shrink_cases(blocks):
+  "returns the inputs bench_cse and bench_simplify run on (see _bench_options)"
+  text = smt_text(blocks)
+  return [("%d blocks" % blocks, text[text.index("\n")+1:text.rindex(")")], 
+           []), ("8 bits in, 8 out, ite", table_text(8, 8), ["-tables", "ite"])]
+
+def bench_cse(blocks=200, solver="z3"):
+  """pysmt -cse: the size of the output with and without common subterms 
+     named, and how long solver takes on it (if it is installed)"""
+  _bench_options(_shrink_cases(blocks), [[], ["-cse"]], solver)
+
+def bench_simplify(blocks=200, solver="z3"):
+  """pysmt -simplify: the size of the output with and without simplifying 
+     (and with -cse after it), and how long solver takes on it (if it is 
+     installed)"""
+  _bench_options(_shrink_cases(blocks), 
+                 [[], ["-simplify"], ["-simplify", "-cse"]], solver)
+
+# a stand in for a solver, for bench_session: run on a file, or reading
+# commands from its standard input (with no file), it says sat when at 
+# least three quarters of the bits of thresholds-bv-version-lookup-table are
+# 1, and unsat otherwise, after -delay seconds (default 0). Asserting it is
+# one of several values, it says sat if any of them would be. Assuming 
+# thresholds-selector literals (see pysmt.local_max_thresholds_assume), the
+# table is all 1s but for the bits they say are 0, and the unsat 
+# assumptions are those. With -needed, it is also unsat when any even bit is
+# 0, and then that bit is the unsat assumption. When thresholds-fake-slack
+# is declared and not fixed at #b0 (defined, or asserted equal to it), half
+# the bits being 1 is enough. Values asked for with get-value are 0. As z3
+# does, it only answers get-value, get-model and get-unsat-assumptions right
+# after a check, before anything else is asserted, declared or scoped.
+FAKE_SOLVER = r"""
+import re, sys, time
+VALUE = r"thresholds-bv-version-lookup-table\s*"+\
+        r"(?:\(\)\s*\(_ BitVec \d+\)\s*)?(#b[01]+)"
+args = sys.argv[1:]
+delay = 0.0
+if args[:1] == ["-delay"]:
+  delay = float(args[1])
+  args = args[2:]
+needed = False
+if args[:1] == ["-needed"]:
+  needed = True
+  args = args[1:]
+SLACK = "thresholds-fake-slack"
+FIXED = r"\((?:define-fun "+SLACK+r" \(\) \(_ BitVec 1\)|assert \(= "+\
+        SLACK+r") #b0\)"
+slack = False
+def possible(value):
+  if needed and [i for i in range(0, len(value)-2, 2) if value[-1-i] == "0"]:
+    return False
+  return (2 if slack else 4)*value.count("1") >= \
+         (1 if slack else 3)*(len(value)-2)
+def answer(values):
+  time.sleep(delay)
+  return "sat" if [value for value in values if possible(value)] else "unsat"
+if args:
+  text = open(args[0]).read()
+  values = re.findall(VALUE, text)[-1:]
+  slack = "(declare-fun "+SLACK in text and not re.search(FIXED, text)
+  print answer(values)
+  print "(model )"
+  sys.exit(0)
+values = [None]
+width = 0
+table = None
+zeros = []
+sorts = {}
+checked = False
+for line in iter(sys.stdin.readline, ""):
+  if line.startswith("(get-") and not checked:
+    print '(error "model is not available")'
+    sys.stdout.flush()
+    continue
+  if re.match(r"\((assert|push|pop|declare|define)", line):
+    checked = False
+  declared = re.match(r"\(declare-fun thresholds-bv-version-lookup-table "+
+                      r"\(\) \(_ BitVec (\d+)\)\)", line)
+  constant = re.match(r"\(declare-fun (\S+) \(\) (Bool|\(_ BitVec (\d+)\))", 
+                      line)
+  if constant:
+    sorts[constant.group(1)] = int(constant.group(3) or 0)
+    if constant.group(1) == SLACK:
+      slack = True
+  if re.match(FIXED, line):
+    slack = False
+  if declared:
+    width = int(declared.group(1))
+  elif line.startswith("(push"):
+    values.append(values[-1])
+  elif line.startswith("(pop"):
+    values.pop()
+  elif line.startswith("(assert (= thresholds-bv-version-lookup-table") or \
+       line.startswith("(assert (or (= thresholds-bv-version-lookup-table"):
+    values[-1] = re.findall(VALUE, line)
+  elif line.startswith("(check-sat-assuming"):
+    bits = ["1"]*width
+    for negated, i in re.findall(r"(\(not )?thresholds-selector-(\d+)", line):
+      bits[width-1-int(i)] = "0" if negated else "1"
+    table = "#b"+"".join(bits)
+    zeros = re.findall(r"\(not thresholds-selector-(\d+)\)", line)
+    if needed:
+      zeros = [i for i in zeros if int(i) % 2 == 0][:1] or zeros
+    print answer([table])
+    checked = True
+  elif line.startswith("(check-sat"):
+    table = (values[-1] or ["#b"+"1"*width])[-1]
+    print answer(values[-1]) if values[-1] else "sat"
+    checked = True
+  elif line.startswith("(get-value"):
+    print "("+" ".join("(%s %s)" % (name, table if name == 
+        "thresholds-bv-version-lookup-table" else "#b"+"0"*sorts[name] if 
+        sorts.get(name) else "false") for name in 
+        re.findall(r"[^\s()]+", line[len("(get-value"):]))+")"
+  elif line.startswith("(get-unsat-assumptions"):
+    print "("+" ".join("(not thresholds-selector-%s)" % i for i in zeros)+")"
+  elif line.startswith("(get-model"):
+    print "(model (define-fun thresholds-bv-version-lookup-table () "+\
+          "(_ BitVec %d) %s))" % (width, table)
+  elif line.startswith("(exit"):
+    break
+  sys.stdout.flush()
+"""
+
+def _bench_searches(searches, blocks, bits, ones, slack=False):
+  """runs each of searches, (name, function of a document, a model and the
+     command line of the fake solver returning (the table it found, how 
+     many checks that took)), on the QF_BV of blocks blocks with a table of
+     bits bits, the first ones of them 1 (and if slack, 
+     thresholds-fake-slack, which the model makes #b0), writing how long 
+     each took and how many checks. Every search must find the table the
+     first one does."""
+  import pysmt
+  text = smt_text(blocks)
+  directory = tempfile.mkdtemp()
+  filename = os.path.join(directory, "input.smt2")
+  solver = os.path.join(directory, "solver.py")
+  open(filename, "w").write(text[text.index("\n")+1:text.rindex(")")]+
+      "(declare-fun thresholds-bv-version-lookup-table () (_ BitVec %d))\n" %
+      bits+("(declare-fun thresholds-fake-slack () (_ BitVec 1))\n" if slack
+      else "")+"(check-sat)\n(get-model)\n")
+  open(solver, "w").write(FAKE_SOLVER)
+  command = sys.executable+" "+solver
+  model = "(model (define-fun thresholds-bv-version-lookup-table () "+\
+          "(_ BitVec %d) #b%s)" % (bits, "1"*ones+"0"*(bits-ones))+\
+          (" (define-fun thresholds-fake-slack () (_ BitVec 1) #b0)" if 
+           slack else "")+")"
+  stdout = sys.stdout
+  try:
+    results = []
+    for name, search in searches:
+      d = pysmt.LispDocument(pysmt.lisp_file_forms(filename, comment=";"))
+      pysmt.qf_bv_passes().run(d)
+      sys.stdout = open(os.devnull, "w")
+      try:
+        seconds, (result, checks) = timed(search, d, LispNode(model), 
+                                          command)
+      finally:
+        sys.stdout = stdout
+      results.append(result)
+      print "  %-26s %8.3fs %6d checks" % (name, seconds, checks)
+      assert result == results[0], "%s found %s, but %s found %s" % (name, 
+          result, searches[0][0], results[0])
+  finally:
+    shutil.rmtree(directory)
+
+def _per_bit(document, model, command):
+  "local_max_thresholds_iterative, counting the bits it tries"
+  import pysmt
+  from cStringIO import StringIO
+  stdout = sys.stdout
+  sys.stdout = StringIO()
+  try:
+    table = pysmt.local_max_thresholds_iterative(document, model, command)
+  finally:
+    printed, sys.stdout = sys.stdout.getvalue(), stdout
+  return table, len([line for line in printed.split() if line.isdigit()])
+
+def _in_session(search, *args):
+  """returns a function running search on a pysolver.SolverSession (with 
+     args after it), for _bench_searches"""
+  import pysmt
+  def run(document, model, command):
+    session = pysmt.SolverSession(command)
+    try:
+      return search(document, model, session, *args), session.checks
+    finally:
+      session.close()
+  return run
+
+def _slow(search, delay):
+  "returns search, run with the fake solver taking delay seconds a check"
+  return lambda document, model, command:search(document, model, 
+                                                command+" -delay "+str(delay))
+
+def bench_session(blocks=50, bits=64, delay=0.01, jobs=4):
+  """pysmt -iterative-optimize on a table of bits bits, all 1, with the 
+     QF_BV of blocks blocks: running a solver on a file for each bit tried, 
+     against one pysolver.SolverSession (with a fake solver, so that it is 
+     the cost of starting it and sending it the QF_BV which is measured),
+     then, with the fake solver taking delay seconds a check, one session
+     against a pysolver.SolverPool of jobs sessions"""
+  import pysmt
+  def in_pool(document, model, command):
+    pool = pysmt.SolverPool(command, jobs)
+    try:
+      return (pysmt.local_max_thresholds_parallel(document, model, pool), 
+              sum(pool.checks))
+    finally:
+      pool.close()
+  session = _in_session(pysmt.local_max_thresholds_session)
+  _bench_searches([("solver per bit", _per_bit), ("session", session),
+                   ("session, slow solver", _slow(session, delay)),
+                   ("%d sessions, slow solver" % jobs, _slow(in_pool, delay))],
+                  blocks, bits, bits)
+
+def bench_bisect(blocks=50, bits=256, spare=4, block=16, delay=0.01):
+  """pysmt -bisect: the checks and time local_max_thresholds_iterative (a 
+     solver per bit), local_max_thresholds_session and 
+     local_max_thresholds_bisect take with a table of bits bits, spare of 
+     which can be flipped, then the last two with the fake solver taking 
+     delay seconds a check (see bench_session)"""
+  import pysmt
+  session = _in_session(pysmt.local_max_thresholds_session)
+  bisect = _in_session(pysmt.local_max_thresholds_bisect, block)
+  _bench_searches([("solver per bit", _per_bit), ("session", session),
+                   ("bisect %d" % block, bisect),
+                   ("session, slow solver", _slow(session, delay)),
+                   ("bisect %d, slow solver" % block, _slow(bisect, delay))],
+                  blocks, bits, (3*bits+3)/4+spare)
+
+def bench_assume(blocks=50, bits=128, delay=0.01):
+  """pysmt -localmax with -session: the checks and time 
+     local_max_thresholds_assume takes with a table of bits bits, all 1, of
+     which only the odd ones can be flipped (the fake solver's -needed), 
+     against local_max_thresholds_iterative (a solver per bit) and 
+     local_max_thresholds_session starting from the same table, then the 
+     last two with the fake solver taking delay seconds a check (see 
+     bench_session). thresholds-fake-slack is declared, so that tables 
+     found without keeping it as the first model has it would differ."""
+  import pysmt
+  def assume(document, model, command):
+    session = pysmt.SolverSession(command)
+    try:
+      return pysmt.local_max_thresholds_assume(document, session), \
+             session.checks
+    finally:
+      session.close()
+  session = _in_session(pysmt.local_max_thresholds_session)
+  needed = lambda search:lambda document, model, command:search(document, 
+      model, command+" -needed")
+  _bench_searches([("solver per bit", needed(_per_bit)),
+                   ("session", needed(session)), 
+                   ("selectors", needed(assume)),
+                   ("session, slow solver", _slow(needed(session), delay)),
+                   ("selectors, slow solver", _slow(needed(assume), delay))],
+                  blocks, bits, bits, slack=True)
+
+def _analysis_model(n):
+  """returns the text of a model giving values to the thresholds-... Bools
+     pysmt.append_analysis declares for n"""
+  import pysmt
+  lines = ["(model"]
+  for t in ['Decision', 'Change', 'Availability', 'Truth']:
+    for i in range(n):
+      for b in pysmt.sbinaries(n):
+        lines.append("  (define-fun thresholds-%s-%d-%s () Bool\n    %s)" % 
+                     (t, i, b, "true" if (i+len(b)+b.count("1")) % 3 else 
+                               "false"))
+  return "\n".join(lines)+")"
+
+def bench_model(sizes=(4, 6, 8), digits=1 << 16):
+  """reading the Bools perform_analysis draws from a model, for n of sizes:
+     parsing it and finding each one, against pysmt.read_model; then 
+     hex_to_binary on digits hex digits, one at a time against all at once"""
+  import pysmt
+  def found(text, n):
+    model = LispNode(text)
+    return [possibles[0].parent.children[4] == "false" for possibles in 
+            [model.find("thresholds-"+t+"-"+str(i)+"-"+b) for t in 
+             ['Decision', 'Change', 'Availability', 'Truth'] 
+             for i in range(n) for b in pysmt.sbinaries(n)]]
+  def read(text, n):
+    values = pysmt.read_model(text)
+    return [values["thresholds-"+t+"-"+str(i)+"-"+b] is False for t in 
+            ['Decision', 'Change', 'Availability', 'Truth'] 
+            for i in range(n) for b in pysmt.sbinaries(n)]
+  for n in sizes:
+    text = _analysis_model(n)
+    results = []
+    for name, f in [("parse and find", found), ("read_model", read)]:
+      seconds, result = timed(f, text, n)
+      results.append(result)
+      print "  %-26s %8.3fs" % ("n=%d, %s" % (n, name), seconds)
+    if results[0] != results[1]:
+      print "  ERROR: different values"
+  h = "".join("0123456789abcdef"[i % 16] for i in range(digits))
+  old = lambda h:"".join(map(lambda x:pysmt.binaries(4)[int(x,16)], h))
+  results = []
+  for name, f in [("hex digit at a time", old), 
+                  ("hex_to_binary", pysmt.hex_to_binary)]:
+    seconds, result = timed(f, h)
+    results.append(result)
+    print "  %-26s %8.3fs" % (name, seconds)
+  if results[0] != results[1]:
+    print "  ERROR: different bits"
+
+def bench_solver_cache(blocks=50, delay=0.5):
+  """pysmt -solver-cache: solving with an empty cache, then the same input 
+     again, then with the inputs of its define-funs renamed, with a fake 
+     solver taking delay seconds (see bench_session)"""
+  import re
+  import pysmt
+  text = smt_text(blocks)
+  text = text[text.index("\n")+1:text.rindex(")")]
+  renamed = "\n".join(re.sub(r"\bb\b", "q", re.sub(r"\bx\b", "p", line)) 
+                      if line.startswith("(define-fun") else line 
+                      for line in text.split("\n"))
+  directory = tempfile.mkdtemp()
+  cache = os.path.join(directory, "cache")
+  filename = os.path.join(directory, "input.smt2")
+  output = os.path.join(directory, "output.smt2")
+  model = os.path.join(directory, "model")
+  solver = os.path.join(directory, "solver.py")
+  open(solver, "w").write(FAKE_SOLVER)
+  command = sys.executable+" "+solver+" -delay "+str(delay)
+  stdout = sys.stdout
+  try:
+    results = []
+    for name, content in [("empty cache", text), ("unchanged", text),
+                          ("inputs renamed", renamed)]:
+      open(filename, "w").write(content)
+      sys.stdout = open(os.devnull, "w")
+      try:
+        seconds, result = timed(pysmt.main, [filename, "-q", output, "-s", 
+            command, "-m", model, "-solver-cache", cache])
+      finally:
+        sys.stdout = stdout
+      results.append(open(model).read())
+      print "  %-26s %8.3fs" % (name, seconds)
+    if len(set(results)) != 1:
+      print "  ERROR: different answers"
+  finally:
+    shutil.rmtree(directory)
+
+def bench_portfolio(blocks=50, delays=(0.5, 0.1, 1.0)):
+  """pysmt -portfolio: solving with fake solvers taking each of delays 
+     seconds, one at a time, then with all of them raced at once"""
+  import pysmt
+  from pysolver import Portfolio
+  directory = tempfile.mkdtemp()
+  filename = os.path.join(directory, "input.smt2")
+  model = os.path.join(directory, "model")
+  solver = os.path.join(directory, "solver.py")
+  open(filename, "w").write(smt_text(blocks))
+  open(solver, "w").write(FAKE_SOLVER)
+  commands = [sys.executable+" "+solver+" -delay "+str(delay) 
+              for delay in delays]
+  try:
+    results = []
+    for name, command in ([("delay "+str(delay), command) 
+                           for delay, command in zip(delays, commands)]+
+                          [("portfolio", Portfolio(commands))]):
+      seconds, result = timed(pysmt.run_solver, command, filename, model)
+      results.append(open(model).read())
+      print "  %-26s %8.3fs" % (name, seconds)
+    if len(set(results)) != 1:
+      print "  ERROR: different answers"
+  finally:
+    shutil.rmtree(directory)
+
+def bench_write(blocks=20000):
+  """serializing to a file: building the whole string first versus 
+     LispNode.write, compact and pretty"""
+  node = lisp_parse(smt_text(blocks), ";")
+  handle, filename = tempfile.mkstemp(suffix=".smt2")
+  os.close(handle)
+  def to_file(write):
+    f = open(filename, "w")
+    try:
+      write(f)
+    finally:
+      f.close()
+    return open(filename).read()
+  try:
+    for name, whole, streamed in [
+        ("compact", lambda f:f.write(str(node)), lambda f:node.write(f)),
+        ("pretty", lambda f:f.write(node.pretty_print()), 
+                   lambda f:node.write(f, pretty=True))]:
+      seconds, expected = timed(to_file, whole)
+      print "  %-26s %8.3fs %8.2f MB" % (name+", whole string", seconds,
+                                         len(expected) / float(1 << 20))
+      seconds, text = timed(to_file, streamed)
+      print "  %-26s %8.3fs" % (name+", streamed", seconds)
+      if text != expected:
+        print "  ERROR: different output"
+  finally:
+    os.remove(filename)
+
+def bench_emit(blocks=200):
+  """writing a large unrolled QF_BV file: the old str, strip and reparse of
+     every form versus pysmt.write_qf_bv straight from the tree"""
+  import pysmt
+  text = smt_text(blocks)
+  text = text[text.index("\n")+1:text.rindex(")")]
+  handle, filename = tempfile.mkstemp(suffix=".smt2")
+  os.write(handle, text)
+  os.close(handle)
+  unrolled = filename+".qf_bv"
+  def reparsed(all_lines_list, f):
+    for x in map(lambda x:str(x).strip(), all_lines_list):
+      if len(x) > 0:
+        if x[0] == "(":
+          x = LispNode(x).pretty_print()
+        f.write(x)
+        f.write("\n")
+  try:
+    pysmt.main([filename, "-q", unrolled, "-s", "NONE"])
+    all_lines_list, lispnode_list = pysmt.lisp_file_comments(unrolled, ";")
+    results = []
+    for name, write in [("str and reparse", reparsed), 
+                        ("write_qf_bv", pysmt.write_qf_bv)]:
+      f = open(filename, "w")
+      seconds, result = timed(write, all_lines_list, f)
+      f.close()
+      results.append(open(filename).read())
+      print "  %-26s %8.3fs %8d bytes" % (name, seconds, len(results[-1]))
+    if results[0] != results[1]:
+      print "  ERROR: different output"
+  finally:
+    for name in [filename, unrolled]:
+      if os.path.exists(name):
+        os.remove(name)
+
+def bench_load(blocks=(1000, 4000, 16000)):
+  """pysmt.lisp_file_comments reading files of growing size, which should
+     take time linear in the size"""
+  import pysmt
+  for n in blocks:
+    text = smt_text(n)
+    text = text[text.index("\n")+1:text.rindex(")")]
+    handle, filename = tempfile.mkstemp(suffix=".smt2")
+    os.write(handle, text)
+    os.close(handle)
+    try:
+      megabytes = len(text) / float(1 << 20)
+      seconds, result = timed(pysmt.lisp_file_comments, filename, ";")
+      print "  %-26s %8.3fs %8.2f MB/s" % ("%.2f MB" % megabytes, seconds,
+                                           megabytes / seconds)
+    finally:
+      os.remove(filename)
+
+BENCHMARKS = [("parse", bench_parse), ("deep", bench_deep), 
+              ("memory", bench_memory), ("share", bench_share),
+              ("find", bench_find), ("transform", bench_transform),
+              ("cache", bench_cache), ("tables", bench_tables),
+              ("cse", bench_cse), ("simplify", bench_simplify),
+              ("session", bench_session), ("bisect", bench_bisect),
+              ("assume", bench_assume), ("model", bench_model),
+              ("solver-cache", bench_solver_cache), 
+              ("portfolio", bench_portfolio), ("write", bench_write),
+              ("emit", bench_emit), ("load", bench_load)]
+
+def main(args):
+  names = args or [name for name, f in BENCHMARKS]
+  for name, f in BENCHMARKS:
+    if name in names:
+      print "== "+name
+      f()
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
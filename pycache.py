@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# A directory of cached strings, named by hashes of what they were made from,
+# kept under a size limit by removing the least recently used.
+import os
+import sys
+import hashlib
+
+def cache_key(*parts):
+  "returns a hex digest naming the strings parts, in order"
+  h = hashlib.sha1()
+  for part in parts:
+    h.update(str(len(part))+":")
+    h.update(part)
+  return h.hexdigest()
+
+class DiskCache(object):
+  """
+  Strings kept in the files of a directory, one per key (see cache_key):
+  .directory: where the files are (made if need be)
+  .max_bytes: how big the files may get, all together, before evict removes
+              the least recently used ones
+  .hits, .misses, .evicted: counts of what get and evict have done so far
+  A file's modification time is when it was last put or got.
+  """
+  def __init__(self, directory, max_bytes=1 << 28):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.evicted = 0
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def _path(self, key):
+    return os.path.join(self.directory, key)
+
+  def get(self, key):
+    "returns the string kept under key, or None if there isn't one"
+    path = self._path(key)
+    try:
+      f = open(path, "rb")
+      try:
+        text = f.read()
+      finally:
+        f.close()
+      os.utime(path, None)
+    except (IOError, OSError):
+      self.misses += 1
+      return None
+    self.hits += 1
+    return text
+
+  def put(self, key, text):
+    "keeps the string text under key"
+    # written under another name first, so no one reads half a file
+    temporary = self._path("."+key+"."+str(os.getpid()))
+    f = open(temporary, "wb")
+    try:
+      f.write(text)
+    finally:
+      f.close()
+    os.rename(temporary, self._path(key))
+
+  def evict(self):
+    "removes the least recently used files until the rest fit in max_bytes"
+    entries = []
+    for name in os.listdir(self.directory):
+      if name.startswith("."):
+        continue
+      try:
+        stat = os.stat(self._path(name))
+      except OSError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, name))
+    entries.sort()
+    total = sum(size for mtime, size, name in entries)
+    for mtime, size, name in entries:
+      if total <= self.max_bytes:
+        break
+      try:
+        os.remove(self._path(name))
+      except OSError:
+        continue
+      total -= size
+      self.evicted += 1
+
+  def report(self, f=None):
+    """writes the hits (and what fraction of the gets they were), misses and 
+       evictions so far to the file object f"""
+    if f == None:
+      f = sys.stdout
+    gets = self.hits + self.misses
+    f.write("cache %s: %d hits (%d%%), %d misses, %d evicted\n" % (
+            self.directory, self.hits, 100*self.hits/gets if gets else 0, 
+            self.misses, self.evicted))
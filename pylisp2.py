@@ -2,8 +2,17 @@
 # a useful library for parsing lisp
 # by Isaac Sheff, March 31, 2014
 
+import gc
+import itertools
+import re
+import sys
+from array import array
 from Queue import Queue
 
+# how many characters to read from a file at a time when tokenizing
+_BLOCK_SIZE = 1 << 16
+# how many of the strings making up a node's text are written at once
+_BLOCK_PIECES = 1 << 12
 
 
 
@@ -66,89 +75,378 @@ def _space_buffered_file_iter(filename):
   "iterates through the file one character at a time, spaces inserted around ()"
   return _SpaceBufferedIterator(_file_iter(filename))
 
-class _PushBackIterator:
-  """just like the iterator inside, but with a new value on top of the stack
-     to be iterated"""
-  def __init__(self, value, iterator):
-    self.value = value
-    self.iterator = iter(iterator)
-    self.used_value = False
-  def next(self):
-    if self.used_value:
-      return self.iterator.next()
-    self.used_value = True
-    return self.value
-  def __iter__(self):
-    return self
-
 def _lisp_node_from_iterator(iterator):
   """given an iterator, this will make a lisp node reading the iterator as a 
      string. DANGER: this requires spaces around all parentheses. Use
-     _SpaceBufferedIterator to make this happen."""
+     _SpaceBufferedIterator to make this happen.
+     Nesting is tracked with a stack of the child lists being read, so depth
+     is bounded only by memory."""
   iterator = iter(iterator)
-  children = []
+  stack = []
   try:
-    c = str(iterator.next())
-    # if there are spaces at the beginning, just ignore them
-    while c.isspace():
-      c = str(iterator.next())
-    # something has gone wrong if we encounter a ) at the beginning
-    if c == ")":
-      raise UnmatchedParenthesesException("unexpected )")
-    # this is a token, so just read in characters until you get to a space
-    if c != "(":
-      token = ""
-      while not c.isspace():
-        token += c
-        try: # or a stop, if you reach stop, that's the end of the token too
-          c = str(iterator.next())
-        except StopIteration:
-          c = " "
-      return LispNode(token=token, is_token=True, parseString=None, parent=None,
-                      children=None)
-    # otherwise, read in children using recursion, eating space or whatever in
-    # between. Note that you have to look ahead to see if the next thing is a ),
-    # which requires using a _PushBackIterator so the recursive call's iterator
-    # can see the character you peaked ahead at.
-    c = str(iterator.next())
-    while c.isspace():
+    while True:
       c = str(iterator.next())
-    while c != ")":
-      children.append(_lisp_node_from_iterator(_PushBackIterator(c,iterator)))
-      c = str(iterator.next())
-      while c.isspace():
-        c = str(iterator.next())
-    a = LispNode(parseString=None, parent=None, children=children,
-                token=None, is_token=False)
-    for child in children:
-      child.parent = a
-    return a
+      # ignore spaces between things
+      if c.isspace():
+        continue
+      if c == "(":
+        stack.append([])
+        continue
+      if c == ")":
+        # something has gone wrong if we encounter a ) outside of any (
+        if not stack:
+          raise UnmatchedParenthesesException("unexpected )")
+        node = LispNode(children=stack.pop())
+      else:
+        # this is a token, so just read in characters until you get to a space
+        token = ""
+        while not c.isspace():
+          token += c
+          try: # or a stop, if you reach stop, that's the end of the token too
+            c = str(iterator.next())
+          except StopIteration:
+            c = " "
+        node = LispNode(token=token, is_token=True)
+      if not stack:
+        return node
+      stack[-1].append(node)
   except StopIteration as s:
-    raise UnmatchedParenthesesException(str(s) +" after "+str(map(str, children)))
-
-class _LispNodeIterator:
-  "iterates through this LispNode (MUST NOT BE A TOKEN NODE) char by char"
-  def __init__(self, lisp_node):
-    self.child_iterator = iter(lisp_node.children)
-    try:
-      self.current_iterator = _PushBackIterator("(",self.child_iterator.next())
-    except StopIteration: #this node has no children.
-      self.current_iterator = iter("(")
-  def __iter__(self):
-    return self
-  def next(self):
-    try:
-      try:
-        return self.current_iterator.next()
-      except StopIteration:
-        self.current_iterator = iter(self.child_iterator.next())
-        return " "
-    except StopIteration:
-      self.next = self.current_iterator.next
-      self.__iter__ = self.current_iterator.__iter__
-      return ")"
+    raise UnmatchedParenthesesException(str(s) +" after "+\
+                                        str(map(str, stack and stack[-1])))
+
+def _chunks(content):
+  """yields content as a series of strings. content may be a string, a file
+     (read _BLOCK_SIZE characters at a time), a LispNode, or any other
+     iterable of strings (such as characters), which are gathered into
+     blocks of roughly _BLOCK_SIZE characters."""
+  if isinstance(content, basestring):
+    yield str(content)
+  elif isinstance(content, LispNode):
+    yield str(content)
+  elif hasattr(content, "read"):
+    block = content.read(_BLOCK_SIZE)
+    while block:
+      yield block
+      block = content.read(_BLOCK_SIZE)
+  else:
+    block = []
+    size = 0
+    for s in content:
+      block.append(str(s))
+      size += len(block[-1])
+      if size >= _BLOCK_SIZE:
+        yield "".join(block)
+        block = []
+        size = 0
+    yield "".join(block)
+
+_token_regexes = {}
+
+def _token_regex(comment):
+  """returns the compiled regex matching a paren, a token, or a comment
+     running from comment to the end of the line (None means no comments)"""
+  if comment not in _token_regexes:
+    if not comment:
+      pattern = r"[()]|[^\s()]+"
+    elif len(comment) == 1:
+      c = re.escape(comment)
+      pattern = r"[()]|"+c+r"[^\n\r]*|[^\s()"+c+"]+"
+    else:
+      c = re.escape(comment)
+      pattern = r"[()]|"+c+r"[^\n\r]*|(?:(?!"+c+r")[^\s()])+"
+    _token_regexes[comment] = re.compile(pattern)
+  return _token_regexes[comment]
+
+def _tokenize(content, comment=None):
+  """yields the parens and tokens of content (see _chunks), skipping
+     whitespace and anything on a line after comment (None means no comments).
+     Blocks are scanned with a single compiled regex; a token (or comment)
+     touching the end of a block is carried over to the next one."""
+  finditer = _token_regex(comment).finditer
+  carry = ""
+  for chunk in _chunks(content):
+    if carry:
+      chunk = carry + chunk
+      carry = ""
+    end = len(chunk)
+    for m in finditer(chunk):
+      if m.end() == end:
+        carry = m.group()
+        break
+      token = m.group()
+      if not (comment and token.startswith(comment)):
+        yield token
+  if carry and not (comment and carry.startswith(comment)):
+    yield carry
+
+def _new_node(token, is_token, children):
+  """returns a new parentless LispNode, without __init__'s checks. children is
+     None or a _Children list with no owner (whose parents aren't set)"""
+  node = LispNode.__new__(LispNode)
+  node.parent = None
+  node._token = token
+  node._is_token = is_token
+  node._arena = None
+  node._row = 0
+  node._hash = None
+  node._width = None
+  node._index = None
+  node._children = children
+  if children is not None:
+    children.owner = node
+  return node
+
+def _lisp_node_from_tokens(tokens):
+  """given an iterator of tokens (see _tokenize), builds a LispNode from the
+     first complete expression, using a stack of the child lists being read
+     rather than recursion."""
+  # every node points to its parent, so the cyclic garbage collector would
+  # otherwise keep rescanning the growing tree while we build it
+  gc_was_enabled = gc.isenabled()
+  gc.disable()
+  try:
+    stack = []
+    append = list.append # without telling anyone: there's no owner yet
+    for token in tokens:
+      if token == "(":
+        stack.append(_Children())
+        continue
+      if token == ")":
+        if not stack:
+          raise UnmatchedParenthesesException("unexpected )")
+        node = _new_node("", False, stack.pop())
+        for child in node._children:
+          child.parent = node
+      else:
+        node = _new_node(intern(token), True, None)
+      if not stack:
+        return node
+      append(stack[-1], node)
+    if stack:
+      raise UnmatchedParenthesesException("end of input after "+\
+                                          str(map(str, stack[-1])))
+    raise UnmatchedParenthesesException("end of input")
+  finally:
+    if gc_was_enabled:
+      gc.enable()
+
+def _unblanked(children):
+  """returns children without the blank tokens (tokens whose token is ""),
+     which the text of a node leaves out"""
+  for child in children:
+    if child._is_token and not child._token:
+      return [c for c in children if c._token or not c._is_token]
+  return children
+
+def _strings(node):
+  """yields strings which, joined together, are the (not exactly pretty) lisp
+     version of node. Uses an explicit stack rather than recursion."""
+  stack = [node]
+  while stack:
+    node = stack.pop()
+    if not isinstance(node, LispNode):
+      yield node
+    elif node._is_token:
+      yield node._token
+    elif _is_view(node):
+      for string in node._arena._strings(node._row):
+        yield string
+    elif not node.children:
+      yield "()"
+    else:
+      children = _unblanked(node.children)
+      if not children:
+        yield "()"
+        continue
+      yield "("
+      stack.append(")")
+      for i in range(len(children)-1, 0, -1):
+        stack.append(children[i])
+        stack.append(" ")
+      stack.append(children[0])
+
+def _pretty_strings(node, max_width, min_width):
+  """yields strings which, joined together, are node.pretty_print(max_width,
+     min_width). Every width is worked out once, bottom up, and cached."""
+  # each entry is a node to print with its max_width and indentation, or a
+  # string to print as is
+  stack = [(node, max_width, "")]
+  while stack:
+    entry = stack.pop()
+    if not isinstance(entry, tuple):
+      yield entry
+      continue
+    node, max_width, indent = entry
+    if max_width < min_width:
+      max_width = min_width
+    children = _unblanked(_kids(node))
+    if node._is_token or (not children) or\
+       _hash_and_width(node)[1] <= max_width:
+      text = "".join(_strings(node))
+      if indent and "\n" in text:
+        text = text.replace("\n", "\n"+indent)
+      yield text
+    else:
+      yield "("
+      stack.append("\n"+indent+")")
+      for child in children[:0:-1]:
+        stack.append((child, max_width-2, indent+"  "))
+        stack.append("\n"+indent+"  ")
+      stack.append((children[0], max_width-1, indent))
+
+def _write_strings(strings, f):
+  "writes an iterator of strings to the file object f, a block at a time"
+  strings = iter(strings)
+  while True:
+    block = list(itertools.islice(strings, _BLOCK_PIECES))
+    if not block:
+      return
+    f.write("".join(block))
+
+def _same_text(a, b):
+  "returns whether two iterators of strings spell out the same text"
+  x, i = "", 0
+  y, j = "", 0
+  while True:
+    while x is not None and i == len(x):
+      x, i = next(a, None), 0
+    while y is not None and j == len(y):
+      y, j = next(b, None), 0
+    if x is None or y is None:
+      return x is None and y is None
+    n = min(len(x)-i, len(y)-j)
+    if x[i:i+n] != y[j:j+n]:
+      return False
+    i += n
+    j += n
+
+def _hash_and_width(node):
+  """returns (hash(node), len(str(node))), caching them on node and every
+     node in it that doesn't have them yet, computed bottom up in one pass"""
+  if node._width is not None:
+    return node._hash, node._width
+  stack = [node]
+  while stack:
+    n = stack[-1]
+    if n._width is not None:
+      stack.pop()
+    elif n._is_token:
+      n._hash = hash(n._token)
+      n._width = len(n._token)
+      stack.pop()
+    elif n._children is None:
+      if n._arena is None:
+        n._hash = hash(())
+        n._width = 2
+      else:
+        n._hash = n._arena._hash(n._row)
+        n._width = n._arena.widths[n._row]
+      stack.pop()
+    else:
+      children = n._children
+      pending = [c for c in children if c._width is None]
+      if pending: # do the children first
+        stack.extend(pending)
+        continue
+      # blank tokens are left out, so that ( ) and () hash alike
+      n._hash = hash(tuple([c._hash for c in children if c._width]))
+      shown = len([c for c in children if c._width])
+      n._width = 1 + shown + sum([c._width for c in children]) if\
+                 shown else 2
+      stack.pop()
+  return node._hash, node._width
 
+def _token_index(node):
+  """returns a dictionary from each token to the nodes with that token in 
+     node, in the order find gives them (and None to True if there are arena
+     views in node, which aren't indexed)"""
+  index = {}
+  stack = [node]
+  while stack:
+    n = stack.pop()
+    if n._is_token:
+      if n._token in index:
+        index[n._token].append(n)
+      else:
+        index[n._token] = [n]
+    if n._children is None:
+      if n._arena is not None:
+        index[None] = True
+    else:
+      stack.extend(reversed(n._children))
+  return index
+
+class _Children(list):
+  """the list of a LispNode's children, which tells the node (so it forgets
+     its cached hash and width) whenever the list is changed"""
+  __slots__ = ("owner",)
+
+  def __init__(self, children=(), owner=None):
+    list.__init__(self, children)
+    self.owner = owner
+
+def _changing(name):
+  "returns a _Children version of the list method name, which tells the owner"
+  method = getattr(list, name)
+  def changing(self, *args):
+    result = method(self, *args)
+    if self.owner is not None:
+      self.owner._changed()
+    return result
+  changing.__name__ = name
+  return changing
+
+for _name in ["__setitem__", "__delitem__", "__setslice__", "__delslice__",
+              "__iadd__", "__imul__", "append", "extend", "insert", "pop",
+              "remove", "reverse", "sort"]:
+  setattr(_Children, _name, _changing(_name))
+
+def _owned(children, node):
+  "returns children as a _Children list owned by node"
+  if isinstance(children, _Children):
+    children.owner = node
+    return children
+  return _Children(children, node)
+
+def _is_view(node):
+  "returns whether node is an arena view whose children haven't been made yet"
+  return node._children is None and node._arena is not None
+
+def _kids(node):
+  """returns node's children for reading only: an untouched arena view gets a
+     new list of views each time, rather than keeping them"""
+  if node._children is None:
+    if node._arena is None:
+      return ()
+    return node._arena._child_nodes(node._row, node)
+  return node._children
 
+def _children_of(node):
+  "returns node.children, without giving a token node an empty list to keep"
+  if node._children is None and node._arena is None:
+    return ()
+  return node.children
+
+def _arena_node(arena, row, parent):
+  "returns a LispNode view of the given row of arena"
+  node = LispNode.__new__(LispNode)
+  node.parent = parent
+  node._children = None
+  node._hash = None
+  node._width = None
+  node._index = None
+  token_id = arena.token_ids[row]
+  if token_id < 0:
+    node._token = ""
+    node._is_token = False
+    node._arena = arena
+    node._row = row
+  else:
+    node._token = arena.tokens[token_id]
+    node._is_token = True
+    node._arena = None
+    node._row = 0
+  return node
 
 
 # AND NOW, ON TO THE STUFF THE USERS MIGHT ACTUALLY USE
@@ -159,7 +457,7 @@ class UnmatchedParenthesesException(Exception):
   def __str__(self):
     return repr(self.value)
 
-class LispNode:
+class LispNode(object):
   """
   You can think of an AST constructed from LISP as consisting of a set of 
   LispNodes, each of which has a parent (except the root), and may have some
@@ -168,7 +466,21 @@ class LispNode:
   .children: this Node's children (a python list) (default: [])
   .token: if this node is a token, this is its string value (default: "")
   .is_token: a boolean representing whether this node is a token (default: F)
+  LispNodes keep these in __slots__ rather than a __dict__, and a token node
+  only gets a list of children once someone asks for it. A LispNode may also
+  be a view of a row in a LispArena, in which case its children are made 
+  (as more views) when they are first asked for.
+  Each node caches its hash and the length of its text once they are needed,
+  and a node searched for a token keeps an index of the token nodes in it, so
+  later searches of it for any token just look them up. Changing a node (its
+  token, is_token, or children list) forgets these for it and the nodes above
+  it (through .parent), so only the changed parts are indexed again.
+  A blank token (one whose token is "") is left out of the text of the nodes
+  it is in, as if it had been removed.
   """
+  __slots__ = ("parent", "_children", "_token", "_is_token", "_arena", "_row",
+               "_hash", "_width", "_index")
+
   def __init__(self, parseString=None, 
                      parent=None, 
                      children=None, 
@@ -180,57 +492,202 @@ class LispNode:
        child nodes, a token value and is_token.
        If this is a token, its child nodes are irrelevant.
        If this is not a token, its token value is irrelevant."""
-    if children == None:
-      children = []
     if token == None:
       token = ""
     if is_token == None:
       is_token = False
-    if parseString: # if we're parsing input string into a node structure
-      s = _lisp_node_from_iterator(_SpaceBufferedIterator(parseString))
-      self.children = s.children
-      self.token = s.token
-      self.is_token = s.is_token
+    self._arena = None
+    self._row = 0
+    self._hash = None
+    self._width = None
+    self._index = None
+    if isinstance(parseString, LispNode) and _is_view(parseString) and\
+       not parseString._is_token:
+      # copying an untouched view: share its row until one of them changes
+      self._children = None
+      self._token = ""
+      self._is_token = False
+      self._arena = parseString._arena
+      self._row = parseString._row
+    elif parseString: # if we're parsing input string into a node structure
+      s = _lisp_node_from_tokens(_tokenize(parseString))
+      self._children = s._children
+      self._token = s._token
+      self._is_token = s._is_token
     else:
-      self.children = children
-      self.token = token
-      self.is_token = (bool(token)) or is_token
-    for child in self.children:
-      child.parent = self
+      self._token = token
+      self._is_token = (bool(token)) or is_token
+      if children == None and not self._is_token:
+        children = []
+      self._children = children
+    if self._children is not None:
+      self._children = _owned(self._children, self)
+      for child in self._children:
+        child.parent = self
     self.parent = parent
 
- 
+  def _get_children(self):
+    if self._children is None:
+      if self._arena is not None:
+        self._children = _Children(self._arena._child_nodes(self._row, self),
+                                   self)
+        self._arena = None
+        # what's cached for a view doesn't cover its new children, so a 
+        # change to them couldn't reach it
+        self._changed()
+      else:
+        self._children = _Children((), self)
+    return self._children
+
+  def _set_children(self, children):
+    if children is not None:
+      children = _owned(children, self)
+    self._children = children
+    self._arena = None
+    self._changed()
+
+  children = property(_get_children, _set_children, 
+                      doc="this Node's children (a python list)")
+
+  def _get_token(self):
+    return self._token
+
+  def _set_token(self, token):
+    self._token = token
+    self._changed()
+
+  token = property(_get_token, _set_token, 
+                   doc="if this node is a token, its string value")
+
+  def _get_is_token(self):
+    return self._is_token
+
+  def _set_is_token(self, is_token):
+    self._is_token = is_token
+    self._changed()
+
+  is_token = property(_get_is_token, _set_is_token, 
+                      doc="whether this node is a token")
+
+  def _changed(self):
+    "forgets the cached hash and width of this node and the nodes above it"
+    node = self
+    while node is not None and node._width is not None:
+      node._width = None
+      node._hash = None
+      node._index = None
+      node = node.parent
+
   def __str__(self):
     "returns a (not exactly pretty) lisp version of this node"
-    return "".join(self)
+    return "".join(_strings(self))
 
   def __eq__(self, other):
-    "returns whether the two lisp nodes are equal (different parents OK)"
+    """returns whether the two lisp nodes are equal (different parents OK).
+       Nodes with different cached hashes or lengths are unequal right away;
+       only ones that look alike are compared all the way through."""
     # should be equivalent to str(self)==str(other)
-    a = iter(self)
-    b = iter(other)
-    a_i = None
-    b_i = None
-    while a_i == b_i:
-      try:
-        a_i = a.next()
-      except StopIteration:
-        try:
-          b_i = b.next()
-          return False
-        except StopIteration:
+    if isinstance(other, LispNode):
+      if self is other:
+        return True
+      if self._is_token and other._is_token:
+        return self._token == other._token
+      if _hash_and_width(self) != _hash_and_width(other):
+        return False
+      if _is_view(self) and _is_view(other) and self._arena is other._arena:
+        if self._row == other._row:
           return True
-      try:
-        b_i = b.next()
-      except StopIteration:
+        if self._arena.shared:
+          return False
+      # they're almost surely equal, so no point in stopping early
+      if self._width <= _BLOCK_SIZE:
+        return "".join(_strings(self)) == "".join(_strings(other))
+      return _same_text(_strings(self), _strings(other))
+    if isinstance(other, basestring):
+      if self._is_token:
+        return self._token == other
+      # the text of a node that is not a token always starts with (
+      if not other.startswith("(") or _hash_and_width(self)[1] != len(other):
         return False
-    return False
+      return _same_text(_strings(self), iter([other]))
+    return NotImplemented
+
+  def __hash__(self):
+    """a structural hash, so equal nodes hash alike (and a token like its 
+       string). It changes when the node does, so don't change a node while
+       it is a key in a dictionary."""
+    return _hash_and_width(self)[0]
+
+  def width(self):
+    "returns len(str(self)), cached (and forgotten on change) like the hash"
+    return _hash_and_width(self)[1]
 
   def find(self, target):
     "Returns all of the LispNodes that match target in this or its children"
-    if self == target:
-      return [self]
-    return reduce(lambda x,y:x+y.find(target), self.children, [])
+    token = target
+    if isinstance(target, LispNode) and target._is_token:
+      token = target._token
+    if isinstance(token, basestring) and token and not token.startswith("("):
+      found = self._find_token(token)
+      if found is not None:
+        return found
+    found = []
+    stack = [self]
+    while stack:
+      node = stack.pop()
+      if node == target:
+        found.append(node)
+      elif _is_view(node):
+        found.extend(node._arena._find(node, target))
+      else:
+        stack.extend(reversed(_children_of(node)))
+    return found
+
+  def _token_nodes(self):
+    "returns this node's index of token nodes, made now if need be"
+    if self._index is None:
+      _hash_and_width(self) # so that changes below here will reach us
+      self._index = _token_index(self)
+    return self._index
+
+  def _find_token(self, token):
+    """returns self.find(token) using this node's index of token nodes, or 
+       None if the index can't answer"""
+    index = self._token_nodes()
+    if None in index:
+      return None
+    found = index.get(token, ())
+    for node in found:
+      if node._children: # find doesn't look inside what it finds
+        return None
+    return list(found)
+
+  def tokens(self):
+    """returns a list of the distinct tokens in this node (from its index of
+       token nodes), or None if there are arena views in it"""
+    index = self._token_nodes()
+    if None in index:
+      return None
+    return index.keys()
+
+  def is_view(self):
+    "returns whether this is an arena view whose children haven't been made"
+    return _is_view(self)
+
+  def has_singleton_lists(self):
+    """returns whether this or any node in it is a list with exactly one 
+       child (without making the children of arena views)"""
+    stack = [self]
+    while stack:
+      node = stack.pop()
+      if _is_view(node):
+        if node._arena.singles[node._row]:
+          return True
+      elif not node.is_token:
+        if len(node.children) == 1:
+          return True
+        stack.extend(node.children)
+    return False
 
   def replace(self, find, replace):
     """all nodes that match find will be replaced with duplicates of replace 
@@ -246,43 +703,476 @@ class LispNode:
   
   def pretty_print(self, max_width=None, min_width=None):
    "returns a marginally prettier string version. max width default: 80"
-   if self.is_token:
-     return self.token
-   if len(self.children) == 0:
-     return "()"
    if max_width == None:
      max_width = 80
    if min_width == None:
      min_width = 40
-   if max_width < min_width:
-     max_width = min_width
-   if len(str(self)) <= max_width:
-     return str(self)
-   else:
-     return "("+self.children[0].pretty_print(max_width-1,min_width) +\
-            reduce(lambda x,y:x+"\n  "+\
-              y.pretty_print(max_width-2, min_width).replace("\n","\n  "), \
-              self.children[1:], "")+"\n)"
+   return "".join(_pretty_strings(self, max_width, min_width))
+
+  def write(self, f, pretty=False, max_width=None, min_width=None):
+    """writes this node to the file object f a block at a time, without ever
+       making the whole string: as str(self) would have it or, if pretty, as
+       self.pretty_print(max_width, min_width) would"""
+    if pretty:
+      if max_width == None:
+        max_width = 80
+      if min_width == None:
+        min_width = 40
+      _write_strings(_pretty_strings(self, max_width, min_width), f)
+    else:
+      _write_strings(_strings(self), f)
   
   def __iter__(self):
     "iterates through this LispNode as if it were a string, char by char"
-    if self.is_token:
-      return iter(self.token)
+    return itertools.chain.from_iterable(_strings(self))
+
+
+class LispArena(object):
+  """
+  A compact store for LispNode trees: every node is a row of some arrays,
+  rather than an object. Rows are numbered in the order they were finished,
+  so the children of a list always come before it:
+  .token_ids: for a token row, the index of its token in .tokens (else -1)
+  .firsts: for a list row, where its children start in .child_rows
+  .counts: for a list row, how many children it has
+  .child_rows: the row numbers of the children of each list, one after another
+  .widths: the length of the (not exactly pretty) lisp version of each row
+  .singles: 1 if a row is or has in it a list with exactly one child, else 0
+  .hashes: the hash of each row's node, filled in as far as it's been needed
+  .tokens: each distinct token, stored once
+  .roots: the row numbers of the top level expressions added so far
+  If shared is true, the arena is hash-consed: each distinct token or list is
+  stored as one row, however many times it occurs, and the text of each row
+  at most text_width long is kept once it has been made.
+  .node(row) gives a LispNode view of a row (default: the first root), which
+  supports the whole LispNode API. Its children are only made, as more views,
+  when they are first asked for, and changing a view changes only the view,
+  so copies of a view (LispNode(view)) share its row until they are changed.
+  Printing, comparing and finding things in untouched views reads the rows.
+  """
+  text_width = 4096
+
+  def __init__(self, content=None, comment=None, shared=False):
+    "content (optional) is added as by .add"
+    self.shared = shared
+    self.token_ids = array("i")
+    self.firsts = array("i")
+    self.counts = array("i")
+    self.child_rows = array("i")
+    self.widths = array("l")
+    self.singles = array("b")
+    self.hashes = array("l")
+    self.tokens = []
+    self.roots = array("i")
+    self._token_ids = {}
+    # for shared arenas: the row of each token id or tuple of child rows, 
+    # the text of rows made so far, and for each token id, whether each row
+    # looked at so far has that token in it
+    self._rows = {}
+    self._texts = {}
+    self._contains = {}
+    if content is not None:
+      self.add(content, comment)
+
+  def __len__(self):
+    "the number of rows"
+    return len(self.token_ids)
+
+  def nbytes(self):
+    "the number of bytes used by the arrays and the distinct tokens"
+    return sum(a.itemsize * len(a) for a in 
+               [self.token_ids, self.firsts, self.counts, self.child_rows,
+                self.widths, self.singles, self.hashes, self.roots]) +\
+           sum(map(sys.getsizeof, self.tokens))
+
+  def _token_id(self, token):
+    "the index of token in .tokens, adding it if it's new"
+    token_id = self._token_ids.get(token)
+    if token_id is None:
+      token_id = self._token_ids[token] = len(self.tokens)
+      self.tokens.append(token)
+    return token_id
+
+  def _new_row(self, token_id, first, count, width, single):
+    "adds a row, returning its number"
+    self.token_ids.append(token_id)
+    self.firsts.append(first)
+    self.counts.append(count)
+    self.widths.append(width)
+    self.singles.append(single)
+    return len(self.token_ids) - 1
+
+  def _token_row(self, token):
+    "returns a row for token (an existing one, if this arena is shared)"
+    token_id = self._token_id(token)
+    if self.shared:
+      row = self._rows.get(token_id)
+      if row is not None:
+        return row
+    row = self._new_row(token_id, 0, 0, len(token), 0)
+    if self.shared:
+      self._rows[token_id] = row
+    return row
+
+  def _list_row(self, child_rows):
+    """returns a row for a list with the given children (an existing one, if 
+       this arena is shared)"""
+    if self.shared:
+      key = tuple(child_rows)
+      row = self._rows.get(key)
+      if row is not None:
+        return row
+    # blank tokens (width 0) are left out of the text, as for LispNodes
+    shown = len([r for r in child_rows if self.widths[r]])
+    if shown:
+      width = 1 + shown + sum(self.widths[r] for r in child_rows)
+      single = int(len(child_rows) == 1 or
+                   max(self.singles[r] for r in child_rows))
     else:
-      return _LispNodeIterator(self)
+      width = 2
+      single = 0
+    row = self._new_row(-1, len(self.child_rows), len(child_rows), width, 
+                        single)
+    self.child_rows.extend(child_rows)
+    if self.shared:
+      self._rows[key] = row
+    return row
+
+  def add(self, content, comment=None):
+    """adds a LispNode, or every top level expression in anything lisp_parse
+       accepts (with single line comments starting with comment, if given),
+       returning the list of new root row numbers"""
+    if isinstance(content, LispNode):
+      roots = [self._add_node(content)]
+    else:
+      roots = []
+      stack = []
+      for token in _tokenize(content, comment):
+        if token == "(":
+          stack.append([])
+          continue
+        if token == ")":
+          if not stack:
+            raise UnmatchedParenthesesException("unexpected )")
+          row = self._list_row(stack.pop())
+        else:
+          row = self._token_row(token)
+        if stack:
+          stack[-1].append(row)
+        else:
+          roots.append(row)
+      if stack:
+        raise UnmatchedParenthesesException("end of input")
+    self.roots.extend(roots)
+    return roots
+
+  def _add_node(self, node):
+    "adds the rows for node and its children, returning node's row number"
+    root = []
+    # entries are (node, the list its row number goes in), or (the rows of 
+    # the children of a list which are all done, the list its row goes in)
+    stack = [(node, root)]
+    while stack:
+      node, rows = stack.pop()
+      if isinstance(node, list):
+        rows.append(self._list_row(node))
+      elif node._arena is self and _is_view(node) and not node.is_token:
+        rows.append(node._row)
+      elif node.is_token:
+        rows.append(self._token_row(node.token))
+      else:
+        child_rows = []
+        stack.append((child_rows, rows))
+        stack.extend((child, child_rows) for child in reversed(_kids(node)))
+    return root[0]
+
+  def node(self, row=None):
+    "returns a LispNode view of row (default: the first root)"
+    if row is None:
+      row = self.roots[0]
+    return _arena_node(self, row, None)
+
+  def _child_nodes(self, row, parent):
+    "returns a list of views of the children of row, with the given parent"
+    first = self.firsts[row]
+    return [_arena_node(self, child_row, parent) for child_row in 
+            self.child_rows[first:first+self.counts[row]]]
+
+  def _strings(self, row, make_texts=True):
+    """just like _strings(self.node(row)), without making any LispNodes.
+       In a shared arena, the text of the outermost rows at most text_width 
+       long is kept (make_texts=False only uses texts already kept)."""
+    stack = [row]
+    while stack:
+      row = stack.pop()
+      if not isinstance(row, int):
+        yield row
+      elif self.token_ids[row] >= 0:
+        yield self.tokens[self.token_ids[row]]
+      elif self.widths[row] == 2:
+        # () itself, or a list of blank tokens
+        yield "()"
+      elif row in self._texts:
+        yield self._texts[row]
+      elif make_texts and self.shared and self.widths[row] <= self.text_width:
+        self._texts[row] = "".join(self._strings(row, False))
+        yield self._texts[row]
+      else:
+        yield "("
+        stack.append(")")
+        first = self.firsts[row]
+        for i in range(first+self.counts[row]-1, first-1, -1):
+          if self.widths[self.child_rows[i]]:
+            stack.append(self.child_rows[i])
+            stack.append(" ")
+        stack.pop() # no space before the first child
+
+  def _hash(self, row):
+    "returns the hash of row's node, working out those of all rows before it"
+    hashes = self.hashes
+    for r in xrange(len(hashes), row+1):
+      if self.token_ids[r] >= 0:
+        hashes.append(hash(self.tokens[self.token_ids[r]]))
+      else:
+        first = self.firsts[r]
+        hashes.append(hash(tuple([hashes[c] for c in 
+            self.child_rows[first:first+self.counts[r]] if self.widths[c]])))
+    return hashes[row]
+
+  def _has_token(self, row, token_id):
+    """(for shared arenas) whether the token with token_id is in row,
+       remembering the answer for every row looked at"""
+    has = self._contains.setdefault(token_id, {})
+    stack = [(row, False)]
+    while stack:
+      row, children_done = stack.pop()
+      if row in has:
+        continue
+      if self.token_ids[row] >= 0:
+        has[row] = self.token_ids[row] == token_id
+        continue
+      first = self.firsts[row]
+      children = self.child_rows[first:first+self.counts[row]]
+      if children_done:
+        has[row] = any(has[child] for child in children)
+      else:
+        stack.append((row, True))
+        stack.extend((child, False) for child in children if child not in has)
+    return has[row]
+
+  def _find(self, node, target):
+    """returns what node.find(target) would find below node, an untouched 
+       view of a row of this arena, searching the rows and only making the
+       nodes on the way to what is found"""
+    if isinstance(target, LispNode):
+      target = target.token if target.is_token else str(target)
+    if not isinstance(target, basestring):
+      return []
+    # anything but a token starts with (
+    token_id = None
+    if not target.startswith("("):
+      token_id = self._token_ids.get(target)
+      if token_id is None:
+        return []
+    width = len(target)
+    # each entry is a row and the path to it, as (child index, rest of path)
+    paths = []
+    stack = [(node._row, None)]
+    while stack:
+      row, path = stack.pop()
+      if path is not None and self.widths[row] == width and (
+         self.token_ids[row] == token_id if token_id is not None else
+         _same_text(self._strings(row), iter([target]))):
+        paths.append(path)
+        continue
+      if self.token_ids[row] >= 0:
+        continue
+      if token_id is not None and self.shared and\
+         not self._has_token(row, token_id):
+        continue
+      first = self.firsts[row]
+      for i in range(self.counts[row]-1, -1, -1):
+        stack.append((self.child_rows[first+i], (i, path)))
+    found = []
+    for path in paths:
+      indices = []
+      while path is not None:
+        indices.append(path[0])
+        path = path[1]
+      n = node
+      for i in reversed(indices):
+        n = n.children[i]
+      found.append(n)
+    return found
+
+
+class LispLine(object):
+  """
+  A handle on one line of a LispDocument (see there):
+  .value: the line, a string (comments and such) or a LispNode (a form)
+  .prev, .next: the lines before and after it (None at the ends)
+  .removed: whether it has been removed from its document
+  """
+  __slots__ = ("value", "prev", "next", "removed")
+
+  def __init__(self, value):
+    self.value = value
+    self.prev = None
+    self.next = None
+    self.removed = False
+
+class _LispLines(object):
+  "an iterable view of the lines (or just the forms) of a LispDocument"
+  def __init__(self, document, forms):
+    self.document = document
+    self.forms = forms
+
+  def handles(self):
+    """iterates through the LispLine handles. This carries on from wherever
+       the current line is, so lines added after it are reached, and lines
+       added before it are not (nor are the lines of a removed one)"""
+    line = self.document.first
+    while line is not None:
+      if not line.removed and \
+         (not self.forms or isinstance(line.value, LispNode)):
+        yield line
+      line = line.next
+
+  def __iter__(self):
+    line = self.document.first
+    while line is not None:
+      if not line.removed and \
+         (not self.forms or isinstance(line.value, LispNode)):
+        yield line.value
+      line = line.next
+
+  def __len__(self):
+    if self.forms:
+      return self.document._forms
+    return self.document._lines
+
+class LispDocument(object):
+  """
+  The lines of a lisp file, in order: strings (comments and such) and 
+  LispNodes (the top level expressions, or forms). The lines are a linked
+  list of LispLine handles, so adding a line before or after any other, or 
+  removing one, takes constant time, and a handle stays where it is however
+  many lines are added or removed around it. Each form also maps to its 
+  handle (by identity), so:
+  .handle(line): the handle of a form (or a handle itself) in constant time
+  .insert_before(line, value), .insert_after(line, value): add a line next to
+                a form or handle, returning the new handle
+  .remove(line): remove a form or handle
+  .replace(line, value): put another value in the same place
+  .lines: an iterable view of all of the lines, in order
+  .forms: an iterable view of just the forms, in order
+  Both views may be walked while the document changes (see handles).
+  """
+  def __init__(self, lines=()):
+    self.first = None
+    self.last = None
+    self._lines = 0
+    self._forms = 0
+    self._handles = {}
+    self.lines = _LispLines(self, False)
+    self.forms = _LispLines(self, True)
+    for value in lines:
+      self.insert_after(self.last, value)
+
+  def __len__(self):
+    return self._lines
+
+  def handle(self, line):
+    "returns the LispLine handle of line, a form in this document or a handle"
+    if isinstance(line, LispLine):
+      handle = line
+    else:
+      handle = self._handles.get(id(line))
+      if handle is None or handle.value is not line:
+        raise ValueError("not a form of this document: "+str(line)[:80])
+    if handle.removed:
+      raise ValueError("already removed: "+str(handle.value)[:80])
+    return handle
+
+  def _add(self, handle):
+    self._lines += 1
+    if isinstance(handle.value, LispNode):
+      self._forms += 1
+      self._handles[id(handle.value)] = handle
+
+  def _drop(self, handle):
+    self._lines -= 1
+    if isinstance(handle.value, LispNode):
+      self._forms -= 1
+      del self._handles[id(handle.value)]
+
+  def insert_after(self, line, value):
+    """adds value as a line just after line (a form or handle), or at the 
+       start if line is None, and returns its handle"""
+    handle = LispLine(value)
+    if line is None:
+      handle.next = self.first
+    else:
+      handle.prev = self.handle(line)
+      handle.next = handle.prev.next
+    if handle.prev is None:
+      self.first = handle
+    else:
+      handle.prev.next = handle
+    if handle.next is None:
+      self.last = handle
+    else:
+      handle.next.prev = handle
+    self._add(handle)
+    return handle
+
+  def insert_before(self, line, value):
+    """adds value as a line just before line (a form or handle), or at the 
+       end if line is None, and returns its handle"""
+    if line is None:
+      return self.insert_after(self.last, value)
+    return self.insert_after(self.handle(line).prev, value)
+
+  def remove(self, line):
+    """removes line (a form or handle). Its handle keeps its .next, so a walk
+       which was at it goes on to the line which came after it"""
+    handle = self.handle(line)
+    if handle.prev is None:
+      self.first = handle.next
+    else:
+      handle.prev.next = handle.next
+    if handle.next is None:
+      self.last = handle.prev
+    else:
+      handle.next.prev = handle.prev
+    handle.removed = True
+    self._drop(handle)
+
+  def replace(self, line, value):
+    "puts value in place of line (a form or handle), returning its handle"
+    handle = self.handle(line)
+    self._drop(handle)
+    handle.value = value
+    self._add(handle)
+    return handle
 
 
 def lisp_parse(content, comment="#"):
   """reads the input content, with single line comments starting with comment,
    parsing the results as a LispNode
    line breaks must be with \\n
+   content may be a string, a file, or an iterable of strings
    comment defaults to #
    note that to be valid, this must be contained within an ultimate ()"""
-  return LispNode(_CommentRemovalIterator(content, comment))
+  return _lisp_node_from_tokens(_tokenize(content, comment))
 
 def lisp_file(filename, comment="#"):
   """reads the input filename, with single line comments starting with comment,
    parsing the results as a LispNode
    comment defaults to #
    note that to be valid, this file must be contained within an ultimate ()"""
-  return lisp_parse(_file_iter(filename), comment)
+  f = open(filename, "r")
+  try:
+    return lisp_parse(f, comment)
+  finally:
+    f.close()
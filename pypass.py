@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# A pass manager for transformations of a lisp document: a 
+# pylisp2.LispDocument of the lines of a file (comment strings and LispNodes).
+import sys
+import time
+
+class PassDependencyException(Exception):
+  " an Exception for when a pass is added before the passes it needs "
+  def __init__(self, value):
+    self.value = value
+  def __str__(self):
+    return repr(self.value)
+
+class Pass(object):
+  """
+  One transformation of a document:
+  .name: the name timings are reported under, and other passes refer to
+  .run: a function of the document doing the whole pass
+  .after: the names of the passes which must run before this one
+  A pass which only acts on the token nodes with certain tokens, one at a
+  time, without adding or removing lines, may instead give:
+  .triggers: those tokens
+  .visit: a function of one such token node, doing what the pass does to it
+  .makes: the tokens visit might add (so it isn't fused with passes which
+          are triggered by them)
+  and a pass which acts on each line of the document by itself may give:
+  .line: a function of a line, returning what to replace it with
+  Adjacent passes of either of these kinds are fused: they run in one walk.
+  """
+  def __init__(self, name, run=None, after=(), triggers=(), visit=None,
+               makes=(), line=None):
+    self.name = name
+    self.after = tuple(after)
+    self.triggers = tuple(triggers)
+    self.visit = visit
+    self.makes = tuple(makes)
+    self.line = line
+    if run == None:
+      if visit != None:
+        run = lambda document:_visit_all([self], document.forms)
+      elif line != None:
+        run = lambda document:_line_all([self], document)
+    self.run = run
+
+def _visit_all(passes, lispnode_list):
+  """runs visiting passes fused: for each form, finds what triggers any of
+     them (find works from one index of the form's tokens), then visits it"""
+  for lispnode in lispnode_list:
+    for p in passes:
+      for token in p.triggers:
+        for node in lispnode.find(token):
+          p.visit(node)
+
+def _line_all(passes, document):
+  "runs line by line passes fused, in one walk of the lines of document"
+  for line in document.lines.handles():
+    value = line.value
+    for p in passes:
+      value = p.line(value)
+    if value is not line.value:
+      document.replace(line, value)
+
+def _fusable(group, p):
+  "returns whether p can run in the same walk as the passes of group"
+  if p.visit != None and all(q.visit != None for q in group):
+    made = set(token for q in group+[p] for token in q.makes)
+    triggers = [token for q in group+[p] for token in q.triggers]
+    return len(set(triggers)) == len(triggers) and not made & set(triggers)
+  return p.line != None and all(q.line != None for q in group)
+
+class PassManager(object):
+  """
+  Runs passes in the order they were added, fusing adjacent ones where it
+  can (see Pass), and keeps how long each walk took:
+  .passes: the passes, in order
+  .timings: a list of (names of the passes in a walk, seconds) for the last
+            run
+  """
+  def __init__(self, passes=()):
+    self.passes = []
+    self.timings = []
+    for p in passes:
+      self.add(p)
+
+  def add(self, p):
+    "adds pass p, which must come after all of the passes it needs"
+    names = set(q.name for q in self.passes)
+    if p.name in names:
+      raise PassDependencyException("pass "+p.name+" added twice")
+    missing = [name for name in p.after if name not in names]
+    if missing:
+      raise PassDependencyException("pass "+p.name+" needs "+
+                                    ", ".join(missing)+" first")
+    self.passes.append(p)
+
+  def walks(self):
+    "returns the passes grouped into the walks they will run in"
+    groups = []
+    for p in self.passes:
+      if groups and _fusable(groups[-1], p):
+        groups[-1].append(p)
+      else:
+        groups.append([p])
+    return groups
+
+  def run(self, document):
+    "runs every pass on the document, timing each walk"
+    self.timings = []
+    for group in self.walks():
+      start = time.time()
+      if len(group) == 1:
+        group[0].run(document)
+      elif group[0].visit != None:
+        _visit_all(group, document.forms)
+      else:
+        _line_all(group, document)
+      self.timings.append(("+".join(p.name for p in group),
+                           time.time()-start))
+
+  def report(self, f=None):
+    "writes the timings of the last run to the file object f (or stdout)"
+    if f == None:
+      f = sys.stdout
+    total = sum(seconds for names, seconds in self.timings)
+    for names, seconds in self.timings:
+      f.write("%9.3fs %5.1f%%  %s\n" % (seconds,
+          100*seconds/total if total else 0.0, names))
+    f.write("%9.3fs         total\n" % total)
@@ -3,43 +3,69 @@ import os
 import datetime
 import sys
 import math
-from pylisp2 import lisp_parse, LispNode
+import hashlib
+from pylisp2 import lisp_parse, LispNode, LispArena, LispDocument
+from pypass import Pass, PassManager
+from pycache import DiskCache, cache_key
+from pysolver import SolverSession, SolverPool, Portfolio
+from cStringIO import StringIO
 import itertools
+import re
+
+# how many characters to read from a file at a time
+_BLOCK_SIZE = 1 << 16
 
 def binaries(n): return map("".join, itertools.product('01',repeat=n))
 # this next one is needed for the analysis printouts
 def sbinaries(n): return  sorted(binaries(n), key=(lambda z:-sum(map(int,z))))
 # convert a hex string to a binary string
-def hex_to_binary(h): return "".join(map(lambda x:binaries(4)[int(x,16)], h))
+def hex_to_binary(h): return bin(int(h, 16))[2:].zfill(4*len(h)) if h else ""
+
+# with -share, a hash-consed LispArena holding the terms the passes copy over
+# and over, so each distinct one is stored once (see share)
+shared_terms = None
+
+def share(lispnode):
+  """returns a copy of lispnode. If shared_terms is on, the copy is a view of
+     the one copy of lispnode in shared_terms, and copies of it 
+     (LispNode(copy)) are views too, until they are changed."""
+  if shared_terms == None:
+    return LispNode(lispnode)
+  return shared_terms.node(shared_terms.add(lispnode)[0])
+
+def define_const_visit(const):
+  "desugars the define-const token node const into a define-fun"
+  const.token="define-fun"
+  const.parent.children.insert(2,LispNode("()"))
 
 def define_const(lispnode_list):
   "desugars define-const into the define-fun it always was"
   for lispnode in lispnode_list:
     for const in lispnode.find("define-const"):
-      const.token="define-fun"
-      const.parent.children.insert(2,LispNode("()"))
+      define_const_visit(const)
+
+def declare_const_visit(const):
+  "desugars the declare-const token node const into a declare-fun"
+  const.token="declare-fun"
+  const.parent.children.insert(2,LispNode("()"))
 
 def declare_const(lispnode_list):
   "desugars declare-const into the declare-fun it always was"
   for lispnode in lispnode_list:
     for const in lispnode.find("declare-const"):
-      const.token="declare-fun"
-      const.parent.children.insert(2,LispNode("()"))
+      declare_const_visit(const)
 
-def define_fun_no_input(all_lines_list, lispnode_list):
+def define_fun_no_input(document):
   """Because apparently some solvers can't handle it, replaces no input
      define-fun with declare fun and assertion"""
-  for lispnode in lispnode_list:
+  for lispnode in document.forms:
     for define in lispnode.find("define-fun"):
       if define.parent.children[2] == "()":
         define.token="declare-fun"
-        lispnode_index = lispnode_list.index(lispnode)
-        all_lines_index = all_lines_list.index(lispnode)
-        lispnode_list.insert(lispnode_index+1, LispNode(children=
+        document.insert_after(lispnode, LispNode(children=
           [LispNode("assert"), LispNode(children=
              [LispNode("="), LispNode(define.parent.children[1]), 
               define.parent.children.pop(4)])]))
-        all_lines_list.insert(all_lines_index+1,lispnode_list[lispnode_index+1])
 
 def bv_all_zero_1_in_ith_place(n, i):
   "creates a node that evaluates to a bitvec size n with a 1 only in place i"
@@ -77,39 +103,31 @@ def forall_single(lispnode_list):
         parent.children[1].children = parent.children[1].children[:1]
         parent = parent.children[2]
 
-def forall_unroll(all_lines_list, lispnode_list):
-  """Unroll any forall BitVec into a big and"""
-  foralls_unrolled_so_far = 0
-  lispnode_index = 0
-  all_lines_index = 0
-  while (lispnode_index < len(lispnode_list)):
-    lispnode = lispnode_list[lispnode_index]
-    while all_lines_list[all_lines_index] != lispnode:
-      all_lines_index += 1
+def forall_unroll(document, first=0):
+  """Unroll any forall BitVec into a big and. The functions made are numbered
+     from first, and the next unused number is returned."""
+  foralls_unrolled_so_far = first
+  for lispnode in document.forms:
     for forall in lispnode.find("forall")[::-1]: # innermost first
       enclosing_item_descriptions = \
           item_descriptions_from_enclosing_foralls(forall.parent)
       item_descriptions = forall.parent.children[1].children
+      descriptions = map(share, enclosing_item_descriptions+item_descriptions)
       if reduce(lambda x,y: x and (len(y.children[1].children) > 2) and 
                               y.children[1].children[1] == "BitVec", 
                 item_descriptions, True):
         #make a function representing this forall
-        lispnode_list.insert(lispnode_index, LispNode(children=
+        document.insert_before(lispnode, LispNode(children=
           [LispNode("define-fun"), 
            LispNode("forall-unroll-"+str(foralls_unrolled_so_far)),
-           LispNode(children = map(LispNode, 
-               enclosing_item_descriptions + item_descriptions)), 
+           LispNode(children = map(LispNode, descriptions)), 
            LispNode("Bool"), 
            forall.parent.children[2]]))
-        all_lines_list.insert(all_lines_index, lispnode_list[lispnode_index])
-        lispnode_index += 1
-        all_lines_index += 1
         forall.token = "and"
         forall.parent.children = [forall]
-        call_forall_unroll = LispNode(children=
+        call_forall_unroll = share(LispNode(children=
           [LispNode("forall-unroll-"+str(foralls_unrolled_so_far))]+
-           map(lambda node:LispNode(node.children[0]), 
-               enclosing_item_descriptions + item_descriptions))
+           map(lambda node:LispNode(node.children[0]), descriptions)))
         # I'm going to unroll this forall one bit at a time, so as
         # to guarantee program expansion linear in the size of the 
         # largest bitvector
@@ -120,33 +138,28 @@ def forall_unroll(all_lines_list, lispnode_list):
             print "ERROR: 0 BIT BITVECTOR: "+str(forall.parent)
           else:
             for i in range(num_bits-1):
-              lispnode_list.insert(lispnode_index, LispNode(children=
+              bit_function = LispNode(children=
                 [LispNode("define-fun"),
                  LispNode("forall-unroll-"+str(foralls_unrolled_so_far)+\
                           "-bit-"+str(i)),
-                 LispNode(children = map(LispNode, 
-                       enclosing_item_descriptions + item_descriptions)), 
+                 LispNode(children = map(LispNode, descriptions)), 
                  LispNode("Bool"),
                  LispNode(children=[LispNode("and"),
                                     LispNode(call_forall_unroll),
                                     LispNode(call_forall_unroll)])
-                ]))
-              all_lines_list.insert(all_lines_index, \
-                                    lispnode_list[lispnode_index])
+                ])
+              document.insert_before(lispnode, bit_function)
               # now I replace one of the arguments in that function with an
               # argument at sets the ith bit to 1
-              lispnode_list[lispnode_index].children[4].children[2].replace(
+              bit_function.children[4].children[2].replace(
                   item_description.children[0], 
                   LispNode(children=[LispNode("bvor"),
                                      item_description.children[0],
                                      bv_all_zero_1_in_ith_place(num_bits,i)]))
-              call_forall_unroll = LispNode(children=
+              call_forall_unroll = share(LispNode(children=
                 [LispNode("forall-unroll-"+str(foralls_unrolled_so_far)+\
                           "-bit-"+str(i))]+
-                 map(lambda node:LispNode(node.children[0]), 
-                     enclosing_item_descriptions + item_descriptions))
-              lispnode_index += 1
-              all_lines_index += 1
+                 map(lambda node:LispNode(node.children[0]), descriptions)))
             forall.parent.children.append(LispNode(call_forall_unroll, 
                                                    parent=forall.parent))
             forall.parent.children.append(LispNode(call_forall_unroll, 
@@ -156,14 +169,576 @@ def forall_unroll(all_lines_list, lispnode_list):
             forall.parent.children[2].replace(item_description.children[0], 
                 bv_all_zero_1_in_ith_place(num_bits, num_bits))
       foralls_unrolled_so_far+=1
-    lispnode_index += 1
-    all_lines_index += 1
+  return foralls_unrolled_so_far
+
+# the names of the functions forall_unroll defines
+_UNROLL_HELPER = re.compile(r"^forall-unroll-[0-9]+(-bit-[0-9]+)?$")
+
+def merge_unroll_helpers(document):
+  """keeps only the first of each set of functions forall_unroll made which
+     are the same but for the names of their inputs (and of the functions 
+     they call, once those are merged), calling it in place of the others.
+     Returns how many it removed."""
+  kept = {} # what a function is, with its inputs numbered -> its name
+  merged = {} # the name of a function removed -> the one kept like it
+  for lispnode in document.forms:
+    tokens = lispnode.tokens()
+    if tokens == None:
+      tokens = merged.keys()
+    for token in tokens:
+      if token in merged:
+        for node in lispnode.find(token):
+          node.token = merged[token]
+    if not (not lispnode.is_token and len(lispnode.children) == 5 and 
+            lispnode.children[0] == "define-fun" and 
+            _UNROLL_HELPER.match(str(lispnode.children[1]))):
+      continue
+    inputs = lispnode.children[2].children
+    # "()i" can't be in the text of a node, so can't be taken for a token
+    numbers = dict((str(inputs[i].children[0]), "()"+str(i))
+                   for i in range(len(inputs)))
+    key = " ".join(str(x.children[1]) for x in inputs)+" "+\
+          str(lispnode.children[3])+" "+\
+          re.sub(r"[^\s()]+", lambda m:numbers.get(m.group(0), m.group(0)),
+                 str(lispnode.children[4]))
+    name = str(lispnode.children[1])
+    if key in kept:
+      merged[name] = kept[key]
+      document.remove(lispnode)
+    else:
+      kept[key] = name
+  return len(merged)
+
+# the operators whose result is the sort of their first input, and the ones
+# whose result is Bool, for _term_sort
+_SAME_SORT = set(["bvnot", "bvneg", "bvand", "bvor", "bvxor", "bvnand", "bvnor",
+                  "bvxnor", "bvadd", "bvsub", "bvmul", "bvudiv", "bvurem", 
+                  "bvsdiv", "bvsrem", "bvsmod", "bvshl", "bvlshr", "bvashr"])
+_BOOL_SORT = set(["=", "distinct", "not", "and", "or", "xor", "=>", "bvult",
+                  "bvule", "bvugt", "bvuge", "bvslt", "bvsle", "bvsgt", "bvsge",
+                  "forall", "exists"])
+
+def _bits(sort):
+  "returns the width of the sort text sort, or None if it isn't a BitVec"
+  if sort == None or not sort.startswith("(_ BitVec "):
+    return None
+  return int(sort[len("(_ BitVec "):-1])
+
+def _term_sort(term, input_sorts, sorts):
+  """returns the sort (as text) of the term node term, given input_sorts, 
+     those of its inputs (see _term_inputs: None where unknown), and sorts, a
+     dictionary of the sorts of the functions and constants declared so far,
+     or None if it can't tell"""
+  if term.is_token:
+    token = term.token
+    if token.startswith("#b"):
+      return "(_ BitVec "+str(len(token)-2)+")"
+    if token.startswith("#x"):
+      return "(_ BitVec "+str(4*(len(token)-2))+")"
+    if token in ["true", "false"]:
+      return "Bool"
+    return sorts.get(token)
+  if not term.children:
+    return None
+  head = term.children[0]
+  if head.is_token:
+    if head.token == "_" and len(term.children) == 3: # (_ bvN width)
+      return "(_ BitVec "+str(term.children[2])+")"
+    if head.token in _BOOL_SORT:
+      return "Bool"
+    if head.token in _SAME_SORT and input_sorts:
+      return input_sorts[0]
+    if head.token == "ite" and len(input_sorts) == 3:
+      return input_sorts[1] or input_sorts[2]
+    if head.token == "concat":
+      widths = map(_bits, input_sorts)
+      if widths and None not in widths:
+        return "(_ BitVec "+str(sum(widths))+")"
+      return None
+    return sorts.get(head.token)
+  # an indexed operator, such as (_ extract 3 0)
+  if len(head.children) < 3 or not head.children[0] == "_" or\
+     len(input_sorts) != 1:
+    return None
+  width = _bits(input_sorts[0])
+  op = str(head.children[1])
+  indices = map(str, head.children[2:])
+  if width == None or not all(index.isdigit() for index in indices):
+    return None
+  indices = map(int, indices)
+  if op == "extract":
+    width = indices[0] - indices[1] + 1
+  elif op == "repeat":
+    width *= indices[0]
+  elif op in ["zero_extend", "sign_extend"]:
+    width += indices[0]
+  elif op not in ["rotate_left", "rotate_right"]:
+    return None
+  return "(_ BitVec "+str(width)+")"
+
+def _term_inputs(term):
+  """returns the children of the term node term which are terms themselves
+     (not the function, nor the variables of a forall), or None if term is a
+     let or an annotation, which common_subterms leaves alone"""
+  if term.is_token or not term.children:
+    return []
+  head = term.children[0]
+  if not head.is_token:
+    return term.children[1:]
+  if head.token in ["forall", "exists"]:
+    return term.children[2:3]
+  if head.token in ["let", "!"]:
+    return None
+  if head.token == "_":
+    return []
+  return term.children[1:]
+
+def _term_roots(form):
+  "returns the indices of the children of the top level form form with terms"
+  if form.is_token or not form.children:
+    return []
+  if form.children[0] == "assert" and len(form.children) == 2:
+    return [1]
+  if form.children[0] == "define-fun" and len(form.children) == 5:
+    return [4]
+  return []
+
+def _terms(form, interned):
+  """returns the terms in the top level form form, each after the terms in
+     it, a dictionary from the id of each to (whether it has an input of
+     the function form defines in it, whether it has a variable bound in form
+     in it, or is a let or an annotation), and a dictionary from the id of 
+     each node in form to a number standing for its text: the same for nodes
+     alike, as given by interned (a dictionary kept from call to call)"""
+  keys = {}
+  stack = [form]
+  nodes = []
+  while stack:
+    nodes.append(stack.pop())
+    if not nodes[-1].is_token:
+      stack.extend(nodes[-1].children)
+  for node in reversed(nodes):
+    if node.is_token:
+      key = node.token
+    else:
+      key = tuple(keys[id(x)] for x in node.children)
+    keys[id(node)] = interned.setdefault(key, len(interned))
+  inputs = set()
+  if form.children and form.children[0] == "define-fun":
+    inputs = set(str(x.children[0]) for x in form.children[2].children 
+                 if not x.is_token)
+  terms = []
+  stack = [form.children[i] for i in _term_roots(form)]
+  bound = set()
+  while stack:
+    term = stack.pop()
+    terms.append(term)
+    if not term.is_token and term.children and\
+       term.children[0] in ["forall", "exists"]:
+      bound.update(str(x.children[0]) for x in term.children[1].children
+                   if not x.is_token)
+    stack.extend(_term_inputs(term) or [])
+  terms.reverse()
+  flags = {}
+  for term in terms:
+    if term.is_token:
+      flags[id(term)] = (term.token in inputs, term.token in bound)
+    else:
+      children = _term_inputs(term)
+      if children == None:
+        flags[id(term)] = (True, True)
+      else:
+        flags[id(term)] = (any(flags[id(x)][0] for x in children),
+                           any(flags[id(x)][1] for x in children))
+  return terms, flags, keys
+
+def common_subterms(document):
+  """names the terms that come up more than once in the asserts and 
+     define-fun bodies of document, where writing the name each time and the
+     term once is shorter than writing the term each time. Those that use no
+     input of the function they are in, and whose sort can be told, are 
+     defined once, by a define-fun with no inputs before the first form using
+     them; the others are bound by lets around the body they are in. A name
+     used only once (as for a term only found inside another named term) is
+     put back. Returns (the bytes of the forms before, and after, 
+     the number of define-funs added, the number of let bindings added)."""
+  forms = list(document.forms)
+  before = sum(form.width()+1 for form in forms)
+  taken = set(name for form in forms for name in declared_symbols(form))
+  for form in forms:
+    taken.update(form.tokens() or [])
+  counter = [0]
+  def saves(term, count, overhead):
+    """returns whether naming term, which comes up count times, with a
+       definition adding overhead characters besides the name and term, 
+       is shorter"""
+    name = len("cse-"+str(counter[0]))
+    return (count-1)*term.width() > (count+1)*name + overhead
+  def fresh():
+    while "cse-"+str(counter[0]) in taken:
+      counter[0] += 1
+    counter[0] += 1
+    return "cse-"+str(counter[0]-1)
+  # how often each term using no inputs comes up in all the forms (by key)
+  interned = {}
+  counts = {}
+  analysed = {}
+  for form in forms:
+    if _term_roots(form):
+      analysed[id(form)] = _terms(form, interned)
+      terms, flags, keys = analysed[id(form)]
+    else:
+      terms = []
+    for term in terms:
+      if not term.is_token and flags[id(term)] == (False, False):
+        counts[keys[id(term)]] = counts.get(keys[id(term)], 0) + 1
+  sorts = {}
+  defined = {} # key of a term -> the name of the define-fun made for it
+  definitions = {} # name -> its define-fun
+  uses = {} # name -> the token nodes using it
+  lets = 0
+  def use(name):
+    token = LispNode(token=name)
+    uses.setdefault(name, []).append(token)
+    return token
+  def put_back(name, value):
+    "puts value (or a copy of it) in place of each use of name"
+    tokens = uses.pop(name)
+    for token in tokens:
+      if token is not tokens[0]:
+        value = LispNode(value)
+        stack = [value]
+        while stack: # the names in the copy are used once more
+          node = stack.pop()
+          if node.is_token and node.token in uses:
+            uses[node.token].append(node)
+          elif not node.is_token:
+            stack.extend(node.children)
+      siblings = token.parent.children
+      for i in range(len(siblings)):
+        if siblings[i] is token:
+          value.parent = token.parent
+          siblings[i] = value
+  for form in forms:
+    roots = _term_roots(form)
+    if roots:
+      terms, flags, keys = analysed.pop(id(form))
+      local_counts = {}
+      for term in terms:
+        if not term.is_token and not flags[id(term)][1]:
+          local_counts[keys[id(term)]] = local_counts.get(keys[id(term)], 0)+1
+      new = {} # id of a term -> what it becomes
+      term_sorts = {}
+      levels = {} # id of a term -> the most lets its new value is inside
+      bound = {} # key of a term -> (the name of the let binding made for it,
+                 #                its level)
+      bindings = [] # (level, name, value)
+      for term in terms:
+        inputs = _term_inputs(term) or []
+        value = term
+        if any(new[id(x)] is not x for x in inputs):
+          changed = dict((id(x), new[id(x)]) for x in inputs)
+          value = LispNode(children=[changed.get(id(x), x) 
+                                     for x in term.children])
+        term_sorts[id(term)] = _term_sort(term, 
+            [term_sorts[id(x)] for x in inputs], sorts)
+        level = max([levels[id(x)] for x in inputs] or [0])
+        key = keys[id(term)]
+        if term.is_token:
+          pass
+        elif flags[id(term)] == (False, False) and key in defined:
+          value = use(defined[key])
+        elif key in bound:
+          value = use(bound[key][0])
+          level = bound[key][1]
+        elif flags[id(term)] == (False, False) and level == 0 and\
+             term_sorts[id(term)] != None and saves(term, counts[key], 
+                 len("(define-fun  () )")+len(term_sorts[id(term)])):
+          name = fresh()
+          definitions[name] = LispNode(children=[LispNode("define-fun"), 
+              LispNode(token=name), LispNode("()"), 
+              LispNode(term_sorts[id(term)]), value])
+          document.insert_before(form, definitions[name])
+          sorts[name] = term_sorts[id(term)]
+          defined[key] = name
+          value = use(name)
+        elif not flags[id(term)][1] and saves(term, local_counts[key], 
+                                              len("(let ((  )) )")):
+          name = fresh()
+          level += 1
+          bound[key] = (name, level)
+          bindings.append((level, name, value))
+          value = use(name)
+        new[id(term)] = value
+        levels[id(term)] = level
+      for i in roots:
+        form.children[i] = new[id(form.children[i])]
+        form.children[i].parent = form
+      kept = []
+      for level, name, value in reversed(bindings):
+        if saves(value, len(uses[name]), len("(let ((  )) )")):
+          kept.insert(0, (level, name, value))
+          del uses[name]
+        else:
+          put_back(name, value)
+      lets += len(kept)
+      for level in sorted(set(level for level, name, value in kept), 
+                          reverse=True):
+        for i in roots:
+          form.children[i] = LispNode(children=[LispNode("let"), 
+              LispNode(children=[LispNode(children=[LispNode(token=name), 
+                                                    value])
+                                 for l, name, value in kept if l == level]),
+              form.children[i]], parent=form)
+    if not form.is_token and len(form.children) > 3 and\
+       form.children[0] in ["declare-fun", "define-fun"]:
+      sorts[str(form.children[1])] = str(form.children[3])
+  for name in sorted(uses, key=lambda name:int(name[4:]), reverse=True):
+    definition = definitions[name]
+    if not saves(definition.children[4], len(uses[name]), 
+                 len("(define-fun  () )")+definition.children[3].width()):
+      document.remove(definitions[name])
+      put_back(name, definitions[name].children[4])
+      del definitions[name]
+  after = sum(form.width()+1 for form in document.forms)
+  return before, after, len(definitions), lets
+
+def _literal(node):
+  "returns (value, width) of the BitVec literal token node node, or None"
+  if not node.is_token:
+    return None
+  token = node.token
+  if token.startswith("#b") and len(token) > 2:
+    return int(token[2:], 2), len(token)-2
+  if token.startswith("#x") and len(token) > 2:
+    return int(token[2:], 16), 4*(len(token)-2)
+  return None
+
+def _write_literal(value, width):
+  "returns the text of a BitVec literal of width bits with value value"
+  if width % 4 == 0:
+    return "#x"+("%x" % value).zfill(width/4)
+  return "#b"+bin(value)[2:].zfill(width)
+
+def _signed(value, width):
+  "returns value, a BitVec of width bits, read as two's complement"
+  if value >> (width-1):
+    return value - (1 << width)
+  return value
+
+def _fold(head, literals, max_width):
+  """returns (value, width) of the BitVec function head (a token node, or an 
+     indexed one like (_ extract 3 0)) of literals, a list of (value, width),
+     or True or False for a Bool one, or None if it can't (or the result
+     would be wider than max_width)"""
+  if not head.is_token:
+    if len(head.children) < 3 or not head.children[0] == "_" or\
+       len(literals) != 1 or\
+       not all(x.is_token and x.token.isdigit() for x in head.children[2:]):
+      return None
+    op = head.children[1].token
+    indices = [int(x.token) for x in head.children[2:]]
+    value, width = literals[0]
+    if op in ["repeat", "zero_extend", "sign_extend"] and\
+       (op == "repeat" and width*indices[0] or width+indices[0]) > max_width:
+      return None
+    if op == "extract" and len(indices) == 2:
+      return (value >> indices[1]) & ((1 << (indices[0]-indices[1]+1))-1),\
+             indices[0]-indices[1]+1
+    if op == "repeat":
+      return sum(value << (width*i) for i in range(indices[0])),\
+             width*indices[0]
+    if op == "zero_extend":
+      return value, width+indices[0]
+    if op == "sign_extend":
+      return _signed(value, width) % (1 << (width+indices[0])),\
+             width+indices[0]
+    if op in ["rotate_left", "rotate_right"] and width:
+      k = indices[0] % width
+      if op == "rotate_right":
+        k = (width-k) % width
+      return ((value << k) | (value >> (width-k))) & ((1 << width)-1), width
+    return None
+  op = head.token
+  widths = set(width for value, width in literals)
+  values = [value for value, width in literals]
+  if op == "concat":
+    value = 0
+    for v, width in literals:
+      value = (value << width) | v
+    return value, sum(width for v, width in literals)
+  if not literals or len(widths) != 1:
+    return None
+  width = widths.pop()
+  mask = (1 << width)-1
+  if op == "=":
+    return len(set(values)) == 1
+  if len(values) == 1 and op == "bvnot":
+    return ~values[0] & mask, width
+  if len(values) == 1 and op == "bvneg":
+    return -values[0] & mask, width
+  if op in ["bvand", "bvor", "bvxor", "bvadd", "bvmul"]:
+    combine = {"bvand":lambda x,y:x & y, "bvor":lambda x,y:x | y,
+               "bvxor":lambda x,y:x ^ y, "bvadd":lambda x,y:x + y,
+               "bvmul":lambda x,y:x * y}[op]
+    return reduce(combine, values) & mask, width
+  if len(values) != 2:
+    return None
+  x, y = values
+  if op == "bvsub":
+    return (x - y) & mask, width
+  if op == "bvshl":
+    return (x << y) & mask if y < width else 0, width
+  if op == "bvlshr":
+    return x >> y if y < width else 0, width
+  if op == "bvudiv":
+    return x / y if y else mask, width
+  if op == "bvurem":
+    return x % y if y else x, width
+  if op in ["bvult", "bvule", "bvugt", "bvuge"]:
+    return {"bvult":x < y, "bvule":x <= y, "bvugt":x > y, "bvuge":x >= y}[op]
+  if op in ["bvslt", "bvsle", "bvsgt", "bvsge"]:
+    x, y = _signed(x, width), _signed(y, width)
+    return {"bvslt":x < y, "bvsle":x <= y, "bvsgt":x > y, "bvsge":x >= y}[op]
+  return None
+
+def _simplified(term):
+  """returns a simpler node meaning the same as term (whose inputs are 
+     simplified already), or term if there isn't one it knows of"""
+  inputs = _term_inputs(term)
+  if not inputs:
+    return term
+  head = term.children[0]
+  literals = map(_literal, inputs)
+  if None not in literals:
+    value = _fold(head, literals, 4*term.width())
+    if isinstance(value, bool):
+      return LispNode(token=value and "true" or "false")
+    if value != None:
+      literal = _write_literal(*value)
+      if len(literal) <= term.width():
+        return LispNode(token=literal)
+  if not head.is_token:
+    if len(head.children) == 3 and head.children[0] == "_" and\
+       (head.children[1] == "zero_extend" and head.children[2] == "0" or
+        head.children[1] == "repeat" and head.children[2] == "1"):
+      return inputs[0]
+    return term
+  op = head.token
+  if op == "not" and inputs[0] in ["true", "false"]:
+    return LispNode(token=inputs[0] == "false" and "true" or "false")
+  if op == "not" and not inputs[0].is_token and inputs[0].children and\
+     inputs[0].children[0] == "not":
+    return inputs[0].children[1]
+  if op in ["and", "or"]:
+    unit, zero = op == "and" and ("true", "false") or ("false", "true")
+    if any(x == zero for x in inputs):
+      return LispNode(token=zero)
+    rest = [x for x in inputs if not x == unit]
+    if not rest:
+      return LispNode(token=unit)
+    if len(rest) == 1:
+      return rest[0]
+    if len(rest) < len(inputs):
+      return LispNode(children=[LispNode(token=op)]+rest)
+    return term
+  if op == "ite" and len(inputs) == 3:
+    condition, yes, no = inputs
+    if condition == "true" or yes == no:
+      return yes
+    if condition == "false":
+      return no
+    if yes == "true" and no == "false":
+      return condition
+    if yes == "false" and no == "true":
+      return LispNode(children=[LispNode(token="not"), condition])
+    return term
+  if op == "=" and len(inputs) == 2:
+    if inputs[0] == inputs[1]:
+      return LispNode(token="true")
+    for x, y in [inputs, inputs[::-1]]:
+      if x in ["true", "false"]:
+        if x == "true":
+          return y
+        return LispNode(children=[LispNode(token="not"), y])
+      # (= #b1 (ite c #b1 #b0)) is c
+      if _literal(x) != None and not y.is_token and len(y.children) == 4 and\
+         y.children[0] == "ite" and _literal(y.children[2]) != None and\
+         _literal(y.children[3]) != None:
+        yes = _literal(y.children[2]) == _literal(x)
+        no = _literal(y.children[3]) == _literal(x)
+        if yes and no:
+          return LispNode(token="true")
+        if yes:
+          return y.children[1]
+        if no:
+          return LispNode(children=[LispNode(token="not"), y.children[1]])
+        return LispNode(token="false")
+    return term
+  if op in ["bvor", "bvxor", "bvand"] and len(inputs) > 1:
+    # drop the inputs that don't matter (or, for bvand, a zero that does)
+    known = [_literal(x) for x in inputs]
+    if op == "bvand":
+      for x, value in zip(inputs, known):
+        if value != None and value[0] == 0:
+          return x
+      rest = [x for x, value in zip(inputs, known) 
+              if value == None or value[0] != (1 << value[1])-1]
+    else:
+      rest = [x for x, value in zip(inputs, known)
+              if value == None or value[0] != 0]
+    if not rest:
+      return inputs[0]
+    if len(rest) == 1:
+      return rest[0]
+    if len(rest) < len(inputs):
+      return LispNode(children=[LispNode(token=op)]+rest)
+  return term
+
+def simplify(document, rounds=4):
+  """rewrites the asserts and define-fun bodies of document, from the inside
+     out, folding operations on literals into literals (if those aren't 
+     longer) and taking out ite and = round trips and the like (see 
+     _simplified), again and again until nothing changes, or it has done so
+     rounds times. Returns (the rounds done, the bytes of the forms before,
+     and after)."""
+  forms = list(document.forms)
+  before = sum(form.width()+1 for form in forms)
+  done = 0
+  changed = True
+  while changed and done < rounds:
+    changed = False
+    done += 1
+    for form in forms:
+      terms = []
+      stack = [form.children[i] for i in _term_roots(form)]
+      while stack:
+        terms.append(stack.pop())
+        stack.extend(_term_inputs(terms[-1]) or [])
+      new = {} # id of a term -> what it becomes
+      for term in reversed(terms):
+        inputs = _term_inputs(term) or []
+        value = term
+        if any(new[id(x)] is not x for x in inputs):
+          replaced = dict((id(x), new[id(x)]) for x in inputs)
+          value = LispNode(children=[replaced.get(id(x), x) 
+                                     for x in term.children])
+        simpler = _simplified(value)
+        if simpler is not value:
+          value = simpler
+        new[id(term)] = value
+      for i in _term_roots(form):
+        if new[id(form.children[i])] is not form.children[i]:
+          changed = True
+          form.children[i] = new[id(form.children[i])]
+          form.children[i].parent = form
+  after = sum(form.width()+1 for form in forms)
+  return done, before, after
 
 
 def exists_replace(lispnode_list):
   " replaces (exists foo bar) with (not (forall foo (not bar))) "
   for lispnode in lispnode_list:
-    lispnode_index = lispnode_list.index(lispnode)
     for exists in lispnode.find("exists"):
       exists.parent.children = [LispNode("not", parent=exists.parent),
           LispNode(parent = exists.parent, children = [
@@ -175,23 +750,20 @@ def exists_replace(lispnode_list):
 
 
 
-def functions_boolean_output_to_bv(all_lines_list, lispnode_list):
+def functions_boolean_output_to_bv(document):
   """if any declared functions have Bool outputs, creates a new declared
      version with BitVec output, and defines the old function to read from the
      new one. In order to bias z3 towards functiosn returning "true" in cases
      where it doesn't matter, the bv version returns 0 when the original
      returns true"""
-  for lispnode in lispnode_list:
+  for lispnode in document.forms:
     for declare_fun in lispnode.find("declare-fun"):
       if declare_fun.parent.children[3] == "Bool":
-        lispnode_index = lispnode_list.index(lispnode)
-        all_lines_index = all_lines_list.index(lispnode)
-        lispnode_list.insert(lispnode_index, LispNode(children = 
+        document.insert_before(lispnode, LispNode(children = 
            [LispNode("declare-fun"),
             LispNode(str(declare_fun.parent.children[1])+"-bv-version"),
             LispNode(declare_fun.parent.children[2]),
             LispNode("(_ BitVec 1)")]))
-        all_lines_list.insert(all_lines_index, lispnode_list[lispnode_index])
         declare_fun.parent.children[0].token = "define-fun"
         for i in range(len(declare_fun.parent.children[2].children)):
           declare_fun.parent.children[2].children[i] = LispNode(
@@ -204,38 +776,167 @@ def functions_boolean_output_to_bv(all_lines_list, lispnode_list):
                          range(len(declare_fun.parent.children[2].children))))+
             "))"))
 
-def bv_functions_to_tables(all_lines_list, lispnode_list):
-  """turns all declare-fun with bv inputs and outputs into defined functions
-     that just look up stuff in a BV lookup value."""
-  name_counter = 0
-  for lispnode in lispnode_list:
-    lispnode_index = lispnode_list.index(lispnode)
-    all_lines_index = all_lines_list.index(lispnode)
-    for declare_fun in lispnode.find("declare-fun"):
-      # if this function's inputs and outputs are all bitvecs
-      if len(declare_fun.parent.children) > 3 and\
+def is_bv_function(declare_fun):
+  """returns whether the declare-fun token node declare_fun declares a 
+     function whose inputs and outputs are all bitvecs"""
+  return len(declare_fun.parent.children) > 3 and\
          len(declare_fun.parent.children[3].children) > 2 and\
          declare_fun.parent.children[3].children[1] == "BitVec" and\
          str(declare_fun.parent.children[2]) != "()" and\
          reduce(lambda x,y:x and (not y.is_token) and len(y.children) > 2 and \
                              y.children[1] == "BitVec", 
-                declare_fun.parent.children[2].children, True):
+                declare_fun.parent.children[2].children, True)
+
+# the ways bv_functions_to_tables can look up a function's value:
+# multiply: shift the table right by the concatenated inputs times the width
+#           of the output (bvmul), and extract the bottom of it
+# shift: the same, but when the output width is a power of two, shift by the
+#        concatenated inputs followed by zeros instead of multiplying
+# ite: a tree of ites over the bits of the inputs, with the table's slices
+#      (extract) at the leaves
+# entries: the same tree, with a fresh constant for each entry at the leaves,
+#          and no table
+# auto: whichever of multiply, shift and ite table_encoding_costs says is 
+#       cheapest, for each function
+TABLE_ENCODINGS = ["multiply", "shift", "ite", "entries", "auto"]
+
+# functions whose lookup table local_max_thresholds and 
+# local_max_thresholds_iterative read, so entries gives them an ite tree
+_TABLES_READ = ["thresholds-bv-version"]
+
+# how many bytes of output a gate a bit-blasting solver makes is taken to be
+# worth, and how many bytes auto lets the lookup of one function take
+# (unless nothing else fits)
+_GATE_BYTES = 8
+_AUTO_MAX_BYTES = 1 << 20
+# the most input bits a function may have for ite or entries, which write out
+# a leaf for every value of the inputs: wider ones use shift or multiply
+_TREE_MAX_ARG_BITS = 16
+
+def table_encoding_costs(arg_bits, sort_bits, name_length=20, inputs=1):
+  """returns a dictionary from each encoding (see TABLE_ENCODINGS, but for 
+     auto) of a function named with name_length characters, with inputs 
+     inputs of arg_bits bits in all, and sort_bits of output, to (nodes, 
+     bytes, widest, gates): about how many LispNodes and bytes its lookup 
+     table and definition take, the widest BitVec in them, and about how 
+     many gates a bit-blasting solver makes of it. shift is only there if
+     sort_bits is a power of two."""
+  entries = 2**arg_bits
+  num_bits = entries * sort_bits
+  # num_bits is written out a few times, and may be far too long to write
+  digits = int(arg_bits*math.log10(2) + math.log10(max(sort_bits, 1))) + 1
+  shifter = num_bits * (arg_bits + int(math.log(sort_bits, 2)) + 1)
+  costs = {}
+  costs["multiply"] = (30 + 6*inputs, 150 + 2*name_length + 30*inputs + 
+      3*digits, num_bits, shifter + num_bits*bin(sort_bits).count("1"))
+  if sort_bits & (sort_bits-1) == 0:
+    costs["shift"] = (25 + 6*inputs, 120 + 2*name_length + 30*inputs + 
+                      3*digits, num_bits, shifter)
+  # each leaf is ((_ extract hi lo) table), each other node 
+  # (ite (= ((_ extract j j) input) #b1) one zero)
+  costs["ite"] = (7*entries + 12*(entries-1) + 10 + 4*inputs, 
+                  (20 + name_length + 2*digits)*entries + 70*(entries-1) +
+                  60 + 2*name_length + 30*inputs + digits, 
+                  num_bits, (entries-1)*sort_bits)
+  # each leaf is a constant, declared as (declare-fun entry () (_ BitVec s))
+  costs["entries"] = (9*entries + 12*(entries-1) + 10 + 4*inputs, 
+                      (50 + 2*name_length + 2*digits)*entries + 
+                      70*(entries-1) + 30 + name_length + 30*inputs, 
+                      sort_bits, (entries-1)*sort_bits)
+  return costs
+
+def choose_table_encoding(arg_bits, sort_bits, name_length=20, inputs=1):
+  """returns the encoding auto uses for a function (see 
+     table_encoding_costs): the one of multiply, shift and ite with the 
+     fewest bytes plus _GATE_BYTES for each gate, of those whose bytes are
+     under _AUTO_MAX_BYTES"""
+  costs = table_encoding_costs(arg_bits, sort_bits, name_length, inputs)
+  choices = [(gates*_GATE_BYTES + size, encoding) 
+             for encoding, (nodes, size, widest, gates) in costs.items()
+             if encoding != "entries" and 
+                (size < _AUTO_MAX_BYTES or encoding == "multiply") and
+                (encoding != "ite" or arg_bits <= _TREE_MAX_ARG_BITS)]
+  return min(choices)[1]
+
+def table_encoding(encoding, name, arg_bits, sort_bits, inputs=1):
+  """returns the encoding bv_functions_to_tables uses, asked for encoding, 
+     for the function name (see table_encoding_costs): auto's choice, 
+     multiply for shift where sort_bits isn't a power of two, ite for entries
+     where the table is read (see _TABLES_READ), and shift or multiply for 
+     ite and entries where arg_bits is over _TREE_MAX_ARG_BITS"""
+  if encoding == "auto":
+    encoding = choose_table_encoding(arg_bits, sort_bits, len(name), inputs)
+  if encoding == "entries" and name in _TABLES_READ:
+    encoding = "ite"
+  if encoding in ["ite", "entries"] and arg_bits > _TREE_MAX_ARG_BITS:
+    encoding = "shift"
+  if encoding == "shift" and sort_bits & (sort_bits-1):
+    encoding = "multiply"
+  return encoding
+
+def _table_tree(leaves, input_bits):
+  """returns an ite tree over the bits of input_bits (token nodes holding the
+     inputs, and which bit of them: most significant first) choosing one of 
+     leaves, (a list of text, the lookup for each value of the inputs)"""
+  if not input_bits:
+    return leaves[0]
+  half = len(leaves)/2
+  name, bit = input_bits[0]
+  return "(ite (= ((_ extract "+str(bit)+" "+str(bit)+") "+name+") #b1) "+\
+         _table_tree(leaves[half:], input_bits[1:])+" "+\
+         _table_tree(leaves[:half], input_bits[1:])+")"
+
+def bv_functions_to_tables(document, encoding="multiply"):
+  """turns all declare-fun with bv inputs and outputs into defined functions
+     that just look up stuff in a BV lookup value (or, with the entries 
+     encoding, constants), in the way encoding (see TABLE_ENCODINGS) says."""
+  name_counter = 0
+  for lispnode in document.forms:
+    # each table goes just before lispnode, ahead of the ones added so far
+    before = document.handle(lispnode).prev
+    for declare_fun in lispnode.find("declare-fun"):
+      if is_bv_function(declare_fun):
         name = declare_fun.parent.children[1]
-        args = LispNode(declare_fun.parent.children[2]).children
+        args = share(declare_fun.parent.children[2]).children
         sort = declare_fun.parent.children[3]
         arg_bits = reduce(lambda x,y:x+int(str(y.children[2])), args, 0)
         sort_bits =int(str(sort.children[2]))
         num_bits = (2**arg_bits) * sort_bits
-        lispnode_list.insert(lispnode_index, 
-            LispNode("(declare-fun "+str(name)+"-lookup-table () (_ BitVec "+
-                     str(num_bits)+"))"))
-        all_lines_list.insert(all_lines_index, lispnode_list[lispnode_index])
+        chosen = table_encoding(encoding, str(name), arg_bits, sort_bits, 
+                                len(args))
+        if encoding in ["ite", "entries"] and chosen in ["shift", "multiply"]:
+          print "%s has %d input bits, too many for %s (at most %d): using %s"\
+                % (name, arg_bits, encoding, _TREE_MAX_ARG_BITS, chosen)
+        if chosen == "entries":
+          for i in reversed(range(2**arg_bits)):
+            document.insert_after(before, 
+                LispNode("(declare-fun "+str(name)+"-lookup-entry-"+str(i)+
+                         " () (_ BitVec "+str(sort_bits)+"))"))
+        else:
+          document.insert_after(before, 
+              LispNode("(declare-fun "+str(name)+"-lookup-table () (_ BitVec "+
+                       str(num_bits)+"))"))
         declare_fun.token="define-fun"
         for i in range(len(declare_fun.parent.children[2].children)):
           declare_fun.parent.children[2].children[i] = LispNode(
               parent = declare_fun.parent.children[2], 
               children = [LispNode("generated-input-name-"+str(i)), 
                           declare_fun.parent.children[2].children[i]])
+        if chosen in ["ite", "entries"]:
+          input_bits = [("generated-input-name-"+str(i), bit) 
+                        for i in range(len(args))
+                        for bit in reversed(range(int(str(
+                          args[i].children[2]))))]
+          if chosen == "ite":
+            leaves = ["((_ extract "+str((i+1)*sort_bits-1)+" "+
+                      str(i*sort_bits)+") "+str(name)+"-lookup-table)"
+                      for i in range(2**arg_bits)]
+          else:
+            leaves = [str(name)+"-lookup-entry-"+str(i) 
+                      for i in range(2**arg_bits)]
+          declare_fun.parent.children.append(LispNode(
+              _table_tree(leaves, input_bits), parent = declare_fun.parent))
+          continue
         sort_bits_expressed = \
             binaries(int(math.ceil(math.log((sort_bits+1), 2))))[sort_bits]
         sort_bits_expressed = LispNode(children=
@@ -247,6 +948,22 @@ def bv_functions_to_tables(all_lines_list, lispnode_list):
            [LispNode("concat"), z, LispNode(w.children[0])]), 
             declare_fun.parent.children[2].children[1:], 
             LispNode(declare_fun.parent.children[2].children[0].children[0]))
+        if chosen == "shift":
+          # times sort_bits is followed by log2(sort_bits) zeros
+          zeros = len(bin(sort_bits)) - 3
+          if zeros:
+            concat_args = LispNode(children=[LispNode("concat"), concat_args, 
+                LispNode("#b"+"0"*zeros)])
+          concat_args = LispNode(children=
+             [LispNode("concat"), 
+              bv_all_zero_1_in_ith_place(num_bits - arg_bits - zeros, 
+                                         num_bits), 
+              concat_args])
+          declare_fun.parent.children.append(LispNode(
+              "((_ extract "+str(sort_bits-1)+" 0) (bvlshr "+str(name)+\
+              "-lookup-table "+str(concat_args)+"))", 
+              parent = declare_fun.parent))
+          continue
         concat_args = LispNode(children=
            [LispNode("concat"), 
             bv_all_zero_1_in_ith_place(num_bits - arg_bits, num_bits), 
@@ -257,6 +974,29 @@ def bv_functions_to_tables(all_lines_list, lispnode_list):
             str(sort_bits_expressed)+")))", parent = declare_fun.parent))
 
 
+def forms_with_token(lispnode_list):
+  """returns a function of a token, giving the forms of lispnode_list with it
+     in them, in order (along with any with arena views in them, whose tokens
+     aren't indexed). It is made in one walk, so it only stays right while no
+     form gains a token it didn't have which is then looked up."""
+  forms = list(lispnode_list)
+  by_token = {}
+  unindexed = []
+  for i in range(len(forms)):
+    tokens = forms[i].tokens()
+    if tokens == None:
+      unindexed.append(i)
+    else:
+      for token in tokens:
+        by_token.setdefault(token, []).append(i)
+  def lookup(token):
+    if isinstance(token, LispNode):
+      if not token.is_token:
+        return forms
+      token = token.token
+    return [forms[i] for i in sorted(by_token.get(token, []) + unindexed)]
+  return lookup
+
 def replace_boolean_function_input(function_token, input_index, lispnode_list):
   """ Should replace the input_index th input of the function with the given
       function token with an if-than-else expression that takes the old
@@ -271,6 +1011,7 @@ def replace_boolean_function_input(function_token, input_index, lispnode_list):
 
 def define_fun_boolean_input(lispnode_list):
   "replace all define-fun functions with Bool inputs with BitVec 1 inputs"
+  forms_with = forms_with_token(lispnode_list)
   for lispnode in lispnode_list:
     for f in lispnode.find("define-fun"):
       if len(f.parent.children) > 3:
@@ -290,10 +1031,11 @@ def define_fun_boolean_input(lispnode_list):
               input_description.children[1] = LispNode("(_ BitVec 1)")
               input_description.children[1].parent = input_description
               replace_boolean_function_input(function_token, input_index,
-                                             lispnode_list)
+                                             forms_with(function_token))
 
 def declare_fun_boolean_input(lispnode_list):
   "replace all declare-fun functions with Bool inputs with BitVec 1 inputs"
+  forms_with = forms_with_token(lispnode_list)
   for lispnode in lispnode_list:
     for f in lispnode.find("declare-fun"):
       if len(f.parent.children) > 2:
@@ -305,9 +1047,9 @@ def declare_fun_boolean_input(lispnode_list):
             replacement.parent = f.parent.children[2]
             f.parent.children[2].children[input_index] = replacement
             replace_boolean_function_input(function_token, input_index,
-                                             lispnode_list)
+                                             forms_with(function_token))
 
-def declare_datatypes(all_lines_list, lispnode_list):
+def declare_datatypes(document):
   """ reads through the lispnode list, replacing all instances of
       declare-datatypes with no type arguments with finite value 
       declarations, as BitVectors.
@@ -319,15 +1061,13 @@ def declare_datatypes(all_lines_list, lispnode_list):
       returning values of this type stating that for all other inputs,
       the values returned by these functions must be at most the maximum
       possible replacment BitVec value.
-      all_lines_list: the set of all the lines in the file
-      lispnode_list: the set of just the lisp nodes in the file"""
-  for lispnode in lispnode_list:
+      document: the LispDocument of the file"""
+  for lispnode in document.forms:
     for declare in lispnode.find(LispNode("declare-datatypes")):
       if declare.parent.children[1] == LispNode("()"):
-        declare_index = all_lines_list.index(lispnode)
-        declare_index_lispnodes = lispnode_list.index(lispnode)
-        lispnode_list.remove(lispnode)
-        all_lines_list.remove(lispnode)
+        # the constants go where the declaration was
+        before = document.handle(lispnode).prev
+        document.remove(lispnode)
         declare.parent.is_token = True # this node becomes blank
         declare.parent.token = ""
         for datatype in declare.parent.children[2].children:
@@ -338,35 +1078,29 @@ def declare_datatypes(all_lines_list, lispnode_list):
             bins = map(lambda x:LispNode("#b"+x), binaries(n))
             # we have to add a clause to all "exists" thingies
             # and a forall for all functions that return these
-            for node in lispnode_list:
+            for node in document.forms:
               for type_name_instance in node.find(type_name):
                 if type_name_instance.parent != None:
                   # if there's a delcared function that returns this type
                   declare = type_name_instance.parent
                   if len(declare.children) > 3:
                     if declare.children[0] == "declare-fun":
-                      node_index = lispnode_list.index(node)
-                      node_all_index = all_lines_list.index(node) 
-                      lispnode_list.insert(node_index+1, 
-                        LispNode(children = [LispNode("assert"), 
+                      assertion = LispNode(children = [LispNode("assert"), 
                           LispNode(children = [LispNode("forall"), 
                             LispNode(children = map(
                               lambda x:LispNode(children=[
                                 LispNode("input-"+str(x)), 
-                                LispNode(declare.children[2].children[x])]), 
+                                share(declare.children[2].children[x])]), 
                               range(len(declare.children[2].children)))), 
                             LispNode("(bvule ("+str(declare.children[1])+" "+\
                              " ".join(map(lambda x:"input-"+str(x), 
                                range(len(declare.children[2].children))))+") "+\
-                             str(bins[len(type_values)-1])+")")])]))
-                      if lispnode_list[node_index+1].children[1].children[1] ==\
-                         "()":
-                        lispnode_list[node_index+1].children[1] = \
-                            lispnode_list[node_index+1].children[1].children[2]
-                        lispnode_list[node_index+1].children[1].parent = \
-                            lispnode_list[node_index+1]
-                      all_lines_list.insert(node_all_index+1, 
-                           lispnode_list[node_index+1])
+                             str(bins[len(type_values)-1])+")")])])
+                      if assertion.children[1].children[1] == "()":
+                        assertion.children[1] = \
+                            assertion.children[1].children[2]
+                        assertion.children[1].parent = assertion
+                      document.insert_after(node, assertion)
                   # if there's an exists of this type
                   if type_name_instance.parent.parent != None:
                     if type_name_instance.parent.parent.parent != None:
@@ -379,14 +1113,13 @@ def declare_datatypes(all_lines_list, lispnode_list):
                                   str(type_name_instance.parent.children[0])+\
                                   " "+str(bins[len(type_values)-1])+")"), \
                                   exists.children[2]])
-            for node in lispnode_list:
+            for node in document.forms:
               # replace the defined type with a bitvec
               node.replace(type_name, LispNode("(_ BitVec "+str(n)+")"))
             for i in range(len(type_values)):
               new_constant = LispNode("(define-const "+str(type_values[i])+\
                                      " (_ BitVec "+str(n)+") "+str(bins[i])+")")
-              lispnode_list.insert(declare_index_lispnodes, new_constant)
-              all_lines_list.insert(declare_index, new_constant)
+              document.insert_after(before, new_constant)
 
 def define_sort(lispnode_list):
   """reads through the lispnode list, replacing the sorts defined (provided they
@@ -405,7 +1138,11 @@ def define_sort(lispnode_list):
 
 def remove_parens_around_tokens(lispnode_list):
   "replaces any nodes with just a single token child with that token child"
-  for node in lispnode_list:
+  stack = list(lispnode_list)[::-1]
+  while stack:
+    node = stack.pop()
+    if node.is_view() and not node.has_singleton_lists():
+      continue # nothing to remove in here
     if node.is_token:
       while (node.parent != None) and (len(node.parent.children)==1):
         node.parent.token=node.token
@@ -413,19 +1150,116 @@ def remove_parens_around_tokens(lispnode_list):
         node.parent.children=[]
         node = node.parent
     else:
-      remove_parens_around_tokens(node.children)
+      stack.extend(reversed(node.children))
+
+def fix_get_model_line(line):
+  "returns line, with get-model at its start replaced with (get-model)"
+  if isinstance(line, LispNode) and not line.is_token:
+    return line # its text starts with (
+  if str(line).startswith("get-model"):
+    return "(get-model)"+(str(line)[len("get-model"):])
+  return line
 
-def fix_get_model(file_list):
+def fix_get_model(document):
   "replaces get-model with (get-model), provided its on a line of its own."
-  for i in range(len(file_list)):
-    if str(file_list[i]).startswith("get-model"):
-      file_list[i] = "(get-model)"+(str(file_list[i])[len("get-model"):])
+  for line in document.lines.handles():
+    document.replace(line, fix_get_model_line(line.value))
 
-def fix_check_sat(file_list):
+def fix_check_sat_line(line):
+  "returns line, with check-sat at its start replaced with (check-sat)"
+  if isinstance(line, LispNode) and not line.is_token:
+    return line # its text starts with (
+  if str(line).startswith("check-sat"):
+    return "(check-sat)"+(str(line)[len("check-sat"):])
+  return line
+
+def fix_check_sat(document):
   "replaces check-sat with (check-sat), provided its on a line of its own."
-  for i in range(len(file_list)):
-    if str(file_list[i]).startswith("check-sat"):
-      file_list[i] = "(check-sat)"+(str(file_list[i])[len("check-sat"):])
+  for line in document.lines.handles():
+    document.replace(line, fix_check_sat_line(line.value))
+
+def _file_text_blocks(f):
+  """yields the text of file f a block at a time, the way lisp_file_comments
+     has always seen it: each line after a newline (so every newline but a
+     final one is doubled)"""
+  text = "\n"
+  newline_held = False # whether the last block ended with a newline
+  while True:
+    block = f.read(_BLOCK_SIZE)
+    if not block:
+      break
+    if newline_held:
+      text += "\n\n"
+    newline_held = block.endswith("\n")
+    if newline_held:
+      block = block[:-1]
+    yield text + block.replace("\n", "\n\n")
+    text = ""
+  if newline_held:
+    yield "\n"
+
+def lisp_file_forms(filename, comment="#"):
+  """reads input file filename a block at a time, with comment character 
+     comment (default #), and yields, as it goes, the strings between top 
+     level lisp expressions (comments and such) and those expressions, 
+     parsed. Only the expression or string being read is kept in memory.
+     (see lisp_file_comments)"""
+  events = re.compile("|".join(([re.escape(comment)] if comment else []) + 
+                               ["[()]"]))
+  lookahead = max(len(comment or ""), 1)
+  read = []     # the text of what's being read, from before buf
+  buf = ""
+  start = 0     # where what's being read starts in buf (if read is empty)
+  i = 0         # where to look next in buf
+  depth = 0
+  in_comment = False
+  done = False
+  f = open(filename, "r")
+  try:
+    blocks = _file_text_blocks(f)
+    while True:
+      if in_comment:
+        end = buf.find("\n", i)
+        if end >= 0:
+          i = end
+          in_comment = False
+          continue
+        i = len(buf)
+      else:
+        match = events.search(buf, i)
+        # a match too near the end might be the start of a longer comment
+        if match and (done or match.start()+lookahead <= len(buf)):
+          i = match.start()
+          if comment and buf.startswith(comment, i):
+            in_comment = True
+            continue
+          if buf[i] == "(":
+            depth += 1
+            if depth == 1:
+              yield "".join(read)+buf[start:i]
+              read = []
+              start = i
+          else:
+            depth -= 1
+            if depth == 0:
+              yield lisp_parse("".join(read)+buf[start:i+1], comment)
+              read = []
+              start = i+1
+          i += 1
+          continue
+        i = max(i, len(buf)-lookahead+1)
+      if done:
+        break
+      block = next(blocks, None)
+      if block is None:
+        done = True
+        continue
+      read.append(buf[start:i])
+      buf = buf[i:] + block
+      start = i = 0
+    yield "".join(read)+buf[start:]
+  finally:
+    f.close()
 
 def lisp_file_comments(filename, comment="#", execute_on_lisp = None):
   """ reads input file filename with comment character comment (default #)
@@ -438,29 +1272,11 @@ def lisp_file_comments(filename, comment="#", execute_on_lisp = None):
     execute_on_lisp = lambda x:x
   answer = []
   lispnodes = []
-  depth = 0
-  open_paren = 0
-  content = (reduce(lambda x,y:x+"\n"+y, open(filename,"r"),""))
-  i=0
-  while i < (len(content)):
-    if content[i:].startswith(comment):
-      while (i < len(content)) and (content[i] != '\n'):
-        i += 1
-    else:
-      if content[i] == '(':
-        depth += 1
-        if depth == 1:
-          answer.append(content[open_paren:i])
-          open_paren = i
-      if content[i] == ')':
-        depth -= 1
-        if depth == 0:
-          a=(execute_on_lisp(lisp_parse(content[open_paren:i+1], comment)))
-          answer.append(a)
-          lispnodes.append(a)
-          open_paren = i+1
-      i+=1
-  answer.append(content[open_paren:])
+  for x in lisp_file_forms(filename, comment):
+    if isinstance(x, LispNode):
+      x = execute_on_lisp(x)
+      lispnodes.append(x)
+    answer.append(x)
   return answer, lispnodes
 
 def get_n(lispnode_list):
@@ -479,21 +1295,20 @@ def get_n(lispnode_list):
   return 0
 
 
-def local_max_thresholds(all_lines_list, lispnode_list):
+def local_max_thresholds(document):
   """adds the requirement that flipping any 1 of thresholds to 0 fails 
      assertions. Must be done after functions to tables but before 
      exists and forall unrolling"""
   all_requirements = LispNode(children = [LispNode("and")] + 
       map(lambda x:LispNode(x.children[1]), 
           filter(lambda y: (len(y.children) > 1) and (y.children[0]=="assert"),
-                  lispnode_list)))
+                  document.forms)))
   # get the length of the lookup table, and thresholds functions
   len_lookup = 0
-  thresholds_all_index = 0
-  thresholds_index = 0
+  thresholds_line = document.first
   thresholds_bv = LispNode("")
   thresholds = LispNode("")
-  for lispnode in lispnode_list:
+  for lispnode in document.forms:
     for node in lispnode.find("thresholds-bv-version-lookup-table"):
       if node.parent.children[0] == "declare-fun":
         len_lookup = int(str(node.parent.children[3].children[2]))
@@ -502,8 +1317,7 @@ def local_max_thresholds(all_lines_list, lispnode_list):
         thresholds_bv = LispNode(node.parent)
     for node in lispnode.find("thresholds"):
       if node.parent.children[0] == "define-fun":
-        thresholds_all_index = all_lines_list.index(lispnode)
-        thresholds_index = lispnode_list.index(lispnode)
+        thresholds_line = document.handle(lispnode)
         thresholds = LispNode(node.parent)
   # create a new function, threshholds-with-table, that is like thresholds but
   # takes as its last input a lookup table
@@ -540,7 +1354,8 @@ def local_max_thresholds(all_lines_list, lispnode_list):
       thresholds.token="thresholds-with-table"
       thresholds.parent.children.append(LispNode(adapted_table,
                                                  parent=thresholds.parent))
-  lispnode_list.insert(thresholds_index, LispNode(children=
+  # add our functions to the file, each before the last
+  before = document.insert_before(thresholds_line, LispNode(children=
   [LispNode("assert"),
    LispNode(children = 
      [LispNode("not"),
@@ -554,18 +1369,14 @@ def local_max_thresholds(all_lines_list, lispnode_list):
             LispNode("(not (= thresholds-bv-version-lookup-table "+\
                               str(adapted_table)+"))"), 
             all_requirements])])])]))
-  # add our functions to the file
-  all_lines_list.insert(thresholds_all_index, lispnode_list[thresholds_index])
-  lispnode_list.insert(thresholds_index, new_thresholds)
-  all_lines_list.insert(thresholds_all_index, new_thresholds)
-  lispnode_list.insert(thresholds_index, new_thresholds_bv)
-  all_lines_list.insert(thresholds_all_index, new_thresholds_bv)
+  before = document.insert_before(before, new_thresholds)
+  document.insert_before(before, new_thresholds_bv)
 
 
-def local_max_thresholds_iterative(all_lines_list, lispnode_list,model,solver):
-  define_funs_from_model(model, lispnode_list)
+def local_max_thresholds_iterative(document,model,solver,cache=None):
+  define_funs_from_model(model, document.forms)
   thresholds_lookup = LispNode("")
-  for lispnode in lispnode_list:
+  for lispnode in document.forms:
     for node in lispnode.find("thresholds-bv-version-lookup-table"):
       if node.parent.children[0] == "define-fun":
         thresholds_lookup = node.parent.children[4]
@@ -581,22 +1392,16 @@ def local_max_thresholds_iterative(all_lines_list, lispnode_list,model,solver):
       f_name = ("/tmp/iteration-"+\
                str("-".join(str(datetime.datetime.now()).split()))+".smt2")
       f = open(f_name,"w")
-      for x in map(lambda x:str(x).strip(),all_lines_list):
-        if (len(x) > 0):
-          if (x[0] == "("):
-            x = LispNode(x).pretty_print()
-        f.write(x)
-        f.write("\n")
+      write_qf_bv(document.lines, f)
       f.flush() 
       f.close() 
       model_filename = "/tmp/iteration-model"+\
                str("-".join(str(datetime.datetime.now()).split()))+".smt2"
-      os.system(solver+" "+f_name+" > "+ model_filename)
+      run_solver(solver, f_name, model_filename, cache)
       m = open(model_filename,"r").read()
       m = m.strip()
       if m.startswith("sat"):
-        return local_max_thresholds_iterative(all_lines_list, lispnode_list,
-                                              LispNode(m[3:]), solver)
+        return local_max_thresholds_iterative(document, m[3:], solver, cache)
       elif m.startswith("unsat"):
         thresholds_lookup.token = thresholds_lookup.token[     :bit]+"1"+\
                                   thresholds_lookup.token[bit+1:   ]
@@ -606,23 +1411,428 @@ def local_max_thresholds_iterative(all_lines_list, lispnode_list,model,solver):
   return thresholds_lookup.token
 
 
-def append_analysis(n, all_lines_list, lispnode_list):
+# the commands a solver answers
+_ANSWERED = re.compile(r"\((check-sat|get-|echo|exit)")
+
+def _session_prefix(document, table):
+  """returns the QF_BV text of document for a solver session: without the
+     commands which would answer (check-sats, get-models, get-values, ...),
+     and with the define-fun table (if not None) as a declare-fun, so that 
+     the session can assert values for it"""
+  lines = []
+  for line in document.lines:
+    if line is table:
+      line = LispNode(children=[LispNode(token="declare-fun"), 
+                                LispNode(table.children[1]), LispNode("()"),
+                                LispNode(table.children[3])])
+    text = str(line).strip()
+    if not _ANSWERED.match(text):
+      lines.append(line)
+  f = StringIO()
+  write_qf_bv(lines, f, comments=False)
+  return f.getvalue()
+
+def _thresholds_table(document, model):
+  """defines the functions declared in document as model says, and returns
+     (the define-fun of thresholds-bv-version-lookup-table, or None, its 
+     value, as a #b token)"""
+  define_funs_from_model(model, document.forms)
+  thresholds_lookup = LispNode("")
+  table = None
+  for lispnode in document.forms:
+    for node in lispnode.find("thresholds-bv-version-lookup-table"):
+      if node.parent.children[0] == "define-fun":
+        table = node.parent
+        thresholds_lookup = node.parent.children[4]
+  if thresholds_lookup.token.startswith("#x"):
+    thresholds_lookup.token = "#b"+hex_to_binary(thresholds_lookup.token[2:])
+  return table, thresholds_lookup
+
+def local_max_thresholds_session(document, model, session):
+  """does what local_max_thresholds_iterative does, but asks the 
+     pysolver.SolverSession session about each bit: the document is sent 
+     once, and each flip is asserted in a scope of its own, and checked"""
+  table, thresholds_lookup = _thresholds_table(document, model)
+  if table == None:
+    return thresholds_lookup.token
+  session.send(_session_prefix(document, table))
+  token = thresholds_lookup.token
+  bit = 2
+  while bit < len(token):
+    if token[bit] == "1":
+      print bit
+      flipped = token[:bit]+"0"+token[bit+1:]
+      session.push()
+      session.send("(assert (= thresholds-bv-version-lookup-table "+flipped+
+                   "))")
+      answer = session.check_sat()
+      session.pop()
+      if answer == "sat":
+        # like local_max_thresholds_iterative, start over from the first bit
+        token = flipped
+        bit = 2
+        continue
+      elif answer != "unsat":
+        print "ITERATIVE SOLVER FAILED:\n"+answer
+        break
+    bit += 1
+  thresholds_lookup.token = token
+  return token
+
+
+def local_max_thresholds_parallel(document, model, pool):
+  """does what local_max_thresholds_session does, with the sessions of the 
+     pysolver.SolverPool pool each trying a different bit at once. The 
+     answers are taken in the order of the bits, so the first bit which can
+     be flipped is, as before: then the bits the others are trying are 
+     stale, so they are cancelled, and all start over from the first bit"""
+  table, thresholds_lookup = _thresholds_table(document, model)
+  if table == None:
+    return thresholds_lookup.token
+  pool.send_all(_session_prefix(document, table))
+  token = thresholds_lookup.token
+  flipped = lambda bit:token[:bit]+"0"+token[bit+1:]
+  bits = [bit for bit in range(2, len(token)) if token[bit] == "1"]
+  tried = 0 # how many of bits have been handed out
+  done = 0 # how many of bits have been answered, in order
+  answers = {}
+  working = {} # session index: the bit it is trying
+  while done < len(bits):
+    for i in pool.idle():
+      if tried < len(bits):
+        working[i] = bits[tried]
+        pool.check(i, "(assert (= thresholds-bv-version-lookup-table "+
+                      flipped(bits[tried])+"))")
+        tried += 1
+    for i, answer in pool.wait():
+      answers[working.pop(i)] = answer
+    while done < len(bits) and bits[done] in answers:
+      bit = bits[done]
+      print bit
+      answer = answers[bit]
+      if answer == "sat":
+        token = flipped(bit)
+        bits = [bit for bit in range(2, len(token)) if token[bit] == "1"]
+      elif answer != "unsat":
+        print "ITERATIVE SOLVER FAILED:\n"+answer
+        bits = []
+      else:
+        done += 1
+        continue
+      for i in working:
+        pool.cancel(i)
+      working = {}
+      answers = {}
+      tried = 0
+      done = 0
+  thresholds_lookup.token = token
+  return token
+
+
+def local_max_thresholds_bisect(document, model, session, block=16):
+  """does what local_max_thresholds_session does, but checks up to block 
+     bits at a time: one check asks whether any one of them can be flipped,
+     and only if one can is the block cut in halves, the first half checked
+     first, to find the first such bit. After flipping it, it goes on from 
+     the next bit, rather than starting over, and passes over the bits until
+     a pass flips none, so the table is as locally maximal as before"""
+  table, thresholds_lookup = _thresholds_table(document, model)
+  if table == None:
+    return thresholds_lookup.token
+  session.send(_session_prefix(document, table))
+  token = thresholds_lookup.token
+  def check(bits):
+    "returns the answer to whether flipping any one of bits can be done"
+    flips = ["(= thresholds-bv-version-lookup-table "+token[:bit]+"0"+
+             token[bit+1:]+")" for bit in bits]
+    session.push()
+    session.send("(assert "+(flips[0] if len(flips) == 1 else 
+                             "(or "+" ".join(flips)+")")+")")
+    answer = session.check_sat()
+    session.pop()
+    return answer
+  flipped = True
+  failed = False
+  while flipped and not failed:
+    flipped = False
+    start = 2
+    while not failed:
+      bits = [bit for bit in range(start, len(token)) 
+              if token[bit] == "1"][:block]
+      if not bits:
+        break
+      answer = check(bits)
+      while answer == "sat" and len(bits) > 1:
+        half = bits[:len(bits)/2]
+        answer = check(half)
+        if answer == "sat":
+          bits = half
+        elif answer == "unsat":
+          bits = bits[len(half):]
+          answer = "sat"
+      if answer == "sat":
+        token = token[:bits[0]]+"0"+token[bits[0]+1:]
+        flipped = True
+      elif answer != "unsat":
+        print "ITERATIVE SOLVER FAILED:\n"+answer
+        failed = True
+      start = bits[-1]+1
+  thresholds_lookup.token = token
+  return token
+
+def _selector(bit, width, value):
+  """returns the literal saying bit (an index into a #b token of width bits)
+     of thresholds-bv-version-lookup-table is value ("1" or "0")"""
+  selector = "thresholds-selector-"+str(width+1-bit)
+  return selector if value == "1" else "(not "+selector+")"
+
+def local_max_thresholds_assume(document, session):
+  """does what local_max_thresholds does, with the pysolver.SolverSession 
+     session, rather than a quantifier: document (converted without 
+     local_max_thresholds) is sent once, with one Bool selector for each bit
+     of thresholds-bv-version-lookup-table, true when the bit is 1. Once it
+     is solved, each flip is a check-sat-assuming the selectors of the 
+     table with that bit flipped. When one is unsat, the assumptions the 
+     solver says it needed are kept, and the flips which would assume all 
+     of them (bits only go from 1 to 0) aren't checked. Starts over from 
+     the first bit after a flip, as local_max_thresholds_iterative does.
+     As there (see define_funs_from_model), the other functions declared 
+     without inputs keep the values the first check gave them: they are 
+     asserted before any flip.
+     Returns the table, as a #b token, or the answer to the first check if 
+     that isn't sat (or to get-value, if that's an error), or None if there
+     is no table. The session is left with
+     the table asserted (if any), and checked, for get-model."""
+  width = 0
+  others = [] # the names of the other functions declared without inputs
+  for lispnode in document.forms:
+    if not lispnode.is_token and len(lispnode.children) > 3 and\
+       lispnode.children[0] == "declare-fun" and\
+       str(lispnode.children[2]) == "()":
+      if lispnode.children[1] == "thresholds-bv-version-lookup-table":
+        width = int(str(lispnode.children[3].children[2]))
+      else:
+        others.append(str(lispnode.children[1]))
+  session.send("(set-option :produce-unsat-assumptions true)")
+  session.send(_session_prefix(document, None))
+  for i in range(width):
+    session.send("(declare-fun thresholds-selector-%d () Bool)\n" % i+
+                 "(assert (= thresholds-selector-%d (= ((_ extract %d %d) " % 
+                 (i, i, i)+"thresholds-bv-version-lookup-table) #b1)))")
+  answer = session.check_sat()
+  if answer != "sat":
+    return answer
+  if width == 0:
+    return None
+  # all read in one get-value, as asserting anything drops the model
+  values = session.ask("(get-value (thresholds-bv-version-lookup-table"+
+                       "".join(" "+name for name in others)+"))")
+  if values.startswith("(error"):
+    return values
+  values = LispNode(values).children
+  token = str(values[0].children[1])
+  for pair in values[1:]:
+    session.send("(assert (= "+str(pair.children[0])+" "+
+                 str(pair.children[1])+"))")
+  if token.startswith("#x"):
+    token = "#b"+hex_to_binary(token[2:])
+  cores = []
+  bit = 2
+  while bit < len(token):
+    if token[bit] == "1":
+      flipped = token[:bit]+"0"+token[bit+1:]
+      assumptions = [_selector(i, width, flipped[i]) 
+                     for i in range(2, len(flipped))]
+      assumed = set(assumptions)
+      if not [core for core in cores if core <= assumed]:
+        answer = session.check_sat(assumptions)
+        if answer == "sat":
+          token = flipped
+          bit = 2
+          continue
+        elif answer == "unsat":
+          core = session.ask("(get-unsat-assumptions)")
+          if not core.startswith("(error"):
+            cores.append(set(str(literal) for literal in 
+                             LispNode(core).children))
+        else:
+          print "ITERATIVE SOLVER FAILED:\n"+answer
+          break
+    bit += 1
+  session.send("(assert (= thresholds-bv-version-lookup-table "+token+"))")
+  session.check_sat()
+  return token
+
+class QFBVText(str):
+  "QF_BV text, as write_qf_bv wrote it, which write_qf_bv writes as it is"
+
+def write_qf_bv(all_lines_list, f, comments=True):
+  """writes each of all_lines_list to the file object f, on a line of its 
+     own: lisp nodes are pretty printed straight from the tree, strings of 
+     lisp are parsed and pretty printed, and anything else (comments) is 
+     written as is, stripped, unless comments is False. Empty lines are left
+     out. QFBVText is written just as it is."""
+  for x in all_lines_list:
+    if isinstance(x, QFBVText):
+      f.write(x)
+      continue
+    if isinstance(x, LispNode) and not x.is_token:
+      # blanked tokens are left out as it goes, so there's nothing to reparse
+      x.write(f, pretty=True)
+      f.write("\n")
+      continue
+    x = str(x).strip()
+    if len(x) > 0 and x[0] == "(":
+      LispNode(x).write(f, pretty=True)
+      f.write("\n")
+    elif len(x) > 0 and comments:
+      f.write(x)
+      f.write("\n")
+
+# a comment, or a token of SMT-LIB text
+_SMT_TOKEN = re.compile(r';[^\n]*|\(|\)|\|[^|]*\||"(?:[^"]|"")*"|[^\s();]+')
+# the heads of the forms which bind names, and which of their children is 
+# the list of them (each name first in a list of its own)
+_BINDERS = {"let":1, "forall":1, "exists":1, "define-fun":2}
+
+def _smt_tokens(f):
+  """yields the tokens (and comments) of the SMT-LIB text in the file object
+     f, read _BLOCK_SIZE characters at a time. Each block is scanned up to
+     its last line break, the rest being carried over to the next, so only 
+     strings and |symbols| with line breaks in them can be split."""
+  carry = ""
+  while True:
+    block = f.read(_BLOCK_SIZE)
+    if not block:
+      break
+    end = block.rfind("\n") + 1
+    if end == 0:
+      carry += block
+      continue
+    for m in _SMT_TOKEN.finditer(carry + block[:end]):
+      yield m.group()
+    carry = block[end:]
+  for m in _SMT_TOKEN.finditer(carry):
+    yield m.group()
+
+def _canonical_strings(tokens):
+  """yields strings which, joined together, are the canonical_smt of the 
+     SMT-LIB text with the tokens (and comments) tokens"""
+  last = None # the last string yielded
+  # for each open list: [its head, how many children it has had so far, 
+  # (name, canonical name) it binds]
+  frames = []
+  bound = {} # name: the canonical names it has, innermost last
+  depth = 0 # how many names are bound
+  for token in tokens:
+    if token[0] == ";":
+      continue
+    if last != None and not last == "(" and not token == ")":
+      yield " "
+    if token == "(":
+      if frames:
+        frames[-1][1] += 1
+      frames.append([None, 0, []])
+      last = token
+      yield token
+      continue
+    if token == ")":
+      names = frames.pop()[2]
+      if names:
+        # the end of a binder: its names aren't bound any more
+        for name, canonical in names:
+          bound[name].pop()
+        depth -= len(names)
+      elif frames and frames[-1][2] and \
+           frames[-1][1]-1 == _BINDERS.get(frames[-1][0]):
+        # the end of the list of names: they are bound from here on
+        for name, canonical in frames[-1][2]:
+          bound.setdefault(name, []).append(canonical)
+        depth += len(frames[-1][2])
+      last = token
+      yield token
+      continue
+    if frames:
+      frames[-1][1] += 1
+      if frames[-1][0] == None:
+        frames[-1][0] = token
+    if len(frames) > 2 and frames[-1][1] == 1 and \
+       frames[-3][1]-1 == _BINDERS.get(frames[-3][0]):
+      names = frames[-3][2]
+      names.append((token, "!"+str(depth+len(names))))
+      last = names[-1][1]
+      yield last
+      continue
+    names = bound.get(token)
+    last = names[-1] if names else token
+    yield last
+
+def canonical_smt(text):
+  """returns SMT-LIB text as canonical text: without comments, spaced 
+     alike, and with the names bound by lets, quantifiers and the inputs of
+     define-funs named by how many names are bound around them, so that 
+     texts which differ only in those names are the same"""
+  return "".join(_canonical_strings(m.group() for m in 
+                                    _SMT_TOKEN.finditer(text)))
+
+def canonical_smt_digest(f):
+  """returns the hex digest of the canonical_smt of the text in the file 
+     object f, read a block at a time, without ever making the whole text"""
+  h = hashlib.sha1()
+  strings = _canonical_strings(_smt_tokens(f))
+  while True:
+    block = list(itertools.islice(strings, 1 << 12))
+    if not block:
+      return h.hexdigest()
+    h.update("".join(block))
+
+def run_solver(solver, qf_bv_filename, model_filename, cache=None):
+  """runs the shell command line solver (or pysolver.Portfolio) on 
+     qf_bv_filename, writing what it says to model_filename. With cache (a
+     pycache.DiskCache), what it says (when that is sat or unsat) is kept 
+     under solver and the canonical_smt_digest of the file, and written out
+     again rather than running solver on the same problem again"""
+  if cache != None:
+    f = open(qf_bv_filename)
+    try:
+      key = cache_key(str(solver), canonical_smt_digest(f))
+    finally:
+      f.close()
+    text = cache.get(key)
+    if text != None:
+      open(model_filename, "w").write(text)
+      return
+  if isinstance(solver, Portfolio):
+    open(model_filename, "w").write(solver.run(qf_bv_filename))
+  else:
+    os.system(solver+" "+qf_bv_filename+" > "+model_filename)
+  if cache != None:
+    text = open(model_filename).read()
+    if text.lstrip().startswith("sat") or text.lstrip().startswith("unsat"):
+      cache.put(key, text)
+
+def append_analysis(n, document):
   "append the analysis code that will print out the values from thresholds"
-  index = -1
-  for line in all_lines_list:
-    if str(line).startswith("check-sat") or str(line).startswith("(check-sat)"):
-      index = all_lines_list.index(line)
+  # it goes before the last check-sat (or else the last line), with each line
+  # ahead of the ones added so far
+  check_sat = document.last
+  for line in document.lines.handles():
+    if str(line.value).startswith("check-sat") or \
+       str(line.value).startswith("(check-sat)"):
+      check_sat = line
+  before = check_sat.prev if check_sat != None else None
   for t in ['Decision', 'Change', 'Availability', 'Truth']:
     for i in range(n):
       bin_i = str(binaries(int(math.ceil(math.log(n,2))))[i])
       for b in sbinaries(n):
-        all_lines_list.insert(index,"(assert (= thresholds-"+t+"-"+str(i)+"-"+b+\
-           " (thresholds "+t+" #b"+bin_i+" #b"+b+")))")
-        all_lines_list.insert(index, "(declare-fun thresholds-"+t+"-"+str(i)+\
-           "-"+b+" () Bool)")
+        document.insert_after(before, "(assert (= thresholds-"+t+"-"+str(i)+\
+           "-"+b+" (thresholds "+t+" #b"+bin_i+" #b"+b+")))")
+        document.insert_after(before, "(declare-fun thresholds-"+t+"-"+\
+           str(i)+"-"+b+" () Bool)")
 
-def perform_analysis(n,model, html_filename):
-  "writes analysis visualization html file, and opens firefox to that file"
+def perform_analysis(n, values, html_filename):
+  """writes analysis visualization html file, and opens firefox to that file,
+     from values, the values in the model (see read_model)"""
   w = open(html_filename, "w")
   w.write("<html>\n<body>\n<table>")
   for t in ['Decision', 'Change', 'Availability', 'Truth']:
@@ -634,8 +1844,7 @@ def perform_analysis(n,model, html_filename):
     for i in range(n):
       w.write("<tr><td>"+str(i)+"</td>")
       for b in sbinaries(n):
-        possibles = model.find("thresholds-"+t+"-"+str(i)+"-"+b)
-        if (len(possibles)>0) and possibles[0].parent.children[4] == "false":
+        if values.get("thresholds-"+t+"-"+str(i)+"-"+b) is False:
           w.write("<td bgcolor=\"black\">&nbsp;</td>")
         else:
           w.write("<td bgcolor=\"green\">&nbsp;</td>")
@@ -646,14 +1855,11 @@ def perform_analysis(n,model, html_filename):
   os.system("firefox "+html_filename+" &")
 
 
-def prepend_headers(all_lines_list, lispnode_list):
+def prepend_headers(document):
   "prepend appropriate headers for QF_BV logic"
-  lispnode_list.insert(0,LispNode("(set-option :produce-models true)"))
-  all_lines_list.insert(0,lispnode_list[0])
-  lispnode_list.insert(0,LispNode("(set-logic QF_BV)"))
-  all_lines_list.insert(0,lispnode_list[0])
-  lispnode_list.insert(0,LispNode("(set-info :smt-lib-version 2.0)"))
-  all_lines_list.insert(0,lispnode_list[0])
+  document.insert_after(None, LispNode("(set-option :produce-models true)"))
+  document.insert_after(None, LispNode("(set-logic QF_BV)"))
+  document.insert_after(None, LispNode("(set-info :smt-lib-version 2.0)"))
 
 def replace_true(lispnode_list):
   "replace the token true with (= #b1 #b1)"
@@ -665,18 +1871,550 @@ def replace_false(lispnode_list):
   for lispnode in lispnode_list:
     lispnode.replace("false", "(= #b0 #b1)")
 
+# a name, and a token or list of tokens, in a model
+_NAME = r"([^\s()|]+|\|[^|]*\|)\s+"
+_TERM = r"([^\s()]+|\([^()]*\))"
+# (define-fun name () sort value) in a model
+_MODEL_ENTRY = re.compile(r"\(define-fun\s+"+_NAME+r"\(\)\s+"+_TERM+r"\s+"+
+                          _TERM+r"\s*\)")
+# (name value) in an answer to get-value
+_GOT_VALUE = re.compile(r"\(\s*"+_NAME+_TERM+r"\s*\)")
+
+def _model_entries(text):
+  """returns a list of (name, sort, value) texts of the functions without 
+     inputs the model (or get-value answer, with None sorts) text defines"""
+  if "define-fun" in text:
+    return _MODEL_ENTRY.findall(text)
+  return [(name, None, value) for name, value in _GOT_VALUE.findall(text)]
+
+def _model_value(text):
+  """returns the value the text of a model gives: True or False for a Bool,
+     (value, width) for a BitVec (as _literal gives), an int for a numeral, 
+     or else the text"""
+  if text == "true":
+    return True
+  if text == "false":
+    return False
+  if text.startswith("#b") and len(text) > 2:
+    return int(text[2:], 2), len(text)-2
+  if text.startswith("#x") and len(text) > 2:
+    return int(text[2:], 16), 4*(len(text)-2)
+  if text.startswith("(_ bv"):
+    value, width = text[5:-1].split()
+    return int(value), int(width)
+  if text.isdigit():
+    return int(text)
+  return text
+
+def read_model(text):
+  """returns a dict from the names to the values (see _model_value) of the
+     functions without inputs in text, a model from a solver, or its answer
+     to get-value, read in one pass"""
+  return dict((name, _model_value(value)) 
+              for name, sort, value in _model_entries(text))
+
 def define_funs_from_model(model, lispnode_list):
-  "given a model from a solver, replace all declare-fun s with definitions"
-  for define in model.find("define-fun"):
-    definition = define.parent
-    for lispnode in lispnode_list:
-      for declare in lispnode.find(definition.children[1]):
-        if declare.parent.children[0] == "declare-fun":
-          declare.parent.children = definition.children
-          for child in declare.parent.children:
-            child.parent = declare.parent
-          declare.parent.token = definition.token
-          declare.parent.is_token = definition.is_token
+  """given a model from a solver, replace all declare-fun s with definitions.
+     If model is a LispNode, they share its define-funs' values (so changing
+     the values in the definitions changes the model, though not its cached
+     widths, so print it from its text); otherwise it is the text
+     of the model, or of an answer to get-value (whose sorts are taken from
+     the declarations), read as read_model does (unless there are functions
+     with inputs in it, when it is parsed)"""
+  definitions = {}
+  entries = {} # name: (sort, value) texts, the sort None from get-value
+  if isinstance(model, str):
+    found = _model_entries(model)
+    for name, sort, value in found:
+      entries[name] = (sort, value)
+    if model.count("define-fun") > len(found):
+      model = LispNode(model)
+  if not isinstance(model, str):
+    for define in model.find("define-fun"):
+      definitions[str(define.parent.children[1])] = define.parent.children
+  for lispnode in lispnode_list:
+    if not lispnode.is_token and len(lispnode.children) > 1 and \
+       lispnode.children[0] == "declare-fun":
+      name = str(lispnode.children[1])
+      children = definitions.get(name)
+      if children == None and name in entries and len(lispnode.children) > 3:
+        sort, value = entries[name]
+        children = [LispNode(token="define-fun"), LispNode(token=name),
+            LispNode("()"), LispNode(lispnode.children[3]) if sort == None 
+            else LispNode(sort) if sort.startswith("(") else 
+            LispNode(token=sort), LispNode(value) if value.startswith("(") 
+            else LispNode(token=value)]
+      if children != None:
+        lispnode.children = list(children) # the model keeps its own list
+        for child in lispnode.children:
+          child.parent = lispnode
+
+def qf_bv_passes(localmax=False, encoding="multiply", merge=False, 
+                 cse=False, simplify=0, sweep=None):
+  """returns a PassManager with the passes converting a document to QF_BV,
+     in order (with local_max_thresholds if localmax, lookup tables encoded
+     as encoding says: see TABLE_ENCODINGS, then merge_unroll_helpers if 
+     merge, simplify, up to simplify rounds, sweep_definitions keeping the
+     names in sweep if it isn't None, and common_subterms last if cse)"""
+  passes = [
+    Pass("remove_parens_around_tokens", 
+         lambda d:remove_parens_around_tokens(d.forms)),
+    Pass("declare_datatypes", declare_datatypes, 
+         after=["remove_parens_around_tokens"]),
+    Pass("define_const", triggers=["define-const"], visit=define_const_visit,
+         makes=["define-fun"]),
+    Pass("declare_const", triggers=["declare-const"], 
+         visit=declare_const_visit, makes=["declare-fun"]),
+    Pass("define_sort", lambda d:define_sort(d.forms)),
+    Pass("define_fun_no_input", define_fun_no_input, after=["define_const"]),
+    Pass("declare_fun_boolean_input", lambda d:declare_fun_boolean_input(d.forms),
+         after=["declare_const", "declare_datatypes", "define_sort"]),
+    Pass("define_fun_boolean_input", lambda d:define_fun_boolean_input(d.forms),
+         after=["define_const", "define_fun_no_input"]),
+    Pass("functions_boolean_output_to_bv", functions_boolean_output_to_bv,
+         after=["declare_fun_boolean_input"]),
+    Pass("bv_functions_to_tables", 
+         lambda d:bv_functions_to_tables(d, encoding),
+         after=["functions_boolean_output_to_bv"]),
+    Pass("remove_parens_around_tokens-2", 
+         lambda d:remove_parens_around_tokens(d.forms),
+         after=["bv_functions_to_tables"])]
+  if localmax:
+    passes.append(Pass("local_max_thresholds", local_max_thresholds,
+                       after=["remove_parens_around_tokens-2"]))
+  passes += [
+    Pass("exists_replace", lambda d:exists_replace(d.forms),
+         after=["declare_datatypes"]),
+    Pass("forall_single", lambda d:forall_single(d.forms), 
+         after=["exists_replace"]),
+    Pass("forall_unroll", forall_unroll,
+         after=["forall_single", "declare_datatypes", "define_sort"]),
+    Pass("remove_parens_around_tokens-3", 
+         lambda d:remove_parens_around_tokens(d.forms), after=["forall_unroll"]),
+    Pass("fix_get_model", line=fix_get_model_line),
+    Pass("fix_check_sat", line=fix_check_sat_line),
+    Pass("prepend_headers", prepend_headers, after=["forall_unroll"])]
+  if merge:
+    def merge_helpers(document):
+      print "merged "+str(merge_unroll_helpers(document))+\
+            " forall-unroll helpers"
+    passes.append(Pass("merge_unroll_helpers", merge_helpers,
+                       after=["forall_unroll"]))
+  if simplify:
+    passes.append(Pass("simplify", lambda d:report_simplify(d, simplify),
+                       after=["forall_unroll"]))
+  if sweep != None:
+    passes.append(Pass("sweep_definitions", 
+                       lambda d:report_sweep_definitions(d, sweep),
+                       after=["forall_unroll"]))
+  if cse:
+    passes.append(Pass("common_subterms", report_common_subterms,
+                       after=["forall_unroll"]))
+  return PassManager(passes)
+
+def report_simplify(document, rounds):
+  "runs simplify on document (at most rounds times), and prints what it did"
+  print "simplified in %d rounds: %d bytes became %d" %\
+        simplify(document, rounds)
+
+def report_common_subterms(document):
+  "runs common_subterms on document, and prints what it did"
+  print "common subterms: %d bytes became %d (%d define-funs, %d lets)" %\
+        common_subterms(document)
+
+# the heads of top level forms which declare or define the name after them
+_DECLARATIONS = ["declare-fun", "define-fun", "declare-const", "define-const",
+                 "declare-sort", "define-sort"]
+
+def declared_symbols(lispnode):
+  "returns the names the top level form lispnode declares or defines"
+  if lispnode.is_token or len(lispnode.children) < 2 or \
+     not lispnode.children[0].is_token:
+    return []
+  head = lispnode.children[0].token
+  if head in _DECLARATIONS:
+    return [str(lispnode.children[1])]
+  if head == "declare-datatypes" and len(lispnode.children) > 2:
+    # the names of the types, and of their values
+    return [str(name) for datatype in lispnode.children[2].children
+            for name in ([datatype] if datatype.is_token else 
+                         datatype.children)]
+  return []
+
+def form_dependencies(forms):
+  """returns a list with, for each of the top level forms in forms, the forms
+     declaring the names it uses, the ones declaring the names those use, and
+     so on (in the order of forms)"""
+  declaring = {}
+  for i in range(len(forms)):
+    for name in declared_symbols(forms[i]):
+      declaring.setdefault(name, []).append(i)
+  uses = []
+  for i in range(len(forms)):
+    tokens = forms[i].tokens()
+    if tokens == None: # arena views: it might use anything
+      uses.append(set(range(len(forms))) - set([i]))
+    else:
+      uses.append(set(j for token in tokens for j in declaring.get(token, ())
+                      if j != i))
+  dependencies = []
+  for i in range(len(forms)):
+    found = set(uses[i])
+    stack = list(found)
+    while stack:
+      for j in uses[stack.pop()]:
+        if j not in found and j != i:
+          found.add(j)
+          stack.append(j)
+    dependencies.append([forms[j] for j in sorted(found)])
+  return dependencies
+
+# the names perform_analysis and local_max_thresholds_iterative look for in
+# the QF_BV, which nothing in it might use yet (see sweep_definitions)
+ANALYSIS_SYMBOLS = ["n", "thresholds", "thresholds-bv-version-lookup-table"]
+
+def _form_tokens(lispnode):
+  "returns the distinct tokens in the top level form lispnode"
+  tokens = lispnode.tokens()
+  if tokens == None: # arena views: read them off the text
+    tokens = set(re.findall(r"[^\s()]+", str(lispnode)))
+  return tokens
+
+def sweep_definitions(document, keep=()):
+  """removes the top level forms of document declaring or defining names 
+     (see declared_symbols) which nothing needs: the forms which don't 
+     declare anything (asserts, get-values, ...) need the names they use, and
+     the names in keep are needed, as are the names used by the forms 
+     declaring needed names, and so on. Returns the number of forms removed."""
+  declaring = {}
+  declarations = []
+  needed = list(keep)
+  for lispnode in document.forms:
+    names = declared_symbols(lispnode)
+    if names:
+      declarations.append(lispnode)
+      for name in names:
+        declaring.setdefault(name, []).append(lispnode)
+    else:
+      needed.extend(_form_tokens(lispnode))
+  seen = set()
+  live = set()
+  while needed:
+    name = needed.pop()
+    if name in seen:
+      continue
+    seen.add(name)
+    for lispnode in declaring.get(name, ()):
+      if id(lispnode) not in live:
+        live.add(id(lispnode))
+        needed.extend(_form_tokens(lispnode))
+  removed = 0
+  for lispnode in declarations:
+    if id(lispnode) not in live:
+      document.remove(lispnode)
+      removed += 1
+  return removed
+
+def report_sweep_definitions(document, keep=()):
+  "runs sweep_definitions on document, and prints what it did"
+  print "swept "+str(sweep_definitions(document, keep))+" unused definitions"
+
+def _source_digest():
+  """returns a digest of the code of this module and the ones it builds on, 
+     which make the QF_BV text kept by -cache"""
+  texts = []
+  for filename in [__file__, sys.modules[LispNode.__module__].__file__,
+                   sys.modules[Pass.__module__].__file__]:
+    if filename.endswith(".pyc") or filename.endswith(".pyo"):
+      filename = filename[:-1]
+    f = open(filename, "rb")
+    try:
+      texts.append(f.read())
+    finally:
+      f.close()
+  return cache_key(*texts)
+
+def convert_form(lispnode, dependencies, first_forall=0, encoding="multiply"):
+  """converts a copy of the top level form lispnode (or its text) to QF_BV
+     (as qf_bv_passes(encoding=encoding) would, but for prepend_headers) in
+     a document of its own, along with copies of the forms (or texts) it 
+     depends on (see form_dependencies), which are dropped before 
+     forall_unroll. Foralls are numbered from first_forall. Returns the lines
+     lispnode became, and the number of the next forall."""
+  document = LispDocument([LispNode(lispnode), ";"]+
+                          map(LispNode, dependencies))
+  # everything made for the dependencies goes after this line
+  marker = document.first.next
+  next_forall = []
+  def drop_dependencies(document):
+    while marker.next != None:
+      document.remove(marker.next)
+    document.remove(marker)
+  def unroll(document):
+    next_forall.append(forall_unroll(document, first_forall))
+  passes = []
+  for p in qf_bv_passes(encoding=encoding).passes:
+    if p.name == "forall_unroll":
+      passes.append(Pass("drop_dependencies", drop_dependencies))
+      passes.append(Pass(p.name, unroll, after=p.after))
+    elif p.name != "prepend_headers":
+      passes.append(p)
+  PassManager(passes).run(document)
+  return list(document.lines), next_forall[0]
+
+def cached_qf_bv(document, cache, parse=True, encoding="multiply"):
+  """returns a new LispDocument with document converted to QF_BV, as 
+     qf_bv_passes(encoding=encoding) would (but for prepend_headers). Each
+     form is converted
+     on its own (see convert_form), and the QF_BV text it became is kept in
+     cache (a pycache.DiskCache) under its text and the text of the forms it
+     depends on, so a form converted on an earlier run (with the same 
+     declarations) is just read back (and parsed, unless parse is False: 
+     then it is left as a QFBVText line, which is all write_qf_bv needs)."""
+  line_passes = [p.line for p in qf_bv_passes().passes if p.line != None]
+  source = _source_digest()
+  forms = list(document.forms)
+  texts = dict((id(form), str(form)) for form in forms)
+  dependencies = dict(zip(map(id, forms), form_dependencies(forms)))
+  converted = LispDocument()
+  foralls = 0 # the number forall_unroll gives the next forall
+  for line in document.lines:
+    if not isinstance(line, LispNode):
+      for fix in line_passes:
+        line = fix(line)
+      converted.insert_before(None, line)
+      continue
+    key = [source, encoding, texts[id(line)]]+\
+          [texts[id(form)] for form in dependencies[id(line)]]
+    tokens = line.tokens()
+    if tokens == None or set(tokens) & set(["forall", "exists", 
+                                             "declare-fun", "declare-const"]):
+      # foralls may come out of it, numbered from here
+      key.append(str(foralls))
+    key = cache_key(*key)
+    text = cache.get(key)
+    if text != None:
+      count, text = text.split("\n", 1)
+      foralls += int(count)
+      lines = [QFBVText(text)]
+      if parse:
+        lines = LispNode("("+text+")").children
+        for x in lines:
+          x.parent = None
+    else:
+      # parsed from the texts already made for the key, rather than copied
+      lines, next_forall = convert_form(texts[id(line)], 
+          [texts[id(form)] for form in dependencies[id(line)]], foralls, 
+          encoding)
+      f = StringIO()
+      write_qf_bv(lines, f)
+      cache.put(key, str(next_forall-foralls)+"\n"+f.getvalue())
+      foralls = next_forall
+      if not parse:
+        lines = [QFBVText(f.getvalue())]
+    for x in lines:
+      converted.insert_before(None, x)
+  return converted
+
+def _count_nodes(lispnode):
+  "returns how many LispNodes there are in lispnode"
+  count = 0
+  stack = [lispnode]
+  while stack:
+    node = stack.pop()
+    count += 1
+    if not node.is_token:
+      stack.extend(node.children)
+  return count
+
+def document_size(lines, memo=None):
+  """returns (nodes, bytes, widest) for lines: how many LispNodes there are
+     in them, about how long they are written out, and the widest BitVec
+     sort in them. memo, if given, is a dictionary in which to keep the 
+     numbers for each form, to use again while its hash stays the same."""
+  if memo == None:
+    memo = {}
+  nodes = 0
+  size = 0
+  widest = 0
+  for line in lines:
+    if isinstance(line, LispNode):
+      kept = memo.get(id(line))
+      if kept == None or kept[0] is not line or kept[1] != hash(line):
+        form_widest = 0
+        for bitvec in line.find("BitVec"):
+          if bitvec.parent != None and len(bitvec.parent.children) > 2 and\
+             bitvec.parent.children[2].token.isdigit():
+            form_widest = max(form_widest, 
+                              int(bitvec.parent.children[2].token))
+        kept = (line, hash(line), _count_nodes(line), len(str(line))+1,
+                form_widest)
+        memo[id(line)] = kept
+      nodes += kept[2]
+      size += kept[3]
+      widest = max(widest, kept[4])
+    elif str(line).strip():
+      size += len(str(line).strip())+1
+  return nodes, size, widest
+
+def _table_estimate(declare_fun, encoding="multiply"):
+  """returns (nodes, bytes, widest) bv_functions_to_tables will add for 
+     the declare-fun token node declare_fun (see is_bv_function) with 
+     encoding: the lookup table's declaration (or the entries'), and the
+     definition the declaration becomes (see table_encoding_costs)"""
+  args = declare_fun.parent.children[2].children
+  arg_bits = reduce(lambda x,y:x+int(str(y.children[2])), args, 0)
+  sort_bits = int(str(declare_fun.parent.children[3].children[2]))
+  name = str(declare_fun.parent.children[1])
+  encoding = table_encoding(encoding, name, arg_bits, sort_bits, len(args))
+  costs = table_encoding_costs(arg_bits, sort_bits, len(name), len(args))
+  return costs[encoding][:3]
+
+def _unroll_estimate(forall):
+  """returns (nodes, bytes, bits) forall_unroll will add for the forall 
+     token node forall (with a single item, after forall_single): a define-fun
+     for each bit of the item, each with all of the enclosing items as inputs,
+     or None if it won't unroll it"""
+  item_descriptions = forall.parent.children[1].children
+  if not item_descriptions or not reduce(lambda x,y: x and 
+      (len(y.children[1].children) > 2) and y.children[1].children[1] == 
+      "BitVec", item_descriptions, True):
+    return None
+  bits = int(str(item_descriptions[0].children[1].children[2]))
+  descriptions = item_descriptions_from_enclosing_foralls(forall.parent) +\
+                 item_descriptions
+  description_nodes = 1 + sum(map(_count_nodes, descriptions))
+  description_bytes = 1 + sum(len(str(d))+1 for d in descriptions)
+  call_nodes = 2 + len(descriptions)
+  call_bytes = 40 + sum(len(str(d.children[0]))+1 for d in descriptions)
+  # each bit's define-fun calls the last one twice, setting the bit in one
+  bit_nodes = 25 + description_nodes + 2*call_nodes
+  bit_bytes = 150 + description_bytes + 2*call_bytes
+  return (bits*bit_nodes + description_nodes, 
+          bits*bit_bytes + description_bytes, bits)
+
+def _quantity(n):
+  "returns n written out, or as a power of 2 if it is too long for that"
+  if n < 10**15:
+    return str(n)
+  return "~2^"+str(n.bit_length())
+
+class Estimate(object):
+  """
+  What converting a document to QF_BV would make, as estimate_qf_bv found:
+  .stages: (name, nodes, bytes, widest BitVec, predicted) for the document
+           after each pass it ran, and after the ones it predicted
+  .items: (pass, form, nodes, bytes, widest BitVec) for what each predicted
+          pass adds for each declaration or form
+  .over: a message for each limit of the budget which would be exceeded
+  """
+  def __init__(self, budget=None):
+    self.budget = budget or {}
+    self.stages = []
+    self.items = []
+    self.over = []
+
+  def stage(self, name, nodes, size, widest, predicted=False):
+    "adds a stage, returning whether the budget still holds"
+    self.stages.append((name, nodes, size, widest, predicted))
+    for limit, value in [("nodes", nodes), ("bytes", size), 
+                         ("width", widest)]:
+      if limit in self.budget and value > self.budget[limit]:
+        self.over.append("%s: %s %s, over the budget of %s" % (name, 
+            _quantity(value), limit, _quantity(self.budget[limit])))
+    return not self.over
+
+  def report(self, f=None, items=10):
+    """writes the stages, and the items adding the most bytes and the widest
+       BitVecs, to the file object f (or stdout). Predictions are marked ~"""
+    if f == None:
+      f = sys.stdout
+    f.write("  %-40s %12s %14s %12s\n" % ("after", "nodes", "bytes", 
+                                          "widest"))
+    for name, nodes, size, widest, predicted in self.stages:
+      f.write("%s %-40s %12s %14s %12s\n" % ("~" if predicted else " ", name,
+              _quantity(nodes), _quantity(size), _quantity(widest)))
+    biggest = sorted(self.items, key=lambda item:-item[3])[:items]
+    widest = sorted(self.items, key=lambda item:-item[4])[:items]
+    for title, chosen in [("most bytes added", biggest), 
+                          ("widest BitVecs", widest)]:
+      if chosen:
+        f.write(title+":\n")
+      for name, form, nodes, size, width in chosen:
+        f.write("~ %-22s %12s %14s %12s  %s\n" % (name, _quantity(nodes), 
+                _quantity(size), _quantity(width), form))
+    for message in self.over:
+      f.write("over budget: "+message+"\n")
+
+def _stub_tables(document):
+  """turns each declare-fun bv_functions_to_tables would make a lookup table
+     for into a define-fun with the same inputs which is just zero, without 
+     any table: what estimate_qf_bv runs in place of bv_functions_to_tables"""
+  for lispnode in document.forms:
+    for declare_fun in lispnode.find("declare-fun"):
+      if is_bv_function(declare_fun):
+        args = declare_fun.parent.children[2]
+        sort_bits = str(declare_fun.parent.children[3].children[2])
+        declare_fun.token = "define-fun"
+        for i in range(len(args.children)):
+          args.children[i] = LispNode(parent = args, children = 
+              [LispNode("generated-input-name-"+str(i)), args.children[i]])
+        declare_fun.parent.children.append(LispNode("(_ bv0 "+sort_bits+")",
+                                                    parent = declare_fun.parent))
+
+def estimate_qf_bv(document, localmax=False, budget=None, encoding="multiply"):
+  """returns an Estimate of converting (a copy of) document to QF_BV, with 
+     qf_bv_passes(localmax, encoding). It runs the passes, measuring the 
+     document after each, but for bv_functions_to_tables and forall_unroll,
+     whose additions it predicts from each declaration and forall. It never
+     makes the tables: _stub_tables runs in place of bv_functions_to_tables,
+     and what the tables would add beyond the stubs is added to the 
+     measurements after it. It doesn't run forall_unroll or anything after
+     it, which add little else.
+     It stops as soon as a limit of budget, a dictionary with any of "nodes",
+     "bytes" and "width" (the widest BitVec), would be exceeded."""
+  document = LispDocument(LispNode(str(x)) if isinstance(x, LispNode) else x
+                          for x in document.lines)
+  estimate = Estimate(budget)
+  memo = {}
+  if not estimate.stage("input", *document_size(document.lines, memo)):
+    return estimate
+  extra = None # what the tables add beyond their stubs, once they're stubbed
+  for p in qf_bv_passes(localmax, encoding).passes:
+    if p.name in ["bv_functions_to_tables", "forall_unroll"]:
+      nodes, size, widest = estimate.stages[-1][1:4]
+      for lispnode in document.forms:
+        form = " ".join(str(lispnode).split())[:60]
+        for token in lispnode.find(p.name == "forall_unroll" and "forall" or
+                                   "declare-fun"):
+          if p.name == "forall_unroll":
+            added = _unroll_estimate(token)
+          elif is_bv_function(token):
+            added = _table_estimate(token, encoding)
+          else:
+            added = None
+          if added != None:
+            estimate.items.append((p.name, form)+added)
+            nodes += added[0]
+            size += added[1]
+            widest = max(widest, added[2])
+      if not estimate.stage(p.name, nodes, size, widest, predicted=True) or\
+         p.name == "forall_unroll":
+        return estimate
+    if p.name == "bv_functions_to_tables":
+      _stub_tables(document)
+      stubbed = document_size(document.lines, memo)
+      extra = (nodes - stubbed[0], size - stubbed[1], widest)
+      continue
+    p.run(document)
+    nodes, size, widest = document_size(document.lines, memo)
+    if extra != None:
+      if not estimate.stage(p.name, nodes + extra[0], size + extra[1], 
+                            max(widest, extra[2]), predicted=True):
+        return estimate
+    elif not estimate.stage(p.name, nodes, size, widest):
+      return estimate
+  return estimate
 
 def retrieve_and_remove(args, keys, default):
   """if an element of keys is in args, and is not the last element in arg,
@@ -729,6 +2467,95 @@ def main(args):
 
     -model or -m: the filename to which to write the solver's output
 
+    -timings: print how long each pass (or set of passes run together) took
+
+    -share: store terms that get copied many times (as when unrolling 
+            quantifiers) once each, sharing them between the copies. Uses
+            less memory and time on large inputs; the output is the same.
+
+    -tables: how to look up the values of declared functions in their lookup
+             tables: multiply (shift the table by the inputs times the 
+             output width), shift (the same, but shifting by the inputs 
+             followed by zeros where the output width is a power of two),
+             ite (a tree of ites over the bits of the inputs picking slices
+             of the table), entries (the same tree, picking one constant per
+             entry, instead of a table), or auto (whichever of multiply, 
+             shift and ite looks cheapest for each function, by the size of
+             its text and how many gates bit-blasting it makes; see 
+             benchmark.py tables). default: multiply
+             Functions with more than 16 bits of input use shift (or 
+             multiply) rather than ite or entries, which would write out a 
+             leaf for each of their 65536 or more entries.
+
+    -merge-helpers: of the functions made unrolling foralls, keep one of each
+                    set which are the same but for the names of their inputs
+                    (as the range checks of declared functions returning the
+                    same datatype often are), and call it in place of the 
+                    rest. Prints how many were merged.
+
+    -cse: name the terms that come up more than once in the result: those 
+          using no function inputs with a define-fun before their first use,
+          the rest with lets in the function or assert they are in. Prints
+          how many bytes that saved.
+
+    -simplify: fold operations on literals into literals, and take out 
+               round trips such as (= #b1 (ite c #b1 #b0)), over and over 
+               until nothing changes. Prints how many bytes that saved.
+
+    -simplify-rounds: simplify, at most this many times over. default: 4
+
+    -sweep: leave out the declarations and definitions which nothing uses: 
+            not the asserts, get-values and other commands, not the names
+            -keep lists (nor, with -analysis or -iterative-optimize, the
+            ones they look for), and not the declarations and definitions
+            of names used by those, and so on. Prints how many were left 
+            out.
+
+    -keep: a comma separated list of names -sweep should keep
+
+    -cache: a directory in which to keep the QF_BV each top level expression
+            became, keyed by its text and that of the declarations it uses,
+            so that later runs only convert the expressions which changed
+            (or use changed declarations). Not used with -localmax, which 
+            ties all the asserts together, and -timings doesn't time it.
+            Converting each expression on its own (with the declarations it
+            uses) costs more than converting them all at once: a run with an
+            empty cache may take up to twice as long as one without -cache.
+
+    -cache-size: how many megabytes the -cache directory may hold before the
+                 least recently used entries are removed. default: 256
+
+    -solver-cache: a directory in which to keep what the solver said (when
+                   it was sat or unsat) about each QF_BV file it was run on
+                   (including those -iterative-optimize writes), keyed by
+                   the solver command line and the text of the file, less
+                   comments, spacing and the names of bound variables, so
+                   that the same problem isn't solved twice. How often it 
+                   was used is printed at the end.
+
+    -solver-cache-size: the same as -cache-size, for -solver-cache
+
+    -portfolio: a comma separated list of solver command lines to use in 
+                place of -solver: each QF_BV file (including those 
+                -iterative-optimize writes) is given to all of them at once,
+                and the first to say sat or unsat is taken, the rest being
+                stopped. How many times each won is printed at the end.
+
+    -portfolio-log: a file to which a line is added for each -portfolio 
+                    race: the winner, how long it took, what it said, and 
+                    the file, for choosing which solvers to race
+
+    -dry-run: don't transform anything, just estimate how big the result 
+              would get (see below), and write out the estimate
+
+    -budget-nodes, -budget-bytes, -budget-width: limits on the nodes, bytes,
+              and widest BitVec (such as a lookup table) of the result. The 
+              result is estimated first, passing the declarations and foralls
+              through the passes up to the lookup tables and unrolling, and
+              predicting what those will add. If a limit would be exceeded, 
+              the estimate is written out, and nothing is transformed (the 
+              exit status is 1).
+
     -analysis or -a: if this tag is present, we execute analysis specific to 
                      Isaac's research. The remaining tags pertain to this.
 
@@ -744,6 +2571,27 @@ def main(args):
                                as -localmax, but it's slower, and less likely
                                to run out of memory and crash.
 
+    -session: the command line of a solver which reads SMT-LIB commands from
+              its standard input, such as "z3 -in", for -iterative-optimize 
+              to keep running, rather than running -solver on a file for 
+              every bit it tries: the QF_BV is sent once, and each bit is 
+              tried in a push/pop scope of its own.
+
+    -jobs: how many -session solvers -iterative-optimize runs at once, each 
+           trying a different bit, taking the first bit (in order) which 
+           can be flipped, as one solver would. Prints how many checks each
+           solver answered, and how many were cancelled when another bit 
+           was flipped first (a cancelled check is left to finish, its 
+           answer dropped, and the solver then tries another bit, so the
+           QF_BV is only sent once). default: 1
+
+    -bisect: how many bits -iterative-optimize should try at once, with one
+             -session solver: if one of them can be flipped, the bits are
+             cut in halves until it is found. After a flip it goes on from
+             the next bit (rather than from the first), and goes over the 
+             bits again until none can be flipped. Best when most bits 
+             can't be. The checks it took are printed.
+
     -localmax or -l: requires from the solver that this set of thresholds is
                      locally maximal, which is to say that there there is no 
                      one set of possible responses which presently does not 
@@ -751,9 +2599,48 @@ def main(args):
                      without violating a requirement.
                      DANGER: this option makes z3 (I don't know about other
                              solvers) take MUCH longer.
+                     With -session, the QF_BV is written without this, and
+                     solved in the session, which then tries flipping each
+                     bit of the thresholds table with check-sat-assuming 
+                     (and one selector for each bit), as 
+                     -iterative-optimize does (keeping the other declared
+                     functions as the first solution has them), but 
+                     skipping the flips which need what earlier unsat ones
+                     did (by get-unsat-assumptions). The checks it took 
+                     are printed.
     
     """
     return 0
+  dry_run = False
+  if "-dry-run" in args:
+    dry_run = True
+    args.pop(args.index("-dry-run"))
+  timings = False
+  if "-timings" in args:
+    timings = True
+    args.pop(args.index("-timings"))
+  rounds = 0
+  if "-simplify" in args:
+    rounds = 4
+    args.pop(args.index("-simplify"))
+  rounds = int(retrieve_and_remove(args, ["-simplify-rounds"], rounds))
+  cse = False
+  if "-cse" in args:
+    cse = True
+    args.pop(args.index("-cse"))
+  sweep = None
+  if "-sweep" in args:
+    sweep = []
+    args.pop(args.index("-sweep"))
+  keep = retrieve_and_remove(args, ["-keep"], "")
+  merge = False
+  if "-merge-helpers" in args:
+    merge = True
+    args.pop(args.index("-merge-helpers"))
+  global shared_terms
+  if "-share" in args:
+    shared_terms = LispArena(shared=True)
+    args.pop(args.index("-share"))
   iterative_optimize = False
   if "-iterative-optimize" in args:
     iterative_optimize = True
@@ -774,6 +2661,10 @@ def main(args):
   if "-l" in args:
     localmax = True
     args.pop(args.index("-l"))
+  if sweep != None:
+    sweep = [name for name in keep.split(",") if name]
+    if analysis or iterative_optimize:
+      sweep += ANALYSIS_SYMBOLS
   now = str("-".join(str(datetime.datetime.now()).split()))
   html_filename = retrieve_and_remove(args, ["-html","-w"], "/tmp/pysmt-html-"+\
                                                             now+".html")
@@ -782,80 +2673,165 @@ def main(args):
   qf_bv_filename= retrieve_and_remove(args, ["-QF-BV","-qf-bv","-qf_bv",
       "-QF_BV","-q"], "/tmp/pysmt-QF_BV-"+now+".smt2")
   solver = retrieve_and_remove(args, ["-solver","-s"],"z3")
+  portfolio = retrieve_and_remove(args, ["-portfolio"], None)
+  portfolio_log = retrieve_and_remove(args, ["-portfolio-log"], None)
+  if portfolio != None:
+    solver = Portfolio(portfolio.split(","), portfolio_log)
+  session_command = retrieve_and_remove(args, ["-session"], None)
+  jobs = int(retrieve_and_remove(args, ["-jobs"], "1"))
+  if jobs > 1 and session_command == None:
+    print "-jobs needs -session"
+    return 1
+  # with -session, -localmax is done in the session, with selectors
+  localmax_session = localmax and session_command != None
+  if localmax_session:
+    localmax = False
+    if sweep != None:
+      sweep.append("thresholds-bv-version-lookup-table")
+  block = retrieve_and_remove(args, ["-bisect"], None)
+  if block != None:
+    block = int(block)
+    if session_command == None or jobs > 1:
+      print "-bisect needs -session, and one solver (no -jobs)"
+      return 1
+  cache_directory = retrieve_and_remove(args, ["-cache"], None)
+  cache_size = retrieve_and_remove(args, ["-cache-size"], "256")
+  solver_cache = retrieve_and_remove(args, ["-solver-cache"], None)
+  solver_cache_size = retrieve_and_remove(args, ["-solver-cache-size"], "256")
+  if solver_cache != None:
+    solver_cache = DiskCache(solver_cache, 
+                             int(float(solver_cache_size)*(1 << 20)))
+  encoding = retrieve_and_remove(args, ["-tables"], "multiply")
+  if encoding not in TABLE_ENCODINGS:
+    print "-tables must be one of "+", ".join(TABLE_ENCODINGS)
+    return 1
+  budget = {}
+  for limit in ["nodes", "bytes", "width"]:
+    value = retrieve_and_remove(args, ["-budget-"+limit], None)
+    if value != None:
+      budget[limit] = int(float(value))
   input_filename = args[0]
+  document = LispDocument(lisp_file_forms(input_filename, comment=";"))
+  if dry_run or budget:
+    estimate = estimate_qf_bv(document, localmax, budget, encoding)
+    if dry_run or estimate.over:
+      estimate.report()
+    if estimate.over:
+      print "not transforming "+input_filename+": it is over budget"
+      return 1
+    if dry_run:
+      return 0
   print "transforming "+input_filename+" to "+qf_bv_filename
-  a, l = lisp_file_comments(input_filename, comment=";")
-  remove_parens_around_tokens(l)
-  declare_datatypes(a,l)
-  define_const(l)
-  declare_const(l)
-  define_sort(l)
-  define_fun_no_input(a,l)
-  declare_fun_boolean_input(l)
-  define_fun_boolean_input(l)
-  functions_boolean_output_to_bv(a,l)
-  bv_functions_to_tables(a,l)
-  remove_parens_around_tokens(l)
-  if localmax:
-    local_max_thresholds(a,l)
-  exists_replace(l)
-  forall_single(l)
-  forall_unroll(a,l)
-  remove_parens_around_tokens(l)
-  fix_get_model(a)
-  fix_check_sat(a)
-  prepend_headers(a,l)
+  if cache_directory != None and localmax:
+    print "not using the cache: -localmax ties all the asserts together"
+  if cache_directory != None and not localmax:
+    cache = DiskCache(cache_directory, int(float(cache_size)*(1 << 20)))
+    document = cached_qf_bv(document, cache, 
+                            parse=analysis or iterative_optimize or merge or
+                                  cse or rounds or sweep != None, 
+                            encoding=encoding)
+    prepend_headers(document)
+    if merge:
+      print "merged "+str(merge_unroll_helpers(document))+\
+            " forall-unroll helpers"
+    if rounds:
+      report_simplify(document, rounds)
+    if sweep != None:
+      report_sweep_definitions(document, sweep)
+    if cse:
+      report_common_subterms(document)
+    cache.evict()
+    cache.report()
+  else:
+    passes = qf_bv_passes(localmax, encoding, merge, cse, rounds, 
+                          sweep)
+    passes.run(document)
+    if timings:
+      passes.report()
   if analysis and (not iterative_optimize):
-    n = get_n(l)
-    append_analysis(n,a,l)
+    n = get_n(document.forms)
+    append_analysis(n, document)
   qf_bv_file = open(qf_bv_filename,"w")
-  for x in map(lambda x:str(x).strip(),a):
-    if (len(x) > 0):
-      if (x[0] == "("):
-        x = LispNode(x).pretty_print()
-      qf_bv_file.write(x)
-      qf_bv_file.write("\n")
+  write_qf_bv(document.lines, qf_bv_file)
   qf_bv_file.flush() 
   qf_bv_file.close() 
   print "transformation complete: "+qf_bv_filename
   if solver != "NONE":
     print("attempting to apply solver to produce "+model_filename)
-    os.system(solver+" "+qf_bv_filename+" > "+model_filename)
+    if localmax_session:
+      session = SolverSession(session_command)
+      try:
+        model = local_max_thresholds_assume(document, session)
+        if model == None:
+          print "no thresholds-bv-version-lookup-table to maximize"
+          model = "sat"
+        if model == "sat" or model.startswith("#b"):
+          model = "sat\n"+session.ask("(get-model)")
+      finally:
+        session.close()
+      session.report()
+      open(model_filename, "w").write(model+"\n")
+    else:
+      run_solver(solver, qf_bv_filename, model_filename, solver_cache)
     model = open(model_filename,"r").read()
     model = model.strip()
     if model.startswith("sat"):
       print "sat"
       if iterative_optimize:
         m = LispNode(model[3:])
-        iot = local_max_thresholds_iterative(a, l,m,solver)
-        open(model_filename,"w").write("sat\n"+m.pretty_print())
+        if block != None:
+          session = SolverSession(session_command)
+          try:
+            iot = local_max_thresholds_bisect(document, m, session, block)
+          finally:
+            session.close()
+          session.report()
+        elif jobs > 1:
+          pool = SolverPool(session_command, jobs)
+          try:
+            iot = local_max_thresholds_parallel(document, m, pool)
+          finally:
+            pool.close()
+          pool.report()
+        elif session_command != None:
+          session = SolverSession(session_command)
+          try:
+            iot = local_max_thresholds_session(document, m, session)
+          finally:
+            session.close()
+          session.report()
+        else:
+          iot = local_max_thresholds_iterative(document,m,solver,solver_cache)
+        # the search changed values under m without clearing its caches
+        open(model_filename,"w").write("sat\n"+
+                                       LispNode(str(m)).pretty_print())
         if analysis:
-          n = get_n(l)
-          append_analysis(n,a,l)
+          n = get_n(document.forms)
+          append_analysis(n, document)
           qf_bv_file = open("/tmp/iterative-analysis-final-"+now+".smt2","w")
-          for x in map(lambda x:str(x).strip(),a):
-            if (len(x) > 0):
-              if (x[0] == "("):
-                x = LispNode(x).pretty_print()
-                qf_bv_file.write(x)
-                qf_bv_file.write("\n")
+          write_qf_bv(document.lines, qf_bv_file, comments=False)
           qf_bv_file.flush() 
           qf_bv_file.close() 
-          os.system(solver+" /tmp/iterative-analysis-final-"+now+".smt2"+" > "+\
-                    "/tmp/iterative-analysis-model-"+now+".smt2")
+          run_solver(solver, "/tmp/iterative-analysis-final-"+now+".smt2",
+                     "/tmp/iterative-analysis-model-"+now+".smt2", solver_cache)
           model = open("/tmp/iterative-analysis-model-"+now+".smt2","r").read()
           model = model.strip()
       if analysis:
-        n = get_n(l)
+        n = get_n(document.forms)
         print "analysis generating html to "+html_filename
-        perform_analysis(n,LispNode(model[3:]),html_filename)
+        perform_analysis(n, read_model(model[3:]), html_filename)
         print "done."
     elif model.startswith("unsat"):
       print "unsat"
     else:
       print "solver failed"
       print model
+  if solver_cache != None:
+    solver_cache.evict()
+    solver_cache.report()
+  if isinstance(solver, Portfolio):
+    solver.report()
 
 
 if __name__ == '__main__':
-  main(map(str, list(sys.argv)[1:]))
+  sys.exit(main(map(str, list(sys.argv)[1:])))
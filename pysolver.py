@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# A solver kept running between questions: one process reading SMT-LIB
+# commands from its standard input (as z3 -in does), and answering them on
+# its standard output; pools of them; and portfolios of solvers raced 
+# against each other.
+import os
+import re
+import sys
+import time
+import select
+import signal
+import subprocess
+
+class SolverException(Exception):
+  " an Exception for when the solver stops answering "
+  def __init__(self, value):
+    self.value = value
+  def __str__(self):
+    return repr(self.value)
+
+# what doesn't count towards the depth of parentheses: strings and |symbols|
+_QUOTED = re.compile(r'"(?:[^"]|"")*"|\|[^|]*\|')
+
+def _depth(line):
+  "returns how many more parentheses line opens than it closes"
+  line = _QUOTED.sub("", line).split(";", 1)[0]
+  return line.count("(") - line.count(")")
+
+class SolverSession(object):
+  """
+  One solver process, started by the shell command line .command, which is
+  sent commands one after another, and keeps what they asserted (within the
+  scopes push and pop make) between checks:
+  .checks: how many check-sats it has answered
+  .seconds: how long it took to answer them, all together
+  """
+  def __init__(self, command):
+    self.command = command
+    self.checks = 0
+    self.seconds = 0.0
+    self.started = None
+    # exec, so that kill stops the solver, rather than a shell running it
+    self.process = subprocess.Popen("exec "+command, shell=True,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+
+  def send(self, text):
+    "sends the commands in text, which the solver doesn't answer"
+    self.process.stdin.write(text)
+    if not text.endswith("\n"):
+      self.process.stdin.write("\n")
+    self.process.stdin.flush()
+
+  def read(self):
+    """returns the solver's next answer: a token, or an s-expression, which
+       may take several lines"""
+    lines = []
+    depth = 0
+    while True:
+      line = self.process.stdout.readline()
+      if not line:
+        raise SolverException(self.command+" stopped answering"+
+                              (": "+"".join(lines) if lines else ""))
+      if not lines and not line.strip():
+        continue
+      lines.append(line)
+      depth += _depth(line)
+      if depth <= 0:
+        return "".join(lines).strip()
+
+  def ask(self, text):
+    "sends the command text, and returns the answer to it (see read)"
+    self.send(text)
+    return self.read()
+
+  def push(self):
+    "opens a scope, which pop drops what is asserted in"
+    self.send("(push 1)")
+
+  def pop(self):
+    "drops what was asserted since the last push"
+    self.send("(pop 1)")
+
+  def start_check(self, assumptions=None):
+    """sends check-sat (or check-sat-assuming the literals assumptions, if 
+       given), without waiting for the answer, which finish_check reads"""
+    self.started = time.time()
+    if assumptions == None:
+      self.send("(check-sat)")
+    else:
+      self.send("(check-sat-assuming ("+" ".join(assumptions)+"))")
+
+  def finish_check(self):
+    "returns the answer to the check start_check sent (see check_sat)"
+    answer = self.read()
+    self.seconds += time.time() - self.started
+    self.checks += 1
+    return answer
+
+  def check_sat(self, assumptions=None):
+    """returns sat, unsat, unknown or the error the solver gave checking what
+       is asserted (along with the literals assumptions, if given, through
+       check-sat-assuming)"""
+    self.start_check(assumptions)
+    return self.finish_check()
+
+  def close(self):
+    "asks the solver to exit, and waits for it to"
+    try:
+      self.send("(exit)")
+      self.process.stdin.close()
+    except (IOError, OSError):
+      pass
+    self.process.wait()
+
+  def kill(self):
+    "stops the solver, whatever it is doing"
+    try:
+      self.process.kill()
+    except OSError:
+      pass
+    self.process.wait()
+
+  def report(self, f=None):
+    "writes how many checks there were, and how long they took, to f"
+    if f == None:
+      f = sys.stdout
+    f.write("solver session %s: %d checks, %.3fs\n" % (self.command,
+            self.checks, self.seconds))
+
+class SolverPool(object):
+  """
+  jobs SolverSessions running the same command, each of which can be 
+  checking something different at once:
+  .sessions: the sessions
+  .busy: the indices of the sessions which haven't answered their checks
+  .stale: those of them whose answers are no longer wanted (see cancel)
+  .checks, .seconds, .cancelled: for each session, how many checks it has 
+                                 answered, how long that took, and how many
+                                 of them were cancelled
+  """
+  def __init__(self, command, jobs):
+    self.command = command
+    self.sessions = [SolverSession(command) for i in range(jobs)]
+    self.busy = set()
+    self.stale = set()
+    self.checks = [0]*jobs
+    self.seconds = [0.0]*jobs
+    self.cancelled = [0]*jobs
+
+  def send_all(self, text):
+    "sends the commands in text to every session"
+    for session in self.sessions:
+      session.send(text)
+
+  def idle(self):
+    "returns the indices of the sessions which aren't checking anything"
+    return [i for i in range(len(self.sessions)) if i not in self.busy]
+
+  def check(self, i, text):
+    """has session i check what is asserted along with the commands in text,
+       in a scope of its own, answering later (see wait)"""
+    session = self.sessions[i]
+    session.push()
+    session.send(text)
+    session.start_check()
+    self.busy.add(i)
+
+  def wait(self):
+    """waits for one or more of the busy sessions to answer, and returns 
+       a list of (index, answer) for those which have (leaving out the 
+       stale ones, which are idle again)"""
+    ready = select.select([self.sessions[i].process.stdout 
+                           for i in self.busy], [], [])[0]
+    answers = []
+    for i in sorted(self.busy):
+      session = self.sessions[i]
+      if session.process.stdout in ready:
+        seconds = session.seconds
+        answer = session.finish_check()
+        session.pop()
+        self.busy.discard(i)
+        self.checks[i] += 1
+        self.seconds[i] += session.seconds - seconds
+        if i in self.stale:
+          self.stale.discard(i)
+        else:
+          answers.append((i, answer))
+    return answers
+
+  def cancel(self, i):
+    """drops the answer to the check session i is busy with. The check isn't
+       stopped (which would mean starting the solver over, and sending it
+       everything again): the session is busy until it answers"""
+    if i in self.busy and i not in self.stale:
+      self.stale.add(i)
+      self.cancelled[i] += 1
+
+  def close(self):
+    "asks every session to exit (stopping those still checking)"
+    for i in range(len(self.sessions)):
+      if i in self.busy:
+        self.sessions[i].kill()
+      else:
+        self.sessions[i].close()
+    self.busy = set()
+    self.stale = set()
+
+  def report(self, f=None):
+    "writes what each session did to f"
+    if f == None:
+      f = sys.stdout
+    for i in range(len(self.sessions)):
+      f.write("solver %d of %s: %d checks, %.3fs, %d cancelled\n" % (i, 
+              self.command, self.checks[i], self.seconds[i], 
+              self.cancelled[i]))
+
+class Portfolio(object):
+  """
+  Solver command lines raced against each other: each file is given to all
+  of them at once, and the first to say sat or unsat is taken, the rest 
+  being stopped:
+  .commands: the command lines
+  .wins, .seconds: for each, how many races it won, and how long they took
+  .log: a file name to which a line is added for each race (the winner, 
+        how long it took, what it said, and the file), or None
+  """
+  def __init__(self, commands, log=None):
+    self.commands = list(commands)
+    self.wins = [0]*len(self.commands)
+    self.seconds = [0.0]*len(self.commands)
+    self.log = log
+
+  def __str__(self):
+    return ",".join(self.commands)
+
+  def run(self, filename):
+    """returns what the first of the commands to say sat or unsat (run on 
+       filename) said, or, if none did, what the first said"""
+    start = time.time()
+    # each in a process group of its own, so that killing the group stops 
+    # everything the command line started (a pipeline, say), not just a shell
+    processes = [subprocess.Popen(command+" "+filename, shell=True,
+                                  stdout=subprocess.PIPE, preexec_fn=os.setsid)
+                 for command in self.commands]
+    outputs = [[] for command in self.commands]
+    running = set(range(len(processes)))
+    winner = None
+    try:
+      while running and winner == None:
+        ready = select.select([processes[i].stdout for i in running], 
+                              [], [])[0]
+        for i in sorted(running):
+          if processes[i].stdout in ready:
+            chunk = os.read(processes[i].stdout.fileno(), 1 << 16)
+            if chunk:
+              outputs[i].append(chunk)
+              continue
+            running.discard(i)
+            processes[i].wait()
+            answer = "".join(outputs[i]).lstrip()
+            if answer.startswith("sat") or answer.startswith("unsat"):
+              winner = i
+              break
+    finally:
+      for process in processes:
+        try:
+          os.killpg(process.pid, signal.SIGKILL)
+        except OSError: # everything in it has finished
+          pass
+        process.wait()
+    seconds = time.time() - start
+    text = "".join(outputs[winner if winner != None else 0])
+    if winner != None:
+      self.wins[winner] += 1
+      self.seconds[winner] += seconds
+    if self.log != None:
+      f = open(self.log, "a")
+      try:
+        f.write("%s\t%.3f\t%s\t%s\n" % (self.commands[winner] if winner != 
+                None else "NONE", seconds, (text.split() or [""])[0], 
+                filename))
+      finally:
+        f.close()
+    return text
+
+  def report(self, f=None):
+    "writes how many races each command won, and how long they took, to f"
+    if f == None:
+      f = sys.stdout
+    for i in range(len(self.commands)):
+      f.write("portfolio %s: %d wins, %.3fs\n" % (self.commands[i],
+              self.wins[i], self.seconds[i]))